@@ -1,24 +1,27 @@
 """
-This is where the flask application starts. One of the functions of the `flask
-run` command-line tool is to attempt to `import app`. Because the name of the
-package associated with this file is named `app`, this script is called to
-initiate the application.
+This is where the flask application starts. The application is built by
+`create_app()`, which the `flask` command-line tool finds through `FLASK_APP`
+(see `flaskapp.py`). Importing this package only creates the extension
+objects; nothing is connected to an application, and no routes, models or
+templates are loaded, until `create_app()` is called.
 
-Functions performed by this fie include:
+Functions performed by `create_app()` include:
  - Importing configuration settings from `config.py` in the project root
-   directory
- - Initializing database objects
- - Importing the `routes.py` module, which contains all of the website URLs
-   (i.e., view functions)
- - Configure settings for mail server, if one is set up
- - Configure logging settings
+   directory, or from the configuration class that is passed in
+ - Initializing each extension for the application
+ - Registering the blueprints, which contain all of the website URLs (i.e.,
+   view functions) and error handlers, and the `flask` commands
+ - Configure logging settings (see `app/log.py`)
+
+Several worker processes can share one preloaded application (e.g., with
+`gunicorn --preload`). Database connections, threads and process pools are
+never carried over into a forked worker; each one opens its own.
 """
 
 import logging
 import os
-from logging.handlers import RotatingFileHandler, SMTPHandler
 
-from flask import Flask, request
+from flask import Flask, current_app, request
 from flask_babel import Babel
 from flask_babel import lazy_gettext as _l
 from flask_bootstrap import Bootstrap
@@ -26,100 +29,165 @@ from flask_login import LoginManager
 from flask_mail import Mail
 from flask_migrate import Migrate
 from flask_moment import Moment
-from flask_sqlalchemy import SQLAlchemy
-
+from sqlalchemy import event, exc
+from sqlalchemy.pool import Pool
+
+from app.cache import ResponseCache
+from app.database import Database
+from app.fragments import FragmentCache
+from app.instrumentation import Instrumentation
+from app.last_seen import LastSeenTracker
+from app.log import QueueLogging
+from app.mail_queue import MailQueue
+from app.passwords import PasswordHasher
+from app.search import SearchIndex
+from app.stream import PostStream
 from config import Config
 
-# Initialize the application and load configuration settings from the
-# config.py located in the root of the application directory.
-app = Flask(__name__)
-app.config.from_object(Config)
-
 # Create flask-mail object.
-mail = Mail(app)
+mail = Mail()
 
 # Create flask-bootstrap object
-bootstrap = Bootstrap(app)
+bootstrap = Bootstrap()
 
 # Create flask-moment object
-moment = Moment(app)
+moment = Moment()
 
 # Create flask-babel object
-babel = Babel(app)
+babel = Babel()
+
+# Initialize the database object, which also tunes the connection pool and
+# SQLite, and routes the reads of some views to a replica (see
+# `app/database.py`).
+db = Database()
+
+# Database migration engine, for the `flask db` commands and for scripts that
+# call `flask_migrate.upgrade()`
+migrate = Migrate()
+
+# Count the queries and time of every request, for `Server-Timing`, the slow
+# request log and `/metrics`
+instrumentation = Instrumentation()
+
+# Buffer `last_seen` updates in memory and write them to the database in bulk
+last_seen = LastSeenTracker(db=db)
+
+# Cache for rendered post lists that are the same for every viewer
+cache = ResponseCache()
+
+# Cache for the rendered HTML of each post, shared by every feed page
+fragments = FragmentCache()
+
+# Outbound email is stored in the database and sent by a pool of workers
+mail_queue = MailQueue(db=db, mail=mail)
 
-# Initialize the database object, as well as the another object representing
-# the database migration engine
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
+# Passwords are hashed in a separate pool of processes
+passwords = PasswordHasher()
+
+# Full-text index of posts, for `/search`
+search_index = SearchIndex()
+
+# New posts are pushed to the open feed pages over Server-Sent Events
+post_stream = PostStream()
+
+# Log records are written from a background thread (only in production)
+queue_logging = QueueLogging()
 
 # Initialize the flask login object
-login = LoginManager(app)
-login.login_view = "login"
+login = LoginManager()
+login.login_view = "auth.login"
 
 # Override the default login message with a version wrapped in the
 # lazy-processing function.
 login.login_message = _l("Please log in to access this page.")
 
-# The `models` module defines the structure of the database. Note here that we
-# are importing at the bottom of the file, and not the typical top of the file.
-# This is because the `routes` module imports the `app` variable defined above.
-# This avoids a circular import.
-from app import errors, models, routes
+
+def create_app(config_class=Config):
+    """Create and configure an instance of the application."""
+    app = Flask(__name__)
+    app.config.from_object(config_class)
+
+    db.init_app(app)
+
+    migrate.init_app(app, db)
+    login.init_app(app)
+    mail.init_app(app)
+    bootstrap.init_app(app)
+    moment.init_app(app)
+    babel.init_app(app)
+    instrumentation.init_app(app)
+    last_seen.init_app(app)
+    cache.init_app(app)
+    fragments.init_app(app)
+    mail_queue.init_app(app)
+    passwords.init_app(app)
+    search_index.init_app(app)
+    post_stream.init_app(app)
+
+    # The models and blueprints are imported here rather than at the top of
+    # the file, because they import the extension objects defined above. This
+    # avoids a circular import.
+    from app import cli, identity, models
+    from app.api import bp as api_bp
+    from app.auth import bp as auth_bp
+    from app.errors import bp as errors_bp
+    from app.main import bp as main_bp
+
+    app.register_blueprint(errors_bp)
+    app.register_blueprint(auth_bp)
+    app.register_blueprint(main_bp)
+    app.register_blueprint(api_bp, url_prefix="/api/v1")
+    cli.register(app)
+
+    # Configurations for production. Log records are written to the log file,
+    # and errors are emailed to the admins, from a background thread.
+    if not app.debug and not app.testing:
+        queue_logging.init_app(app)
+        app.logger.setLevel(logging.INFO)
+        app.logger.info("Microblog")
+
+    return app
 
 
 # Select a language translation based on a best-match to the client's
 # `Accept-Languages` header.
 @babel.localeselector
 def get_local():
-    return request.accept_languages.best_match(app.config["LANGUAGES"])
-
+    return request.accept_languages.best_match(current_app.config["LANGUAGES"])
 
-# Configurations for production
-if not app.debug:
 
-    # Configure mail server
-    if app.config["MAIL_SERVER"]:
+# A connection opened before a server forked its workers belongs to the
+# parent, and using it from a child would corrupt both. Such a connection is
+# discarded on checkout, and the pool opens a new one.
+@event.listens_for(Pool, "connect")
+def _remember_pid(dbapi_connection, connection_record):
+    connection_record.info["pid"] = os.getpid()
 
-        auth = None
-        if app.config["MAIL_USERNAME"] or app.config["MAIL_PASSWORD"]:
-            auth = (app.config["MAIL_USERNAME"], app.config["MAIL_PASSWORD"])
 
-        secure = None
-        if app.config["MAIL_USE_TLS"]:
-            secure = ()
-
-        mail_handler = SMTPHandler(
-            mailhost=(app.config["MAIL_SERVER"], app.config["MAIL_PORT"]),
-            fromaddr="no-reply@" + app.config["MAIL_SERVER"],
-            toaddrs=app.config["ADMINS"],
-            subject="Microblog Failure",
-            credentials=auth,
-            secure=secure,
+@event.listens_for(Pool, "checkout")
+def _check_pid(dbapi_connection, connection_record, connection_proxy):
+    pid = os.getpid()
+    if connection_record.info["pid"] != pid:
+        connection_record.dbapi_connection = connection_proxy.dbapi_connection = None
+        raise exc.DisconnectionError(
+            "Connection belongs to process %d, not %d"
+            % (connection_record.info["pid"], pid)
         )
 
-        mail_handler.setLevel(logging.ERROR)
-        app.logger.addHandler(mail_handler)
-
-    # Configure logging
-    if not os.path.exists("logs"):
-        os.mkdir("logs")
 
-    # The RotatingFileHandler class creates a new log file whenever the log
-    # file exceeds the `maxBytes` limit. Additionally, `backupCount` denotes
-    # how many log files are backed up.
-    file_handler = RotatingFileHandler(
-        "logs/microblog.log", maxBytes=10240, backupCount=10
-    )
-
-    # Set the format of the log messages
-    file_handler.setFormatter(
-        logging.Formatter(
-            "%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]"
-        )
-    )
+def _after_fork():
+    for extension in (
+        last_seen,
+        cache,
+        fragments,
+        mail_queue,
+        passwords,
+        search_index,
+        post_stream,
+        queue_logging,
+    ):
+        extension.after_fork()
 
-    file_handler.setLevel(logging.INFO)
-    app.logger.addHandler(file_handler)
 
-    app.logger.setLevel(logging.INFO)
-    app.logger.info("Microblog")
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,15 @@
+"""
+JSON API, served under `/api/v1`.
+
+Clients get a token from `POST /api/v1/tokens` with HTTP basic auth, and send
+it as `Authorization: Bearer <token>` with every other request. Lists are
+paginated with the same cursors as the HTML pages: each response links to the
+next and previous pages in `_links`. Lists of posts can also be exported in
+full, one JSON object per line, with `?format=ndjson`.
+"""
+
+from flask import Blueprint
+
+bp = Blueprint("api", __name__)
+
+from app.api import errors, posts, tokens, users
@@ -0,0 +1,22 @@
+from flask import jsonify, request
+from werkzeug.http import HTTP_STATUS_CODES
+
+from app.api import bp
+
+
+def error_response(status_code, message=None):
+    payload = {"error": HTTP_STATUS_CODES.get(status_code, "Unknown error")}
+    if message:
+        payload["message"] = message
+    response = jsonify(payload)
+    response.status_code = status_code
+    return response
+
+
+def bad_request(message):
+    return error_response(400, message)
+
+
+def wants_json_response():
+    """True if an error should be answered in JSON rather than HTML."""
+    return request.path.startswith("/api/")
@@ -0,0 +1,119 @@
+"""
+Paginated lists of posts and users in API responses.
+
+Lists of posts use the same keyset cursors as the HTML pages, in `before` and
+`after` arguments, and are read as lightweight rows (see `app/rows.py`). With
+`?format=ndjson`, the whole list is streamed instead, one post per line. The
+stream is generated in batches of `API_STREAM_BATCH_SIZE` posts, each fetched
+with a cursor, so memory use stays the same no matter how long the list is.
+"""
+
+import json
+
+from flask import Response, current_app, jsonify, request, stream_with_context, url_for
+
+from app.models import User
+from app.pagination import decode_cursor, encode_cursor, paginate_posts
+
+
+def per_page():
+    """Return the page size asked for by the client, within bounds."""
+    default = current_app.config["POSTS_PER_PAGE"]
+    limit = current_app.config["API_MAX_PER_PAGE"]
+    return max(1, min(request.args.get("per_page", default, type=int), limit))
+
+
+def post_dict(post):
+    """Return a post (or a `PostRow`) as a dictionary for the JSON API."""
+    return {
+        "id": post.id,
+        "body": post.body,
+        "timestamp": post.timestamp.isoformat() + "Z",
+        "author": {
+            "id": post.author.id,
+            "username": post.author.username,
+            "avatar": post.author.avatar(70),
+        },
+        "_links": {
+            "self": url_for("api.get_post", id=post.id),
+            "author": url_for("api.get_user", id=post.author.id),
+        },
+    }
+
+
+def post_collection(query, endpoint, **values):
+    """Return the response for a list of the posts in `query`."""
+    if request.args.get("format") == "ndjson":
+        return stream_posts(query)
+
+    size = per_page()
+    page = paginate_posts(query, size, rows=True)
+    return jsonify(
+        {
+            "items": [post_dict(post) for post in page.items],
+            "_meta": {"per_page": size},
+            "_links": {
+                "self": url_for(endpoint, per_page=size, **values),
+                "next": url_for(
+                    endpoint, before=page.next_cursor, per_page=size, **values
+                )
+                if page.has_next
+                else None,
+                "prev": url_for(
+                    endpoint, after=page.prev_cursor, per_page=size, **values
+                )
+                if page.has_prev
+                else None,
+            },
+        }
+    )
+
+
+def stream_posts(query):
+    """Return a response that streams every post in `query` as NDJSON."""
+    batch_size = current_app.config["API_STREAM_BATCH_SIZE"]
+
+    def generate():
+        page = paginate_posts(query, batch_size, page=1, rows=True)
+        while True:
+            for post in page.items:
+                yield json.dumps(post_dict(post), separators=(",", ":")) + "\n"
+            if not page.has_next:
+                return
+            page = paginate_posts(query, batch_size, before=page.next_cursor, rows=True)
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+def user_collection(query, endpoint, **values):
+    """
+    Return the response for a list of the users in `query`, in order of id.
+    The `after` argument is the cursor of the last user of the previous page.
+    """
+    size = per_page()
+    query = query.order_by(User.id)
+    cursor = request.args.get("after")
+    if cursor:
+        try:
+            query = query.filter(User.id > int(decode_cursor(cursor)[0]))
+
+        # A malformed cursor is treated like no cursor at all.
+        except ValueError:
+            pass
+
+    users = query.limit(size + 1).all()
+    items = users[:size]
+    next_url = None
+    if len(users) > size:
+        after = encode_cursor(items[-1].id)
+        next_url = url_for(endpoint, after=after, per_page=size, **values)
+    return jsonify(
+        {
+            "items": [user.to_dict() for user in items],
+            "_meta": {"per_page": size},
+            "_links": {
+                "self": url_for(endpoint, per_page=size, **values),
+                "next": next_url,
+            },
+        }
+    )
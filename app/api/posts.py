@@ -0,0 +1,59 @@
+from flask import jsonify, request, url_for
+
+from app import db, post_stream, timeline
+from app.api import bp
+from app.api.auth import token_auth
+from app.api.errors import bad_request
+from app.api.pagination import post_collection, post_dict
+from app.database import use_replica
+from app.feeds import invalidate_feeds, render_posts
+from app.models import Post
+
+
+@bp.route("/posts", methods=["GET"])
+@token_auth.login_required
+@use_replica
+def get_posts():
+    return post_collection(Post.query, "api.get_posts")
+
+
+@bp.route("/posts/<int:id>", methods=["GET"])
+@token_auth.login_required
+def get_post(id):
+    return jsonify(post_dict(Post.query.get_or_404(id)))
+
+
+@bp.route("/posts", methods=["POST"])
+@token_auth.login_required
+def create_post():
+    data = request.get_json(silent=True) or {}
+    body = data.get("body")
+    if not isinstance(body, str) or not 0 < len(body) <= 140:
+        return bad_request("body must be between 1 and 140 characters")
+
+    user = token_auth.current_user()
+    post = Post(body=body, author=user)
+    db.session.add(post)
+
+    # Same as posting from the home page: push into timelines, and commit
+    # both in a single transaction.
+    db.session.flush()
+    timeline.push_post(post)
+    db.session.commit()
+    invalidate_feeds(user)
+    post_stream.publish_post(post, render_posts([post])[0])
+
+    response = jsonify(post_dict(post))
+    response.status_code = 201
+    response.headers["Location"] = url_for("api.get_post", id=post.id)
+    return response
+
+
+@bp.route("/timeline", methods=["GET"])
+@token_auth.login_required
+@use_replica
+def get_timeline():
+    """The home timeline of the user the token belongs to."""
+    return post_collection(
+        timeline.home_posts(token_auth.current_user()), "api.get_timeline"
+    )
@@ -0,0 +1,172 @@
+from email_validator import EmailNotValidError, validate_email
+from flask import jsonify, request, url_for
+
+from app import db, post_stream, recommendations, timeline
+from app.api import bp
+from app.api.auth import token_auth
+from app.api.errors import bad_request, error_response
+from app.api.pagination import post_collection, user_collection
+from app.database import use_replica
+from app.feeds import invalidate_feeds
+from app.models import User
+
+
+@bp.route("/users/<int:id>", methods=["GET"])
+@token_auth.login_required
+def get_user(id):
+    user = User.query.get_or_404(id)
+    return jsonify(user.to_dict(include_email=user == token_auth.current_user()))
+
+
+@bp.route("/users/<int:id>/posts", methods=["GET"])
+@token_auth.login_required
+@use_replica
+def get_user_posts(id):
+    user = User.query.get_or_404(id)
+    return post_collection(user.posts, "api.get_user_posts", id=id)
+
+
+@bp.route("/users/<int:id>/followers", methods=["GET"])
+@token_auth.login_required
+def get_followers(id):
+    user = User.query.get_or_404(id)
+    return user_collection(user.followers, "api.get_followers", id=id)
+
+
+@bp.route("/users/<int:id>/followed", methods=["GET"])
+@token_auth.login_required
+def get_followed(id):
+    user = User.query.get_or_404(id)
+    return user_collection(user.followed, "api.get_followed", id=id)
+
+
+@bp.route("/users/<int:id>/recommendations", methods=["GET"])
+@token_auth.login_required
+def get_recommendations(id):
+    """The users suggested to the user the token belongs to, best first."""
+    user = token_auth.current_user()
+    if user.id != id:
+        return error_response(403)
+
+    items = []
+    for candidate, score in recommendations.suggestions(user):
+        data = candidate.to_dict()
+        data["score"] = score
+        items.append(data)
+    return jsonify(
+        {
+            "items": items,
+            "_links": {"self": url_for("api.get_recommendations", id=id)},
+        }
+    )
+
+
+# The same limits as the HTML forms, and the columns of `User`
+USER_FIELDS = (
+    ("username", True, 64),
+    ("email", True, 120),
+    ("password", True, None),
+    ("about_me", False, 140),
+)
+
+
+def user_error(data, fields):
+    """
+    Return what is wrong with the `fields` of `data` that are given, or None
+    if they are all acceptable.
+    """
+    for name, required, max_length in USER_FIELDS:
+        if name not in fields or name not in data:
+            continue
+        value = data[name]
+        if not isinstance(value, str):
+            return "%s must be a string" % name
+        if required and not value.strip():
+            return "%s must not be empty" % name
+        if max_length is not None and len(value) > max_length:
+            return "%s must be at most %d characters" % (name, max_length)
+    if "email" in fields and "email" in data:
+        try:
+            validate_email(data["email"], check_deliverability=False)
+        except EmailNotValidError:
+            return "email must be a valid email address"
+    return None
+
+
+@bp.route("/users", methods=["POST"])
+def create_user():
+    data = request.get_json(silent=True) or {}
+    if not all(key in data for key in ("username", "email", "password")):
+        return bad_request("must include username, email and password fields")
+    error = user_error(data, ("username", "email", "password", "about_me"))
+    if error:
+        return bad_request(error)
+    if User.query.filter_by(username=data["username"]).first():
+        return bad_request("please use a different username")
+    if User.query.filter_by(email=data["email"]).first():
+        return bad_request("please use a different email address")
+
+    user = User(
+        username=data["username"],
+        email=data["email"],
+        about_me=data.get("about_me"),
+    )
+    user.set_password(data["password"])
+    db.session.add(user)
+    db.session.commit()
+
+    response = jsonify(user.to_dict(include_email=True))
+    response.status_code = 201
+    response.headers["Location"] = url_for("api.get_user", id=user.id)
+    return response
+
+
+@bp.route("/users/<int:id>", methods=["PUT"])
+@token_auth.login_required
+def update_user(id):
+    user = token_auth.current_user()
+    if user.id != id:
+        return error_response(403)
+
+    data = request.get_json(silent=True) or {}
+    error = user_error(data, ("username", "about_me"))
+    if error:
+        return bad_request(error)
+    username = data.get("username", user.username)
+    if username != user.username and User.query.filter_by(username=username).first():
+        return bad_request("please use a different username")
+    user.username = username
+    user.about_me = data.get("about_me", user.about_me)
+    db.session.commit()
+    invalidate_feeds(user)
+    return jsonify(user.to_dict(include_email=True))
+
+
+@bp.route("/users/<int:id>/followers", methods=["POST"])
+@token_auth.login_required
+def follow(id):
+    """Make the user the token belongs to follow the user with `id`."""
+    user = User.query.get_or_404(id)
+    current = token_auth.current_user()
+    if user == current:
+        return bad_request("you cannot follow yourself")
+    current.follow(user)
+    timeline.backfill(current, user)
+    recommendations.update(current)
+    db.session.commit()
+    post_stream.publish_follow(current, user)
+    return "", 204
+
+
+@bp.route("/users/<int:id>/followers", methods=["DELETE"])
+@token_auth.login_required
+def unfollow(id):
+    """Make the user the token belongs to stop following the user with `id`."""
+    user = User.query.get_or_404(id)
+    current = token_auth.current_user()
+    current.unfollow(user)
+    timeline.prune(current, user)
+    recommendations.update(current)
+    db.session.commit()
+    post_stream.publish_follow(current, user, following=False)
+    return "", 204
@@ -0,0 +1,9 @@
+"""
+Signing in and out, registering, and resetting a forgotten password.
+"""
+
+from flask import Blueprint
+
+bp = Blueprint("auth", __name__)
+
+from app.auth import routes
@@ -1,12 +1,12 @@
 """
-Stores all web form classes. Each form is passed to the appropriate web page
-via the page's view function in app/routes.py.
+Web forms of the `auth` blueprint: signing in, registering, and resetting a
+forgotten password.
 """
 
 from flask_babel import lazy_gettext as _l
 from flask_wtf import FlaskForm
-from wtforms import BooleanField, PasswordField, StringField, SubmitField, TextAreaField
-from wtforms.validators import DataRequired, Email, EqualTo, Length, ValidationError
+from wtforms import BooleanField, PasswordField, StringField, SubmitField
+from wtforms.validators import DataRequired, Email, EqualTo, ValidationError
 
 from app.models import User
 
@@ -44,33 +44,6 @@ class RegistrationForm(FlaskForm):
             raise ValidationError("Email already taken.")
 
 
-class EditProfileForm(FlaskForm):
-    username = StringField("Username", validators=[DataRequired()])
-    about_me = TextAreaField("About me", validators=[Length(min=0, max=140)])
-    submit = SubmitField("Submit")
-
-    def __init__(self, original_username, *args, **kwargs):
-        super(EditProfileForm, self).__init__(*args, **kwargs)
-        self.original_username = original_username
-
-    def validate_username(self, username):
-        if username.data != self.original_username:
-            user = User.query.filter_by(username=self.username.data).first()
-            if user is not None:
-                raise ValidationError("Please use a different username.")
-
-
-class EmptyForm(FlaskForm):
-    submit = SubmitField("Submit")
-
-
-class PostForm(FlaskForm):
-    post = TextAreaField(
-        "Say something", validators=[DataRequired(), Length(min=1, max=140)]
-    )
-    submit = SubmitField("Submit")
-
-
 class ResetPasswordRequestForm(FlaskForm):
     email = StringField("Email", validators=[DataRequired(), Email()])
     submit = SubmitField("Request Password Reset")
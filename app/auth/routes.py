@@ -0,0 +1,134 @@
+"""
+Views of the `auth` blueprint: signing in and out, registering, and resetting a
+forgotten password.
+"""
+
+from flask import flash, redirect, render_template, request, url_for
+from flask_login import current_user, login_user, logout_user
+from werkzeug.urls import url_parse
+
+from app import db
+from app.auth import bp
+from app.auth.email import send_password_reset_email
+from app.auth.forms import (
+    LoginForm,
+    RegistrationForm,
+    ResetPasswordForm,
+    ResetPasswordRequestForm,
+)
+from app.models import User
+
+
+@bp.route("/login", methods=["GET", "POST"])
+def login():
+
+    # If the user is already logged in and they attempt to navigate to the
+    # login page, redirect them to `/index`. The `current_user` variable comes
+    # from `flask_login`, representing the client of the request.
+    if current_user.is_authenticated:
+        return redirect(url_for("main.index"))
+
+    # Create the form and check to see if the fields were filled out correctly.
+    form = LoginForm()
+    if form.validate_on_submit():
+
+        # Query the table of users from the database. The `username` is
+        # obtained from the form. We use `first()` to return the (single)
+        # record.
+        user = User.query.filter_by(username=form.username.data).first()
+
+        # If the user is not in the database, or the password was incorrect,
+        # flash an error message and redirect to the login page.
+        if user is None or not user.check_password(form.password.data):
+            flash("Invalid username or password.")
+            return redirect(url_for("auth.login"))
+
+        # This is the only time we have the plain password, so it's the time
+        # to replace a hash made with an outdated method or cost.
+        if user.password_needs_rehash():
+            user.set_password(form.password.data)
+            db.session.commit()
+
+        # Log in the user, and redirect to the index
+        login_user(user, remember=form.remember_me.data)
+
+        # If the user was redirected to the login page from a page they were
+        # unable to view before logging in, redirect them back to that page.
+        # Otherwise, bring them to the index.
+        next_page = request.args.get("next")
+        if not next_page or url_parse(next_page).netloc != "":
+            next_page = url_for("main.index")
+        return redirect(next_page)
+
+    # Render the login page
+    return render_template("auth/login.html", title="Sign In", form=form)
+
+
+@bp.route("/logout")
+def logout():
+    logout_user()
+    return redirect(url_for("main.index"))
+
+
+@bp.route("/register", methods=["GET", "POST"])
+def register():
+    if current_user.is_authenticated:
+        return redirect(url_for("main.index"))
+    form = RegistrationForm()
+    if form.validate_on_submit():
+        user = User(username=form.username.data, email=form.email.data)
+        user.set_password(form.password.data)
+        db.session.add(user)
+        db.session.commit()
+        flash("Congratulations, you are now a registered user!")
+
+        return redirect(url_for("auth.login"))
+    return render_template("auth/register.html", title="Register", form=form)
+
+
+@bp.route("/reset_password_request", methods=["GET", "POST"])
+def reset_password_request():
+
+    # If the user is logged in, no need to send password reset email.
+    if current_user.is_authenticated:
+        return redirect(url_for("main.index"))
+
+    form = ResetPasswordRequestForm()
+
+    if form.validate_on_submit():
+        user = User.query.filter_by(email=form.email.data).first()
+
+        if user:
+            send_password_reset_email(user)
+
+        # Flash this message even if the user is unkown. This is so clients
+        # cannot use this form to determine if a given user is a member or not.
+        flash("Check your email for the instruction to reset your password.")
+
+        return redirect(url_for("auth.login"))
+
+    return render_template(
+        "auth/reset_password_request.html", title="Reset Password", form=form
+    )
+
+
+@bp.route("/reset_password/<token>", methods=["GET", "POST"])
+def reset_password(token):
+
+    if current_user.is_authenticated:
+        return redirect(url_for("main.index"))
+
+    user = User.verify_reset_password_token(token)
+
+    if not user:
+        return redirect(url_for("main.index"))
+
+    form = ResetPasswordForm()
+
+    if form.validate_on_submit():
+        user.set_password(form.password.data)
+        db.session.commit()
+        flash("Your password has been reset.")
+        return redirect(url_for("auth.login"))
+
+    return render_template("auth/reset_password.html", form=form)
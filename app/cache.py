@@ -0,0 +1,237 @@
+"""
+Server-side cache for rendered HTML.
+
+The post lists on `/explore` and on profile pages are the same for everybody
+who views them, so there is no reason to query and render them again for each
+viewer. `ResponseCache` stores them in one of several backends, chosen with
+`RESPONSE_CACHE_BACKEND`:
+
+ - "memory": a least-recently-used dictionary with a time-to-live, private to
+   each server process
+ - "sqlite": a table in a SQLite file at `RESPONSE_CACHE_PATH`, which can be
+   shared by several server processes on the same machine
+ - "null": caches nothing
+
+Entries are grouped into namespaces (e.g., "explore" or "user:42"). Each
+namespace has a generation token that is part of the key of every entry in it,
+so that `invalidate()` can drop a whole namespace at once by replacing the
+token, without having to find the entries. A process with a private backend
+doesn't see the invalidations of the others, so there, the tokens also expire
+after `RESPONSE_CACHE_TTL` seconds, like the entries.
+"""
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from app.sqlite import LocalConnections
+
+
+class NullBackend(object):
+    # Whether every server process sees the same entries
+    shared = True
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl=None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+    def after_fork(self):
+        pass
+
+
+class MemoryBackend(object):
+    """An in-process LRU cache, where every entry also has a time-to-live."""
+
+    shared = False
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def after_fork(self):
+        # The lock may have been held by another thread of the parent process
+        self._lock = threading.Lock()
+
+
+class SQLiteBackend(object):
+    """
+    A cache stored in a SQLite file, shared by every process that opens it.
+    Expired entries are removed when they are read, and every so often when
+    new ones are written.
+    """
+
+    shared = True
+
+    def __init__(self, path, purge_every=1000):
+        self.path = path
+        self.purge_every = purge_every
+        self._connections = LocalConnections(path)
+        self._writes = 0
+        self._execute(
+            "CREATE TABLE IF NOT EXISTS cache "
+            "(key TEXT PRIMARY KEY, value TEXT, expires REAL)"
+        )
+
+    def _execute(self, sql, parameters=()):
+        return self._connections.get().execute(sql, parameters)
+
+    def get(self, key):
+        row = self._execute(
+            "SELECT value, expires FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        value, expires = row
+        if expires is not None and expires < time.time():
+            self._execute("DELETE FROM cache WHERE key = ?", (key,))
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        self._execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+            (key, value, expires),
+        )
+        self._writes += 1
+        if self._writes % self.purge_every == 0:
+            self._execute("DELETE FROM cache WHERE expires < ?", (time.time(),))
+
+    def delete(self, key):
+        self._execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def clear(self):
+        self._execute("DELETE FROM cache")
+
+    def after_fork(self):
+        self._connections.after_fork()
+
+
+class ResponseCache(object):
+    def __init__(self, app=None):
+        self.backend = NullBackend()
+        self.ttl = None
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("RESPONSE_CACHE_BACKEND", "memory")
+        app.config.setdefault("RESPONSE_CACHE_TTL", 300)
+        app.config.setdefault("RESPONSE_CACHE_SIZE", 1024)
+        app.config.setdefault("RESPONSE_CACHE_PATH", "cache.db")
+        app.extensions["response_cache"] = self
+
+        self.ttl = app.config["RESPONSE_CACHE_TTL"]
+        backend = app.config["RESPONSE_CACHE_BACKEND"]
+        if backend == "memory":
+            self.backend = MemoryBackend(app.config["RESPONSE_CACHE_SIZE"])
+        elif backend == "sqlite":
+            self.backend = SQLiteBackend(app.config["RESPONSE_CACHE_PATH"])
+        elif backend == "null":
+            self.backend = NullBackend()
+        else:
+            raise ValueError("Unknown RESPONSE_CACHE_BACKEND %r" % backend)
+
+    @property
+    def enabled(self):
+        """Whether anything is stored at all."""
+        return not isinstance(self.backend, NullBackend)
+
+    def generation(self, namespace):
+        """
+        Return the current generation token of `namespace`. The token changes
+        whenever the namespace is invalidated, and with a private backend, at
+        least every `RESPONSE_CACHE_TTL` seconds. The null backend has nothing
+        to invalidate, and always returns the same token.
+        """
+        if not self.enabled:
+            return "null"
+        key = "generation:" + namespace
+        generation = self.backend.get(key)
+        if generation is None:
+            generation = self._new_generation(namespace)
+        return generation
+
+    def _new_generation(self, namespace):
+        generation = uuid.uuid4().hex
+        ttl = None if self.backend.shared else self.ttl
+        self.backend.set("generation:" + namespace, generation, ttl)
+        return generation
+
+    def cached(self, namespace, key, create):
+        """
+        Return the value cached under `key` in `namespace`. If there is none,
+        call `create()` to make it, and cache the result.
+        """
+        # The generation is read once, so that if the namespace is invalidated
+        # while `create()` runs, the possibly stale value is stored under the
+        # old generation, where nobody will find it.
+        full_key = "%s:%s:%s" % (namespace, self.generation(namespace), key)
+        value = self.backend.get(full_key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        value = create()
+        self.backend.set(full_key, value, self.ttl)
+        return value
+
+    def invalidate(self, namespace):
+        """Drop every entry in `namespace`."""
+        self._new_generation(namespace)
+
+    def clear(self):
+        self.backend.clear()
+
+    def after_fork(self):
+        self.backend.after_fork()
+
+    def stats(self):
+        """Return the hit and miss counts of this process."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,162 @@
+"""
+Custom commands for the `flask` command-line tool. Each group of commands is
+registered on `app.cli` by `register()`, and is run as, for example, `flask
+timeline rebuild`.
+"""
+
+import click
+from flask.cli import AppGroup
+
+from app import db, mail_queue
+from app import recommendations as suggestions
+from app import seed
+from app import timeline as timelines
+from app.models import Post, reconcile_counters
+
+
+@click.group(cls=AppGroup)
+def timeline():
+    """Materialized home timeline commands."""
+    pass
+
+
+@timeline.command()
+def rebuild():
+    """Regenerate all home timelines from the followers and post tables."""
+    count = timelines.rebuild()
+    db.session.commit()
+    click.echo("Wrote {} timeline entries.".format(count))
+
+
+@click.group(cls=AppGroup)
+def recommendations():
+    """Commands for the "who to follow" suggestions."""
+    pass
+
+
+@recommendations.command("rebuild")
+def rebuild_recommendations():
+    """Score every user from the followers graph. Meant to run on a schedule."""
+    count = suggestions.rebuild()
+    db.session.commit()
+    click.echo("Wrote {} suggestions.".format(count))
+
+
+@click.group(cls=AppGroup)
+def counters():
+    """Denormalized user counter commands."""
+    pass
+
+
+@counters.command()
+def reconcile():
+    """Recompute the follower, following and post counts of every user."""
+    reconcile_counters()
+    db.session.commit()
+    click.echo("Counters reconciled.")
+
+
+@click.group(cls=AppGroup)
+def mail():
+    """Outbound mail queue commands."""
+    pass
+
+
+@mail.command()
+def status():
+    """Show the number of queued and failed messages."""
+    click.echo("Queued: {}".format(mail_queue.depth()))
+    click.echo("Failed: {}".format(mail_queue.failed()))
+
+
+@mail.command()
+def drain():
+    """Send every message that is due, without waiting for the workers."""
+    click.echo("Sent {} messages.".format(mail_queue.drain()))
+
+
+@click.group(cls=AppGroup)
+def search():
+    """Full-text search commands."""
+    pass
+
+
+@search.command()
+def reindex():
+    """Rebuild the search index from the posts in the database."""
+    click.echo("Indexed {} posts.".format(Post.reindex()))
+
+
+@click.group(cls=AppGroup)
+def data():
+    """Bulk data loading commands."""
+    pass
+
+
+@data.command("import")
+@click.option("--users", type=click.Path(exists=True), help="CSV or JSONL file.")
+@click.option("--posts", type=click.Path(exists=True), help="CSV or JSONL file.")
+@click.option("--followers", type=click.Path(exists=True), help="CSV or JSONL file.")
+@click.option("--chunk-size", default=5000, help="Rows per INSERT.")
+@click.option("--hash-workers", default=0, help="Processes that hash plain passwords.")
+@click.option("--defer-indexes", is_flag=True, help="Build the indexes after loading.")
+def import_(users, posts, followers, chunk_size, hash_workers, defer_indexes):
+    """
+    Load users, posts and follower edges from files. Users have `username`,
+    `email`, and `password` or `password_hash`; posts have `body`, `timestamp`,
+    and `user_id` or `username`; edges have `follower_id` and `followed_id`, or
+    `follower` and `followed` usernames.
+    """
+    counts = seed.import_files(
+        users, posts, followers, chunk_size, hash_workers, defer_indexes
+    )
+    seed.finish()
+    click.echo(
+        "Imported {users} users, {posts} posts and {followers} followers.".format(
+            **counts
+        )
+    )
+
+
+@data.command()
+@click.option("--users", default=1000, help="Number of users.")
+@click.option("--posts", default=10000, help="Number of posts.")
+@click.option("--mean-follows", default=20, help="Mean users followed per user.")
+@click.option("--exponent", default=1.0, help="Zipf exponent of popularity.")
+@click.option("--password", default="password", help="Password of every user.")
+@click.option("--chunk-size", default=5000, help="Rows per INSERT.")
+@click.option("--defer-indexes", is_flag=True, help="Build the indexes after loading.")
+@click.option("--seed", "random_seed", type=int, help="Seed for repeatable data.")
+def generate(
+    users,
+    posts,
+    mean_follows,
+    exponent,
+    password,
+    chunk_size,
+    defer_indexes,
+    random_seed,
+):
+    """Generate a synthetic social graph with power-law follower counts."""
+    counts = seed.generate(
+        users,
+        posts,
+        mean_follows=mean_follows,
+        exponent=exponent,
+        password=password,
+        chunk_size=chunk_size,
+        defer=defer_indexes,
+        seed=random_seed,
+    )
+    seed.finish()
+    click.echo(
+        "Generated {users} users, {posts} posts and {followers} followers.".format(
+            **counts
+        )
+    )
+
+
+def register(app):
+    """Add the command groups to the `flask` command of `app`."""
+    for group in (timeline, recommendations, counters, mail, search, data):
+        app.cli.add_command(group)
@@ -0,0 +1,94 @@
+"""
+Conditional GET support for the feed and profile pages.
+
+Browsers and proxies that poll a page send back the `ETag` and
+`Last-Modified` values of the copy they already have, in `If-None-Match` and
+`If-Modified-Since` headers. The `conditional` decorator computes those values
+for the current state of the page from a few cheap queries, *before* the view
+runs, and answers with an empty 304 Not Modified response when nothing has
+changed. The heavy feed query and the template rendering are skipped entirely.
+
+The ETag covers everything shown on the page. `Last-Modified` only tracks the
+newest post, so it is only used when the client doesn't send an ETag.
+
+The cached post lists are vouched for by the generation of their cache
+namespace, which is part of the ETag. With the "memory" response cache, each
+process has its own generations, which expire with the entries, so its ETags
+only match the copies that it would serve anyway, and a client that reaches
+another process gets the whole page. The newest post says nothing about such a
+copy, so `If-Modified-Since` is only answered with a shared cache.
+"""
+
+import hashlib
+from datetime import timezone
+from functools import wraps
+from time import time
+
+from flask import current_app, make_response, request, session
+from flask_babel import get_locale
+from flask_login import current_user
+
+
+def _etag(parts):
+    # Forms on the page embed a CSRF token that expires, so a cached copy must
+    # not be reused for longer than half of the token's lifetime.
+    limit = current_app.config.get("WTF_CSRF_TIME_LIMIT", 3600)
+    csrf_period = int(time() // (limit / 2)) if limit else 0
+
+    parts = [current_user.get_id(), get_locale(), csrf_period] + list(parts)
+    raw = "|".join(str(part) for part in parts).encode("utf-8")
+    return hashlib.sha1(raw).hexdigest()
+
+
+def conditional(validator):
+    """
+    Decorator for views that can answer a conditional GET request. The
+    `validator` function is called with the arguments of the view, and
+    returns a list of values that change whenever the page does, along with
+    the time of the last change to the page (or None).
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+
+            # Pages that are about to show a flashed message are always sent
+            if request.method != "GET" or session.get("_flashes"):
+                return view(*args, **kwargs)
+
+            parts, last_modified = validator(*args, **kwargs)
+            etag = _etag(parts)
+            if last_modified is not None:
+                last_modified = last_modified.replace(
+                    microsecond=0, tzinfo=timezone.utc
+                )
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains(etag)
+            elif (
+                request.if_modified_since
+                and last_modified is not None
+                and current_app.extensions["response_cache"].backend.shared
+            ):
+                not_modified = last_modified <= request.if_modified_since
+            else:
+                not_modified = False
+
+            if not_modified:
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+
+            # The page depends on who is logged in, so shared caches must not
+            # store it, and browsers must check back before reusing it.
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+
+        return wrapper
+
+    return decorator
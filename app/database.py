@@ -0,0 +1,172 @@
+"""
+Database engine settings, and routing of reads to a replica.
+
+`Database` is the Flask-SQLAlchemy extension, with two additions:
+
+ - The connection pool is configured from `DATABASE_POOL_SIZE`,
+   `DATABASE_MAX_OVERFLOW`, `DATABASE_POOL_TIMEOUT`, `DATABASE_POOL_RECYCLE`
+   and `DATABASE_POOL_PRE_PING`. Every new SQLite connection is set up with
+   the `SQLITE_*` PRAGMAs. In WAL mode readers no longer block the writer,
+   and with a busy timeout a writer waits for the lock instead of failing with
+   "database is locked".
+ - With `DATABASE_REPLICA_URI` set, the queries of views decorated with
+   `use_replica` go to the replica. Keeping the replica up to date is left to
+   the database (or, for SQLite, to a tool like Litestream). Everything else,
+   including every write, goes to the primary. So does every read made after
+   the session wrote something, and, for `DATABASE_REPLICA_STICKY` seconds
+   after a request wrote something, every read made for the same client, so
+   that users see their own changes even while the replica lags behind.
+   Reads made within `use_primary()` go to the primary in any case.
+"""
+
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import current_app, has_request_context, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy, get_state
+from sqlalchemy import event, orm
+from sqlalchemy.pool import QueuePool
+
+# The key of the `SQLALCHEMY_BINDS` entry for the replica
+REPLICA = "replica"
+
+
+def _set_pragmas(pragmas):
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute("PRAGMA %s=%s" % (name, value))
+        cursor.close()
+
+    return connect
+
+
+class RoutingSession(SignallingSession):
+    """
+    A session that sends SELECT statements to the replica, once
+    `use_replica()` was called, unless it has written anything.
+    """
+
+    def __init__(self, db, **options):
+        self.replica = False
+        self.wrote = False
+        super().__init__(db, **options)
+
+    def use_replica(self):
+        """Send the reads of this session to the replica, if there is one."""
+        self.replica = REPLICA in (self.app.config["SQLALCHEMY_BINDS"] or ())
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or getattr(clause, "is_dml", False):
+            self.wrote = True
+        elif self.replica and not self.wrote and getattr(clause, "is_select", False):
+            return get_state(self.app).db.get_engine(self.app, bind=REPLICA)
+        return super().get_bind(mapper, clause)
+
+
+def _stick_to_primary(db_session):
+    config = db_session.app.config
+    if (
+        db_session.wrote
+        and config["DATABASE_REPLICA_STICKY"]
+        and REPLICA in (config["SQLALCHEMY_BINDS"] or ())
+        and has_request_context()
+    ):
+        session["_primary_until"] = time.time() + config["DATABASE_REPLICA_STICKY"]
+
+
+class Database(SQLAlchemy):
+    def init_app(self, app):
+        app.config.setdefault("DATABASE_POOL_SIZE", 0)
+        app.config.setdefault("DATABASE_MAX_OVERFLOW", 10)
+        app.config.setdefault("DATABASE_POOL_TIMEOUT", 30)
+        app.config.setdefault("DATABASE_POOL_RECYCLE", -1)
+        app.config.setdefault("DATABASE_POOL_PRE_PING", False)
+        app.config.setdefault("DATABASE_REPLICA_URI", None)
+        app.config.setdefault("DATABASE_REPLICA_STICKY", 5)
+        app.config.setdefault("SQLITE_JOURNAL_MODE", "WAL")
+        app.config.setdefault("SQLITE_SYNCHRONOUS", "NORMAL")
+        app.config.setdefault("SQLITE_BUSY_TIMEOUT", 5000)
+        app.config.setdefault("SQLITE_CACHE_SIZE", -16000)
+        app.config.setdefault("SQLITE_MMAP_SIZE", 0)
+        super().init_app(app)
+
+        if app.config["DATABASE_REPLICA_URI"]:
+            binds = dict(app.config["SQLALCHEMY_BINDS"] or {})
+            binds[REPLICA] = app.config["DATABASE_REPLICA_URI"]
+            app.config["SQLALCHEMY_BINDS"] = binds
+
+    def create_session(self, options):
+        factory = orm.sessionmaker(class_=RoutingSession, db=self, **options)
+        event.listen(factory, "after_commit", _stick_to_primary)
+        return factory
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        config = app.config
+        sqlite = sa_url.drivername.startswith("sqlite")
+        in_memory = sqlite and sa_url.database in (None, "", ":memory:")
+
+        # Without a pool size, SQLite files get a new connection every time
+        if config["DATABASE_POOL_SIZE"] and not in_memory:
+            if sqlite:
+                options["poolclass"] = QueuePool
+            options["pool_size"] = config["DATABASE_POOL_SIZE"]
+            options["max_overflow"] = config["DATABASE_MAX_OVERFLOW"]
+            options["pool_timeout"] = config["DATABASE_POOL_TIMEOUT"]
+        options["pool_recycle"] = config["DATABASE_POOL_RECYCLE"]
+        options["pool_pre_ping"] = config["DATABASE_POOL_PRE_PING"]
+
+        sa_url, options = super().apply_driver_hacks(app, sa_url, options)
+        if sqlite:
+            # Taken back out by `create_engine()`, which has no `app`
+            options["sqlite_pragmas"] = [
+                ("busy_timeout", config["SQLITE_BUSY_TIMEOUT"]),
+                ("journal_mode", config["SQLITE_JOURNAL_MODE"]),
+                ("synchronous", config["SQLITE_SYNCHRONOUS"]),
+                ("cache_size", config["SQLITE_CACHE_SIZE"]),
+                ("mmap_size", config["SQLITE_MMAP_SIZE"]),
+            ]
+        return sa_url, options
+
+    def create_engine(self, sa_url, engine_opts):
+        pragmas = engine_opts.pop("sqlite_pragmas", None)
+        engine = super().create_engine(sa_url, engine_opts)
+        if pragmas:
+            event.listen(engine, "connect", _set_pragmas(pragmas))
+        return engine
+
+
+def use_replica(view):
+    """
+    Decorator for views that only read, and can show data that is a few
+    seconds old. Their GET requests read from the replica, unless the client
+    wrote something within the last `DATABASE_REPLICA_STICKY` seconds.
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method in ("GET", "HEAD"):
+            primary_until = session.get("_primary_until")
+            if primary_until is not None and primary_until <= time.time():
+                del session["_primary_until"]
+                primary_until = None
+            if primary_until is None:
+                current_app.extensions["sqlalchemy"].db.session().use_replica()
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+@contextmanager
+def use_primary():
+    """
+    Send the reads made within the block to the primary, even in a view
+    decorated with `use_replica`.
+    """
+    db_session = current_app.extensions["sqlalchemy"].db.session()
+    replica, db_session.replica = db_session.replica, False
+    try:
+        yield
+    finally:
+        db_session.replica = replica
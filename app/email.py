@@ -1,30 +1,11 @@
-from threading import Thread
+"""
+Sends email through the durable queue in `app/mail_queue.py`, so that a
+request never waits on the mail server.
+"""
 
-from flask import render_template
-from flask_mail import Message
-
-from app import app, mail
-
-
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+from app import mail_queue
 
 
 def send_email(subject, sender, recipients, text_body, html_body):
-    """Send email with named properties."""
-    msg = Message(subject, sender=sender, recipients=recipients)
-    msg.body = text_body
-    msg.html = html_body
-    Thread(target=send_async_email, args=(app, msg)).start()
-
-
-def send_password_reset_email(user):
-    token = user.get_reset_password_token()
-    send_email(
-        "[Microblog] Reset Your Password",
-        sender=app.config["ADMINS"][0],
-        recipients=[user.email],
-        text_body=render_template("email/reset_password.txt", user=user, token=token),
-        html_body=render_template("email/reset_password.html", user=user, token=token),
-    )
+    """Queue an email with named properties to be sent in the background."""
+    mail_queue.enqueue(subject, sender, recipients, text_body, html_body)
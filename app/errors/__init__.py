@@ -0,0 +1,9 @@
+"""
+Error pages, which are answered in JSON for requests to the API.
+"""
+
+from flask import Blueprint
+
+bp = Blueprint("errors", __name__)
+
+from app.errors import handlers
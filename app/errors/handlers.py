@@ -0,0 +1,32 @@
+from flask import make_response, render_template
+
+from app import db
+from app.api.errors import error_response, wants_json_response
+from app.errors import bp
+from app.passwords import PasswordHashingBusy
+
+
+@bp.app_errorhandler(404)
+def not_found(error):
+    if wants_json_response():
+        return error_response(404)
+    return render_template("404.html"), 404
+
+
+@bp.app_errorhandler(500)
+def interval_error(error):
+    db.session.rollback()
+    if wants_json_response():
+        return error_response(500)
+    return render_template("500.html"), 500
+
+
+@bp.app_errorhandler(PasswordHashingBusy)
+def password_hashing_busy(error):
+    db.session.rollback()
+    if wants_json_response():
+        response = error_response(503)
+    else:
+        response = make_response(render_template("503.html"), 503)
+    response.headers["Retry-After"] = "5"
+    return response
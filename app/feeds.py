@@ -0,0 +1,79 @@
+"""
+Rendering and caching of post lists, shared by the pages in `app/main` and the
+JSON API in `app/api`.
+"""
+
+from flask import render_template, request, url_for
+from flask_babel import get_locale
+
+from app import cache, fragments
+from app.database import use_primary
+
+
+def render_feed(posts, endpoint, **values):
+    """
+    Render a page of posts, along with links to the newer and older pages of
+    the view `endpoint`, and return the HTML.
+    """
+
+    # Establish URL for next page, if one exists
+    if posts.has_next:
+        next_url = url_for(endpoint, before=posts.next_cursor, **values)
+    else:
+        next_url = None
+
+    # Establish URL for previos page, if one exists
+    if posts.has_prev:
+        prev_url = url_for(endpoint, after=posts.prev_cursor, **values)
+    else:
+        prev_url = None
+
+    return render_template(
+        "_feed.html",
+        posts=render_posts(posts.items),
+        next_url=next_url,
+        prev_url=prev_url,
+    )
+
+
+def render_posts(posts):
+    """Return the HTML of `_post.html` for each of `posts`."""
+
+    # Each post is only rendered if its HTML isn't in the fragment cache. It
+    # depends on nothing but the post, its author's name and avatar, and the
+    # language.
+    locale = str(get_locale())
+    keys = [
+        (post.id, post.author.username, post.author.email_digest, locale)
+        for post in posts
+    ]
+    return fragments.render("_post.html", "post", posts, keys)
+
+
+def feed_cache_key():
+    """Return the key under which the post list of this request is cached."""
+    return "%s|%s" % (request.full_path, get_locale())
+
+
+def cached_feed(namespace, render):
+    """
+    Return the post list of this request from the cache of `namespace`, or
+    call `render()` to make it, and cache it.
+    """
+
+    # Every viewer gets the cached list, so it is read from the primary. A
+    # lagging replica would store the posts from before the change that
+    # invalidated the namespace, for everyone, until the entry expires.
+    def create():
+        if not cache.enabled:
+            return render()
+        with use_primary():
+            return render()
+
+    return cache.cached(namespace, feed_cache_key(), create)
+
+
+def invalidate_feeds(user):
+    """Drop the cached post lists that show posts by `user`."""
+    cache.invalidate("explore")
+    cache.invalidate("user:%d" % user.id)
@@ -0,0 +1,29 @@
+"""
+Request-scoped answers to "does the current user follow these users?".
+
+`User.is_following()` runs one query per call, so a page with a follow button
+for every author would run one query per row. `following()` instead answers
+for a whole list of users with a single query, via `User.followed_ids()`, and
+caches the answers on `g` for the rest of the request.
+"""
+
+from flask import g
+from flask_login import current_user
+
+
+def following(user_ids):
+    """Return the set of ids, out of `user_ids`, that the current user follows."""
+    cache = g.setdefault("following", {})
+    user_ids = set(user_ids)
+
+    missing = user_ids.difference(cache)
+    if missing:
+        found = current_user.followed_ids(missing)
+        cache.update((id, id in found) for id in missing)
+
+    return {id for id in user_ids if cache[id]}
+
+
+def is_following(user):
+    """Return True if the current user follows `user`."""
+    return user.id in following([user.id])
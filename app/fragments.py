@@ -0,0 +1,111 @@
+"""
+Cache for rendered fragments of templates.
+
+Every feed page renders `_post.html` once for each of its posts, although the
+HTML of a post only changes when its author changes their username or email
+address (and so their avatar). The relative time is filled in by moment.js in
+the browser. `FragmentCache` keeps the HTML of recently shown posts, keyed by
+everything it depends on, so a page only has to render the posts that aren't
+in it, and concatenate the rest.
+
+Since a change of username changes the key, there is nothing to invalidate:
+the old entries are no longer found, and are eventually evicted. The cache is
+a least-recently-used dictionary private to each server process, bounded by
+the size of the HTML it holds, `FRAGMENT_CACHE_SIZE` bytes.
+"""
+
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+from markupsafe import Markup
+
+
+class FragmentCache(object):
+    def __init__(self, app=None):
+        self.max_bytes = 0
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("FRAGMENT_CACHE_SIZE", 16 * 1024 * 1024)
+        app.extensions["fragment_cache"] = self
+        self.max_bytes = app.config["FRAGMENT_CACHE_SIZE"]
+        self.hits = self.misses = 0
+        self.clear()
+
+    def get_many(self, keys):
+        """Return the fragment cached under each of `keys`, or None."""
+        fragments = []
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    fragments.append(None)
+                    continue
+                self._entries.move_to_end(key)
+                fragments.append(entry[0])
+        found = len(fragments) - fragments.count(None)
+        self.hits += found
+        self.misses += len(fragments) - found
+        return fragments
+
+    def set(self, key, fragment):
+        size = len(fragment.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+            self._entries[key] = (fragment, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= evicted
+
+    def render(self, template_name, name, items, keys):
+        """
+        Return the HTML of the template `template_name` for each of `items`,
+        which the template sees as `name`. The fragments cached under `keys`
+        are used where there are any, and the others are rendered and cached.
+        Must be called with a request context.
+        """
+        fragments = self.get_many(keys)
+        template = None
+        for i, fragment in enumerate(fragments):
+            if fragment is not None:
+                continue
+            if template is None:
+                template = current_app.jinja_env.get_template(template_name)
+                context = {}
+                current_app.update_template_context(context)
+            context[name] = items[i]
+            fragments[i] = Markup(template.render(context))
+            self.set(keys[i], fragments[i])
+        return fragments
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def after_fork(self):
+        # The lock may have been held by another thread of the parent process
+        self._lock = threading.Lock()
+
+    def stats(self):
+        """Return the hit and miss counts of this process, and the size."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "bytes": self.size,
+        }
@@ -0,0 +1,166 @@
+"""
+Loading the logged in user without a query on every request.
+
+Flask-Login calls `load_user()` at the start of every request that uses
+`current_user`, which used to be one SELECT per page view. Two things make
+that cheaper:
+
+ - Users are cached in memory by id for `USER_CACHE_TTL` seconds, in an LRU of
+   at most `USER_CACHE_SIZE` entries. A cached user is merged into the session
+   without a query. Whenever a user is changed through the session (a profile
+   edit, a password change, a follow, a new post), its entry is dropped when
+   the change is flushed and again when it is committed, so it is reloaded on
+   the next request. `last_seen` is written behind the session's back, and can
+   be up to `USER_CACHE_TTL` seconds older in the cached copy.
+
+ - With `SESSION_IDENTITY` enabled, the id and username of the user are also
+   kept in the signed session cookie. GET requests get a read-only
+   `SessionUser` built from the cookie instead, and only load the full user if
+   the view asks for anything else. The copy in the cookie is refreshed after
+   `SESSION_IDENTITY_MAX_AGE` seconds, and whenever the user changes their
+   username.
+"""
+
+from itertools import chain
+from time import time
+
+from flask import current_app, request, session
+from flask_login import UserMixin, user_logged_in, user_logged_out
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+
+from app import db, login
+from app.cache import MemoryBackend
+from app.models import Post, User
+
+
+def _users():
+    """The user cache of the current app, which is created on first use."""
+    users = current_app.extensions.get("user_cache")
+    if users is None:
+        users = current_app.extensions.setdefault(
+            "user_cache", MemoryBackend(current_app.config["USER_CACHE_SIZE"])
+        )
+    return users
+
+
+def get_user(id):
+    """Return the user with `id` in the current session, or None."""
+    state = _users().get(id)
+    if state is not None:
+        # The cached copy is attached to the session as if it had just been
+        # loaded. If the user is already in the session, that copy is kept.
+        user = User.__mapper__.class_manager.new_instance()
+        for key, value in state.items():
+            set_committed_value(user, key, value)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    user = db.session.get(User, id)
+    ttl = current_app.config["USER_CACHE_TTL"]
+    if user is not None and ttl:
+        columns = inspect(User).column_attrs
+        _users().set(id, {c.key: getattr(user, c.key) for c in columns}, ttl)
+    return user
+
+
+def invalidate(id):
+    """Drop the cached copy of the user with `id`."""
+    _users().delete(id)
+
+
+def clear():
+    _users().clear()
+
+
+@event.listens_for(db.session, "after_flush")
+def _collect_changed_users(session, context):
+    changed = session.info.setdefault("changed_users", set())
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, User):
+            changed.add(obj.id)
+        elif isinstance(obj, Post):
+            # New posts change the author's `post_count`
+            changed.add(obj.user_id)
+    changed.discard(None)
+    for id in changed:
+        invalidate(id)
+
+
+@event.listens_for(db.session, "after_commit")
+def _invalidate_changed_users(session):
+    # Another request may have cached the old row between the flush and the
+    # commit, so the entries are dropped once more.
+    for id in session.info.pop("changed_users", ()):
+        invalidate(id)
+
+
+@event.listens_for(db.session, "after_soft_rollback")
+def _forget_changed_users(session, previous_transaction):
+    session.info.pop("changed_users", None)
+
+
+class SessionUser(UserMixin):
+    """
+    A read-only stand-in for the logged in user, built from the session. Any
+    attribute other than `id` and `username` is looked up on the full user,
+    which is loaded on first use.
+    """
+
+    def __init__(self, id, username):
+        self.__dict__.update(id=id, username=username, _user=None)
+
+    def __getattr__(self, name):
+        if self._user is None:
+            self.__dict__["_user"] = get_user(self.id)
+        return getattr(self._user, name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("The user of a GET request is read-only")
+
+    def __repr__(self):
+        return "<SessionUser %s>" % self.username
+
+
+def remember(user):
+    """Store the identity of `user` in the session, if it's out of date."""
+    if not current_app.config["SESSION_IDENTITY"]:
+        return
+    identity = session.get("_identity")
+    max_age = current_app.config["SESSION_IDENTITY_MAX_AGE"]
+    if (
+        identity is None
+        or identity[:2] != [user.id, user.username]
+        or time() - identity[2] >= max_age
+    ):
+        session["_identity"] = [user.id, user.username, time()]
+
+
+@user_logged_in.connect
+def _remember_logged_in_user(sender, user):
+    remember(user)
+
+
+@user_logged_out.connect
+def _forget_logged_out_user(sender, user):
+    session.pop("_identity", None)
+
+
+@login.user_loader
+def load_user(id):
+    """
+    The `user_loader` function keeps track of users that have logged into the
+    application.
+    """
+    id = int(id)
+    if current_app.config["SESSION_IDENTITY"] and request.method in ("GET", "HEAD"):
+        identity = session.get("_identity")
+        max_age = current_app.config["SESSION_IDENTITY_MAX_AGE"]
+        if identity and identity[0] == id and time() - identity[2] < max_age:
+            return SessionUser(id, identity[1])
+
+    user = get_user(id)
+    if user is not None:
+        remember(user)
+    return user
@@ -0,0 +1,334 @@
+"""
+Per-request SQL and timing instrumentation.
+
+`Instrumentation` records, for every request, its endpoint, the SQL statements
+it ran and the time spent in the database (from the SQLAlchemy engine events),
+and the time spent rendering templates (from Flask's template signals). That
+is then used in three ways:
+
+ - With `SERVER_TIMING` enabled, every response gets a `Server-Timing` header,
+   which browser developer tools show along with the request.
+ - Requests that take longer than `SLOW_REQUEST_THRESHOLD` milliseconds are
+   logged to the "app.slow" logger, along with the SQL of every statement
+   they ran. The bound values are never logged, since they include tokens and
+   password hashes.
+ - Counters for each endpoint are kept in memory, and with `METRICS_ENABLED`
+   they are served at `/metrics` in the Prometheus text format. The counters
+   are private to each server process, so each one should be scraped.
+
+Statements run outside of a request, like those of the `last_seen` and mail
+queue workers, are not counted.
+"""
+
+import logging
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from flask import (
+    Response,
+    abort,
+    before_render_template,
+    current_app,
+    g,
+    has_request_context,
+    request,
+    request_started,
+    template_rendered,
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds of the request duration histogram, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+slow_log = logging.getLogger("app.slow")
+
+
+class RequestStats(object):
+    """What one request has done so far."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.statements = []
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self._templates = []
+
+    @property
+    def queries(self):
+        return len(self.statements)
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+
+def current_stats():
+    """Return the `RequestStats` of the current request, or None."""
+    if not has_request_context():
+        return None
+    return g.get("_request_stats")
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    stats = current_stats()
+    if stats is not None:
+        stats.statements.append((statement, elapsed))
+        stats.db_time += elapsed
+
+
+def _handle_error(context):
+    # `after_cursor_execute` isn't sent for a statement that failed
+    starts = context.connection.info.get("query_start")
+    if starts:
+        starts.pop()
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+class Instrumentation(object):
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self.reset()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("SERVER_TIMING", False)
+        app.config.setdefault("SLOW_REQUEST_THRESHOLD", 500)
+        app.config.setdefault("METRICS_ENABLED", False)
+        app.extensions["instrumentation"] = self
+
+        # The listeners are attached to every engine, since Flask-SQLAlchemy
+        # creates its engines lazily, and again whenever the URI changes.
+        for name, listener in (
+            ("before_cursor_execute", _before_cursor_execute),
+            ("after_cursor_execute", _after_cursor_execute),
+            ("handle_error", _handle_error),
+        ):
+            if not event.contains(Engine, name, listener):
+                event.listen(Engine, name, listener)
+
+        request_started.connect(self._request_started, app)
+        before_render_template.connect(self._template_started, app)
+        template_rendered.connect(self._template_finished, app)
+
+        # This runs after every other `after_request` function that is
+        # registered later, so it sees the final response.
+        app.after_request(self._request_finished)
+        app.add_url_rule("/metrics", "metrics", self.metrics)
+
+    def reset(self):
+        """Set every counter back to zero."""
+        with self._lock:
+            self._requests = defaultdict(int)
+            self._buckets = defaultdict(lambda: [0] * (len(BUCKETS) + 1))
+            self._durations = defaultdict(float)
+            self._queries = defaultdict(int)
+            self._db_time = defaultdict(float)
+            self._template_time = defaultdict(float)
+            self._slow = defaultdict(int)
+
+    def _request_started(self, sender, **extra):
+        g._request_stats = RequestStats()
+
+    def _template_started(self, sender, template, context, **extra):
+        stats = current_stats()
+        if stats is not None:
+            stats._templates.append(time.perf_counter())
+
+    def _template_finished(self, sender, template, context, **extra):
+        stats = current_stats()
+        if stats is not None and stats._templates:
+            start = stats._templates.pop()
+
+            # Templates rendered while rendering another are already counted
+            if not stats._templates:
+                stats.template_time += time.perf_counter() - start
+
+    def _request_finished(self, response):
+        stats = current_stats()
+        if stats is None:
+            return response
+        elapsed = stats.elapsed()
+        endpoint = request.endpoint or "none"
+
+        if current_app.config["SERVER_TIMING"]:
+            response.headers.add(
+                "Server-Timing",
+                'db;dur=%.1f;desc="%d queries", tpl;dur=%.1f, app;dur=%.1f'
+                % (
+                    stats.db_time * 1000,
+                    stats.queries,
+                    stats.template_time * 1000,
+                    elapsed * 1000,
+                ),
+            )
+
+        threshold = current_app.config["SLOW_REQUEST_THRESHOLD"]
+        slow = bool(threshold) and elapsed * 1000 >= threshold
+        if slow:
+            self._log_slow(endpoint, elapsed, stats)
+
+        with self._lock:
+            self._requests[endpoint, request.method, response.status_code] += 1
+            self._buckets[endpoint][bisect_left(BUCKETS, elapsed)] += 1
+            self._durations[endpoint] += elapsed
+            self._queries[endpoint] += stats.queries
+            self._db_time[endpoint] += stats.db_time
+            self._template_time[endpoint] += stats.template_time
+            if slow:
+                self._slow[endpoint] += 1
+        return response
+
+    def _log_slow(self, endpoint, elapsed, stats):
+        lines = [
+            "Slow request: %s %s (%s) took %.1f ms, with %d queries in %.1f ms "
+            "and templates in %.1f ms"
+            % (
+                request.method,
+                request.full_path.rstrip("?"),
+                endpoint,
+                elapsed * 1000,
+                stats.queries,
+                stats.db_time * 1000,
+                stats.template_time * 1000,
+            )
+        ]
+        for statement, duration in stats.statements:
+            lines.append(
+                "  %8.1f ms  %s" % (duration * 1000, re.sub(r"\s+", " ", statement))
+            )
+        slow_log.warning("\n".join(lines))
+
+    def metrics(self):
+        """The `/metrics` view."""
+        if not current_app.config["METRICS_ENABLED"]:
+            abort(404)
+        return Response(self.render_metrics(), mimetype="text/plain; version=0.0.4")
+
+    def render_metrics(self):
+        """Return the counters in the Prometheus text format."""
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append("# HELP microblog_%s %s" % (name, help))
+            lines.append("# TYPE microblog_%s %s" % (name, kind))
+            for suffix, labels, value in samples:
+                labels = ",".join('%s="%s"' % (k, _label(v)) for k, v in labels)
+                lines.append(
+                    "microblog_%s%s%s %s"
+                    % (name, suffix, "{%s}" % labels if labels else "", value)
+                )
+
+        def per_endpoint(counters):
+            return [
+                ("", [("endpoint", endpoint)], value)
+                for endpoint, value in sorted(counters.items())
+            ]
+
+        with self._lock:
+            metric(
+                "requests_total",
+                "counter",
+                "Requests handled.",
+                [
+                    ("", [("endpoint", e), ("method", m), ("status", s)], value)
+                    for (e, m, s), value in sorted(self._requests.items())
+                ],
+            )
+
+            histogram = []
+            for endpoint, counts in sorted(self._buckets.items()):
+                total = 0
+                for bound, count in zip(BUCKETS + ("+Inf",), counts):
+                    total += count
+                    labels = [("endpoint", endpoint), ("le", bound)]
+                    histogram.append(("_bucket", labels, total))
+                labels = [("endpoint", endpoint)]
+                histogram.append(("_sum", labels, self._durations[endpoint]))
+                histogram.append(("_count", labels, total))
+            metric(
+                "request_duration_seconds",
+                "histogram",
+                "Time taken to handle requests.",
+                histogram,
+            )
+
+            metric(
+                "db_queries_total",
+                "counter",
+                "SQL statements run by requests.",
+                per_endpoint(self._queries),
+            )
+            metric(
+                "db_seconds_total",
+                "counter",
+                "Time requests spent running SQL statements.",
+                per_endpoint(self._db_time),
+            )
+            metric(
+                "template_seconds_total",
+                "counter",
+                "Time requests spent rendering templates.",
+                per_endpoint(self._template_time),
+            )
+            metric(
+                "slow_requests_total",
+                "counter",
+                "Requests slower than SLOW_REQUEST_THRESHOLD.",
+                per_endpoint(self._slow),
+            )
+
+        response_cache = current_app.extensions.get("response_cache")
+        if response_cache is not None:
+            metric(
+                "response_cache_lookups_total",
+                "counter",
+                "Response cache lookups.",
+                [
+                    ("", [("result", "hit")], response_cache.hits),
+                    ("", [("result", "miss")], response_cache.misses),
+                ],
+            )
+
+        fragment_cache = current_app.extensions.get("fragment_cache")
+        if fragment_cache is not None:
+            metric(
+                "fragment_cache_lookups_total",
+                "counter",
+                "Fragment cache lookups.",
+                [
+                    ("", [("result", "hit")], fragment_cache.hits),
+                    ("", [("result", "miss")], fragment_cache.misses),
+                ],
+            )
+            metric(
+                "fragment_cache_bytes",
+                "gauge",
+                "Size of the HTML in the fragment cache.",
+                [("", [], fragment_cache.size)],
+            )
+
+        mail_queue = current_app.extensions.get("mail_queue")
+        if mail_queue is not None:
+            metric(
+                "mail_queue_messages",
+                "gauge",
+                "Messages in the outbound mail queue.",
+                [
+                    ("", [("state", "queued")], mail_queue.depth()),
+                    ("", [("state", "failed")], mail_queue.failed()),
+                ],
+            )
+
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,149 @@
+"""
+Write-behind tracking of `User.last_seen`.
+
+Setting `last_seen` and committing on every request costs one write
+transaction per page view, and with SQLite every one of those serializes the
+whole site behind the database write lock. Instead, `LastSeenTracker` keeps
+the latest time each user was seen in memory, and writes them all at once with
+a single executemany UPDATE. A user that was already recorded within the last
+`LAST_SEEN_WINDOW` seconds is skipped altogether.
+
+Pending updates are flushed every `LAST_SEEN_FLUSH_INTERVAL` seconds from a
+background thread, as soon as `LAST_SEEN_BATCH_SIZE` users are pending, and
+when the process exits.
+"""
+
+import atexit
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam
+
+
+class LastSeenTracker(object):
+    def __init__(self, app=None, db=None):
+        self.app = None
+        self.db = db
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._recorded = {}
+        self._timer = None
+
+        # Don't lose whatever is still pending when the server shuts down.
+        atexit.register(self._flush_at_exit)
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db=None):
+        if db is not None:
+            self.db = db
+        self.app = app
+        app.config.setdefault("LAST_SEEN_WINDOW", 60)
+        app.config.setdefault("LAST_SEEN_FLUSH_INTERVAL", 30)
+        app.config.setdefault("LAST_SEEN_BATCH_SIZE", 500)
+        app.extensions["last_seen"] = self
+
+        # Updates recorded for an application that came before this one (as
+        # when the tests create one for every case) are for its database.
+        with self._lock:
+            self._pending = {}
+            self._recorded = {}
+
+    def after_fork(self):
+        """
+        Start over in a forked process. The flusher thread isn't copied into
+        the child, and whatever is pending is written by the parent.
+        """
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._timer = None
+
+    def touch(self, user_id, now=None):
+        """
+        Record that the user with id `user_id` was seen at `now`. Returns False
+        if the user was already recorded within the window.
+        """
+        now = now or datetime.utcnow()
+        window = timedelta(seconds=self.app.config["LAST_SEEN_WINDOW"])
+
+        with self._lock:
+            recorded = self._recorded.get(user_id)
+            if recorded is not None and now - recorded < window:
+                return False
+            self._recorded[user_id] = now
+            self._pending[user_id] = now
+            full = len(self._pending) >= self.app.config["LAST_SEEN_BATCH_SIZE"]
+
+        if full:
+            # The updates are kept for the next flush, so a database that is
+            # busy or down doesn't fail the request that filled the batch
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception("Failed to flush last_seen updates")
+        else:
+            self._start_timer()
+        return True
+
+    def flush(self):
+        """Write all pending updates, and return how many were written."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+            # Entries older than the window can't cause a skip any more.
+            cutoff = datetime.utcnow() - timedelta(
+                seconds=self.app.config["LAST_SEEN_WINDOW"]
+            )
+            self._recorded = {
+                id: seen for id, seen in self._recorded.items() if seen >= cutoff
+            }
+
+        if not pending:
+            return 0
+
+        users = self.db.metadata.tables["user"]
+        update = (
+            users.update()
+            .where(users.c.id == bindparam("_id"))
+            .values(last_seen=bindparam("_seen"))
+        )
+        rows = [{"_id": id, "_seen": seen} for id, seen in pending.items()]
+
+        try:
+            with self.db.get_engine(self.app).begin() as connection:
+                connection.execute(update, rows)
+        except Exception:
+            # Put the updates back, unless something newer arrived meanwhile.
+            with self._lock:
+                for id, seen in pending.items():
+                    self._pending.setdefault(id, seen)
+            raise
+        return len(rows)
+
+    def _flush_at_exit(self):
+        if not self._pending:
+            return
+        try:
+            self.flush()
+        except Exception:
+            self.app.logger.exception("Failed to flush last_seen updates")
+
+    def _start_timer(self):
+        interval = self.app.config["LAST_SEEN_FLUSH_INTERVAL"]
+        if self._timer is not None or not interval:
+            return
+        with self._lock:
+            if self._timer is None:
+                self._timer = threading.Thread(
+                    target=self._run, args=(interval,), daemon=True
+                )
+                self._timer.start()
+
+    def _run(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception("Failed to flush last_seen updates")
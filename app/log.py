@@ -0,0 +1,284 @@
+"""
+Logging that never makes a request wait.
+
+`QueueLogging` gives `app.logger` a single `QueueHandler`, which only puts
+each record on an in-memory queue. A `QueueListener` thread takes them off the
+queue and passes them on to the handlers that do the slow work:
+
+ - a `RotatingFileHandler`, which starts a new file every `LOG_MAX_BYTES`
+   bytes, and writes either plain text or, with `LOG_JSON`, one JSON object
+   per line
+ - if a mail server is configured, a `DigestHandler` that emails errors to
+   the admins. During an incident the same error can be logged thousands of
+   times, so errors are grouped by where they were logged, and sent at most
+   once every `LOG_MAIL_INTERVAL` seconds, as a digest of each distinct error
+   and how many times it happened.
+
+If the queue ever holds `LOG_QUEUE_SIZE` records, new ones are dropped rather
+than blocking the request. A forked worker gets a queue and a listener of its
+own, since the listener thread of the parent isn't copied into it.
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from logging.handlers import (
+    QueueHandler,
+    QueueListener,
+    RotatingFileHandler,
+    SMTPHandler,
+)
+
+from flask import has_request_context, request
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]"
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """A `QueueHandler` that drops records when the queue is full."""
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # The record is handled in another thread, so everything that can't be
+        # pickled or that depends on the request is resolved now. Unlike the
+        # default, the traceback is kept apart from the message.
+        record = logging.makeLogRecord(record.__dict__)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        if has_request_context():
+            record.request = {
+                "method": request.method,
+                "path": request.full_path.rstrip("?"),
+                "remote_addr": request.remote_addr,
+            }
+        return record
+
+
+class JSONFormatter(logging.Formatter):
+    """Format each record as a JSON object on one line."""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "path": record.pathname,
+            "line": record.lineno,
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        if getattr(record, "request", None):
+            entry["request"] = record.request
+        return json.dumps(entry, default=str)
+
+
+class DigestHandler(logging.Handler):
+    """
+    Collect records, and pass them on to `target` as one digest record at most
+    once every `interval` seconds. Records logged from the same place are
+    counted, and only the first one is included in full.
+    """
+
+    def __init__(self, target, interval=300):
+        super().__init__()
+        self.target = target
+        self.interval = interval
+        self._pending = OrderedDict()
+        self._last_sent = None
+        self._timer = None
+
+    def emit(self, record):
+        key = (record.name, record.levelno, record.pathname, record.lineno)
+        with self.lock:
+            entry = self._pending.get(key)
+            if entry is None:
+                self._pending[key] = [record, 1]
+            else:
+                entry[1] += 1
+            due = (
+                self._last_sent is None
+                or time.monotonic() - self._last_sent >= self.interval
+            )
+            if not due and self._timer is None:
+                delay = self._last_sent + self.interval - time.monotonic()
+                self._timer = threading.Timer(delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self._pending = self._pending, OrderedDict()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not pending:
+                return
+            self._last_sent = time.monotonic()
+
+        total = sum(count for record, count in pending.values())
+        sections = [
+            "%d errors, %d distinct, since %s UTC"
+            % (
+                total,
+                len(pending),
+                datetime.utcfromtimestamp(
+                    min(record.created for record, count in pending.values())
+                ).strftime("%Y-%m-%d %H:%M:%S"),
+            )
+        ]
+        for record, count in pending.values():
+            sections.append("%d times:\n%s" % (count, self.format(record)))
+
+        first = next(iter(pending.values()))[0]
+        digest = logging.makeLogRecord(
+            {
+                "name": first.name,
+                "levelno": first.levelno,
+                "levelname": first.levelname,
+                "msg": "\n\n".join(sections),
+            }
+        )
+        self.target.handle(digest)
+
+    def close(self):
+        self.flush()
+        self.target.close()
+        super().close()
+
+    def after_fork(self):
+        # The timer isn't copied into a forked process, and the pending
+        # records are sent by the parent
+        self._pending = OrderedDict()
+        self._timer = None
+
+
+class QueueLogging(object):
+    def __init__(self, app=None):
+        self.handler = None
+        self.listener = None
+        self._handlers = []
+        self._logger = None
+
+        # Write out whatever is still queued, and send the last digest, when
+        # the process exits.
+        atexit.register(self.stop)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Send the records of `app.logger` through a queue to the file and mail
+        handlers.
+        """
+        # Every application created by `create_app()` logs to the same logger,
+        # so the handlers of an earlier one are replaced, not added to.
+        self.stop()
+        app.extensions["queue_logging"] = self
+
+        formatter = (
+            JSONFormatter()
+            if app.config["LOG_JSON"]
+            else logging.Formatter(TEXT_FORMAT)
+        )
+        handlers = []
+
+        if app.config["MAIL_SERVER"]:
+            auth = None
+            if app.config["MAIL_USERNAME"] or app.config["MAIL_PASSWORD"]:
+                auth = (app.config["MAIL_USERNAME"], app.config["MAIL_PASSWORD"])
+
+            secure = None
+            if app.config["MAIL_USE_TLS"]:
+                secure = ()
+
+            mail_handler = DigestHandler(
+                SMTPHandler(
+                    mailhost=(app.config["MAIL_SERVER"], app.config["MAIL_PORT"]),
+                    fromaddr="no-reply@" + app.config["MAIL_SERVER"],
+                    toaddrs=app.config["ADMINS"],
+                    subject="Microblog Failure",
+                    credentials=auth,
+                    secure=secure,
+                ),
+                interval=app.config["LOG_MAIL_INTERVAL"],
+            )
+            mail_handler.setLevel(logging.ERROR)
+            mail_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+            handlers.append(mail_handler)
+
+        directory = os.path.dirname(app.config["LOG_PATH"])
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        # The RotatingFileHandler class creates a new log file whenever the
+        # log file exceeds the `maxBytes` limit. Additionally, `backupCount`
+        # denotes how many log files are backed up.
+        file_handler = RotatingFileHandler(
+            app.config["LOG_PATH"],
+            maxBytes=app.config["LOG_MAX_BYTES"],
+            backupCount=app.config["LOG_BACKUP_COUNT"],
+        )
+        file_handler.setFormatter(formatter)
+        file_handler.setLevel(logging.INFO)
+        handlers.append(file_handler)
+
+        self._handlers = handlers
+        self._logger = app.logger
+        self.handler = NonBlockingQueueHandler(
+            queue.Queue(app.config["LOG_QUEUE_SIZE"])
+        )
+        app.logger.addHandler(self.handler)
+        self._start()
+
+    def _start(self):
+        self.listener = QueueListener(
+            self.handler.queue, *self._handlers, respect_handler_level=True
+        )
+        self.listener.start()
+
+    def stop(self):
+        """Write out the queued records, and close the handlers."""
+        if self.listener is None:
+            return
+        self.listener.stop()
+        self.listener = None
+        for handler in self._handlers:
+            handler.close()
+        self._logger.removeHandler(self.handler)
+
+    def after_fork(self):
+        """
+        Start over in a forked process, where nothing would take the records
+        off the queue. Whatever the parent had queued is written by the parent.
+        """
+        if self.listener is None:
+            return
+        for handler in self._handlers:
+            if isinstance(handler, DigestHandler):
+                handler.after_fork()
+        self.handler.queue = queue.Queue(self.handler.queue.maxsize)
+        self._start()
@@ -0,0 +1,239 @@
+"""
+A durable queue for outbound email.
+
+Messages are stored in the `outbound_mail` table instead of being sent from a
+new thread per message, so a burst of emails can't spawn hundreds of threads,
+and nothing is lost when the server restarts. A fixed pool of
+`MAIL_QUEUE_WORKERS` threads drains the table, from the first request the
+server handles. Each worker claims up to `MAIL_QUEUE_BATCH_SIZE` due messages
+at a time and sends them all through one SMTP connection, which stays open for
+as long as there are messages to send.
+
+A message that fails to send is retried with exponential backoff, starting at
+`MAIL_QUEUE_BACKOFF` seconds, until it has been tried `MAIL_QUEUE_MAX_ATTEMPTS`
+times. After that it is kept in the table, but not tried again.
+
+To try this out locally, run a debugging SMTP server and point `MAIL_SERVER`
+and `MAIL_PORT` at it, e.g. `python -m aiosmtpd -n -l localhost:8025`.
+"""
+
+import smtplib
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+from flask_mail import BadHeaderError, Message
+from sqlalchemy import and_, func, or_, select
+
+
+class MailQueue(object):
+    def __init__(self, app=None, db=None, mail=None):
+        self.app = None
+        self.db = db
+        self.mail = mail
+        self._wakeup = threading.Condition()
+        self._workers = []
+        if app is not None:
+            self.init_app(app, db, mail)
+
+    def init_app(self, app, db=None, mail=None):
+        if db is not None:
+            self.db = db
+        if mail is not None:
+            self.mail = mail
+        self.app = app
+        app.config.setdefault("MAIL_QUEUE_WORKERS", 2)
+        app.config.setdefault("MAIL_QUEUE_BATCH_SIZE", 50)
+        app.config.setdefault("MAIL_QUEUE_MAX_ATTEMPTS", 5)
+        app.config.setdefault("MAIL_QUEUE_BACKOFF", 30)
+        app.config.setdefault("MAIL_QUEUE_POLL_INTERVAL", 10)
+        app.config.setdefault("MAIL_QUEUE_CLAIM_TIMEOUT", 300)
+        app.extensions["mail_queue"] = self
+
+        # Messages queued before a restart, and retries that come due, are
+        # sent without waiting for a new message. The workers start with the
+        # first request, so that `flask` commands don't start any, and a
+        # server that forks its workers starts them in each worker.
+        if not app.testing:
+            app.before_first_request(self.start)
+
+    def after_fork(self):
+        """Forget the worker threads, which aren't copied into a forked process."""
+        self._wakeup = threading.Condition()
+        self._workers = []
+
+    @property
+    def _table(self):
+        return self.db.metadata.tables["outbound_mail"]
+
+    def _engine(self):
+        return self.db.get_engine(self.app)
+
+    def enqueue(self, subject, sender, recipients, body, html):
+        """Store a message in the queue, and wake up a worker to send it."""
+        with self._engine().begin() as connection:
+            connection.execute(
+                self._table.insert().values(
+                    subject=subject,
+                    sender=sender,
+                    recipients="\n".join(recipients),
+                    body=body,
+                    html=html,
+                    created=datetime.utcnow(),
+                    next_attempt=datetime.utcnow(),
+                    attempts=0,
+                )
+            )
+        self.start()
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def depth(self):
+        """Return the number of messages waiting to be sent."""
+        return self._count(self._table.c.next_attempt.isnot(None))
+
+    def failed(self):
+        """Return the number of messages that the queue has given up on."""
+        return self._count(self._table.c.next_attempt.is_(None))
+
+    def _count(self, criterion):
+        with self._engine().connect() as connection:
+            query = select(func.count()).select_from(self._table).where(criterion)
+            return connection.execute(query).scalar()
+
+    def _claim(self):
+        """
+        Claim a batch of due messages for this worker, and return their rows.
+        The claim is made with one UPDATE, so two workers can never claim the
+        same message.
+        """
+        table = self._table
+        now = datetime.utcnow()
+        claim = uuid.uuid4().hex
+        due = (
+            select(table.c.id)
+            .where(table.c.next_attempt <= now)
+            .where(or_(table.c.claimed_until.is_(None), table.c.claimed_until < now))
+            .order_by(table.c.next_attempt)
+            .limit(self.app.config["MAIL_QUEUE_BATCH_SIZE"])
+        )
+        timeout = timedelta(seconds=self.app.config["MAIL_QUEUE_CLAIM_TIMEOUT"])
+
+        with self._engine().begin() as connection:
+            connection.execute(
+                table.update()
+                .where(table.c.id.in_(due.scalar_subquery()))
+                .where(
+                    or_(table.c.claimed_until.is_(None), table.c.claimed_until < now)
+                )
+                .values(claim=claim, claimed_until=now + timeout)
+            )
+            return connection.execute(
+                select(table).where(table.c.claim == claim).order_by(table.c.id)
+            ).all()
+
+    def _sent(self, ids):
+        table = self._table
+        with self._engine().begin() as connection:
+            connection.execute(table.delete().where(table.c.id.in_(ids)))
+
+    def _release(self, rows, error=None):
+        """
+        Give up the claim on `rows`. If they failed with `error`, schedule the
+        next attempt.
+        """
+        table = self._table
+        now = datetime.utcnow()
+        with self._engine().begin() as connection:
+            for row in rows:
+                values = {"claim": None, "claimed_until": None}
+                if error is not None:
+                    attempts = row.attempts + 1
+                    backoff = self.app.config["MAIL_QUEUE_BACKOFF"] * 2**row.attempts
+                    if attempts >= self.app.config["MAIL_QUEUE_MAX_ATTEMPTS"]:
+                        next_attempt = None
+                    else:
+                        next_attempt = now + timedelta(seconds=backoff)
+                    values.update(
+                        attempts=attempts,
+                        next_attempt=next_attempt,
+                        last_error=str(error)[:255],
+                    )
+                connection.execute(
+                    table.update()
+                    .where(and_(table.c.id == row.id, table.c.claim == row.claim))
+                    .values(**values)
+                )
+
+    def drain(self):
+        """Send every due message, and return how many were sent."""
+        total = 0
+        rows = self._claim()
+        with self.app.app_context():
+            while rows:
+                try:
+                    with self.mail.connect() as connection:
+                        while rows:
+                            total += self._send(connection, rows)
+                            rows = self._claim()
+
+                # Either the connection couldn't be opened, or it broke while
+                # sending. Whatever wasn't sent yet is tried again later.
+                except Exception as error:
+                    self._release(rows, error)
+                    self.app.logger.warning("Failed to send email: %s", error)
+                    break
+        return total
+
+    def _send(self, connection, rows):
+        """
+        Send `rows` through `connection`, removing each row from the list once
+        it has been dealt with. Returns the number of messages sent.
+        """
+        sent = []
+        try:
+            while rows:
+                row = rows[0]
+                message = Message(
+                    row.subject,
+                    sender=row.sender,
+                    recipients=row.recipients.split("\n"),
+                    body=row.body,
+                    html=row.html,
+                )
+
+                # These errors are about the message itself, so the connection
+                # is still good for the other messages.
+                try:
+                    connection.send(message)
+                    sent.append(row.id)
+                except (smtplib.SMTPRecipientsRefused, BadHeaderError) as error:
+                    self._release([row], error)
+                rows.pop(0)
+        finally:
+            if sent:
+                self._sent(sent)
+        return len(sent)
+
+    def start(self):
+        """Start the worker threads, if they aren't running yet."""
+        count = self.app.config["MAIL_QUEUE_WORKERS"]
+        with self._wakeup:
+            while len(self._workers) < count:
+                worker = threading.Thread(target=self._run, daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def _run(self):
+        while True:
+            try:
+                sent = self.drain()
+            except Exception:
+                self.app.logger.exception("Mail queue worker failed")
+                sent = 0
+
+            # Sleep until a new message is queued, or until it is time to look
+            # for messages that are due to be retried.
+            if not sent:
+                with self._wakeup:
+                    self._wakeup.wait(self.app.config["MAIL_QUEUE_POLL_INTERVAL"])
@@ -0,0 +1,9 @@
+"""
+The pages of the site itself: the home timeline, profiles, explore and search.
+"""
+
+from flask import Blueprint
+
+bp = Blueprint("main", __name__)
+
+from app.main import routes
@@ -0,0 +1,371 @@
+"""
+This module contains all of the different URLs that the application implements.
+Each URL page is handled with what is called a 'view' function.
+
+The basic operation of a view function is that when the web browser requests a
+URL, flask is going to call the corresponding view function, passing the return
+value back to the web browser. Each view function uses the `render_template`
+function to pass dynamic content to the template as keyword arguments. The
+Jinja2 template engine renders the content.
+"""
+
+import hashlib
+
+from flask import (
+    Response,
+    current_app,
+    flash,
+    jsonify,
+    redirect,
+    render_template,
+    request,
+    url_for,
+)
+from flask_babel import _
+from flask_login import current_user, login_required
+from markupsafe import Markup
+
+from app import (
+    cache,
+    db,
+    follow_state,
+    identity,
+    last_seen,
+    post_stream,
+    recommendations,
+    timeline,
+)
+from app.conditional import conditional
+from app.database import use_replica
+from app.feeds import cached_feed, invalidate_feeds, render_feed, render_posts
+from app.main import bp
+from app.main.forms import EditProfileForm, EmptyForm, PostForm
+from app.models import Post, User, followers
+from app.pagination import paginate_posts, search_posts
+
+
+@bp.before_app_request
+def before_request():
+    """
+    Executed before any view function is called.
+    """
+    # Rather than committing `last_seen` on every request, the tracker records
+    # it in memory and writes it later, along with those of other users.
+    if current_user.is_authenticated:
+        last_seen.touch(current_user.id)
+
+
+@bp.app_context_processor
+def inject_follow_state():
+    """
+    Make the request-cached follow state available to all templates, so that
+    templates don't need to call `current_user.is_following()` for each user.
+    """
+    return dict(is_following=follow_state.is_following)
+
+
+def newest_post(*criteria):
+    """
+    Return the highest id and the latest timestamp of the posts that match
+    `criteria`. Both come straight from an index.
+    """
+    return (
+        db.session.query(db.func.max(Post.id), db.func.max(Post.timestamp))
+        .filter(*criteria)
+        .one()
+    )
+
+
+def index_version():
+    # Any new post might be on the home page, and the ids of the followed users
+    # change whenever the user follows or unfollows someone. The generation of
+    # the cached explore page changes whenever someone posts or edits their
+    # profile.
+    newest_id, newest_timestamp = newest_post()
+    following = db.session.query(followers.c.followed_id).filter(
+        followers.c.follower_id == current_user.id
+    )
+    following = hashlib.sha1(
+        b",".join(b"%d" % user_id for user_id, in following.order_by("followed_id"))
+    ).hexdigest()
+    parts = [
+        "index",
+        current_user.username,
+        newest_id,
+        following,
+        cache.generation("explore"),
+    ]
+    return parts, None
+
+
+def user_version(username):
+    user = User.query.filter_by(username=username).first_or_404()
+    newest_timestamp = newest_post(Post.user_id == user.id)[1]
+    parts = [
+        "user",
+        user.id,
+        user.username,
+        user.about_me,
+        user.last_seen,
+        user.follower_count,
+        user.followed_count,
+        user.post_count,
+        newest_timestamp,
+        follow_state.is_following(user),
+        cache.generation("user:%d" % user.id),
+    ]
+
+    # Users only see their own suggestions
+    if user.id == current_user.id:
+        parts.append(recommendations.version(user))
+    return parts, newest_timestamp
+
+
+def explore_version():
+    newest_id, newest_timestamp = newest_post()
+    return ["explore", newest_id, cache.generation("explore")], newest_timestamp
+
+
+@bp.route("/", methods=["GET", "POST"])
+@bp.route("/index", methods=["GET", "POST"])
+@login_required
+@use_replica
+@conditional(index_version)
+def index():
+    # Create a post
+    form = PostForm()
+    if form.validate_on_submit():
+        post = Post(body=form.post.data, author=current_user)
+        db.session.add(post)
+
+        # Flush so the post has an id before pushing it into timelines, then
+        # commit both in a single transaction.
+        db.session.flush()
+        timeline.push_post(post)
+        db.session.commit()
+        invalidate_feeds(current_user)
+        post_stream.publish_post(post, render_posts([post])[0])
+        flash(_("Your post is now live!"))
+        return redirect(url_for("main.index"))
+
+    # Display posts of other users that we are following. The page to show is
+    # taken from the `before`/`after` cursors in the request arguments. Only
+    # the columns that `_post.html` shows are loaded, along with the authors,
+    # in a single query.
+    posts = paginate_posts(
+        timeline.home_posts(current_user),
+        current_app.config["POSTS_PER_PAGE"],
+        rows=True,
+    )
+
+    return render_template(
+        "index.html",
+        title="Home",
+        form=form,
+        feed=Markup(render_feed(posts, "main.index")),
+        stream_url=stream_url(),
+    )
+
+
+@bp.route("/user/<username>")
+@login_required
+@use_replica
+@conditional(user_version)
+def user(username):
+
+    user = User.query.filter_by(username=username).first_or_404()
+
+    # The list of posts is the same for every viewer, so it is only queried
+    # and rendered when it isn't in the cache.
+    feed = cached_feed("user:%d" % user.id, lambda: render_user_feed(user))
+
+    form = EmptyForm()
+
+    # Suggest users to follow on the user's own profile
+    if user == current_user:
+        suggestions = recommendations.suggestions(user)
+    else:
+        suggestions = []
+
+    return render_template(
+        "user.html",
+        user=user,
+        feed=Markup(feed),
+        form=form,
+        suggestions=suggestions,
+    )
+
+
+def render_user_feed(user):
+    posts = paginate_posts(user.posts, current_app.config["POSTS_PER_PAGE"], rows=True)
+    return render_feed(posts, "main.user", username=user.username)
+
+
+@bp.route("/edit_profile", methods=["GET", "POST"])
+@login_required
+def edit_profile():
+    form = EditProfileForm(current_user.username)
+
+    # If the data is validated, copy into the user object and write to the
+    # database.
+    if form.validate_on_submit():
+        current_user.username = form.username.data
+        current_user.about_me = form.about_me.data
+        db.session.commit()
+        invalidate_feeds(current_user)
+        identity.remember(current_user)
+        flash("Your changes have been saved.")
+        return redirect(url_for("main.edit_profile"))
+
+    # There can be two cases where the data isn't validated: when the browser
+    # sends a GET request, in which case an initial version of the form needs
+    # to be provided. The other case is if the browser sends a POST request
+    # with form data, but something is wrong with the data.
+    elif request.method == "GET":
+        form.username.data = current_user.username
+        form.about_me.data = current_user.about_me
+
+    return render_template("edit_profile.html", title="Edit Profile", form=form)
+
+
+@bp.route("/follow/<username>", methods=["POST"])
+@login_required
+def follow(username):
+    form = EmptyForm()
+    if form.validate_on_submit():
+
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            flash(_("User %(username)s not found", username=username))
+            return redirect(url_for("main.index"))
+
+        if user == current_user:
+            flash("You cannot follow yourself.")
+            return redirect(url_for("main.user", username=username))
+
+        current_user.follow(user)
+        timeline.backfill(current_user, user)
+        recommendations.update(current_user)
+        db.session.commit()
+        post_stream.publish_follow(current_user, user)
+        flash("You are now following {}.".format(username))
+        return redirect(url_for("main.user", username=username))
+
+    else:
+        return redirect(url_for("main.index"))
+
+
+@bp.route("/unfollow/<username>", methods=["POST"])
+@login_required
+def unfollow(username):
+    form = EmptyForm()
+    if form.validate_on_submit():
+
+        user = User.query.filter_by(username=username).first()
+
+        if user is None:
+            flash(_("User %(username)s not found", username=username))
+            return redirect(url_for("main.index"))
+
+        if user == current_user:
+            flash("You cannot unfollow yourself.")
+            return redirect(url_for("main.user", username=username))
+        current_user.unfollow(user)
+        timeline.prune(current_user, user)
+        recommendations.update(current_user)
+        db.session.commit()
+        post_stream.publish_follow(current_user, user, following=False)
+        flash("You are now following {}.".format(username))
+        return redirect(url_for("main.user", username=username))
+    else:
+        return redirect(url_for("main.index"))
+
+
+@bp.route("/explore")
+@login_required
+@use_replica
+@conditional(explore_version)
+def explore():
+
+    # The list of posts is the same for every viewer, so it is only queried
+    # and rendered when it isn't in the cache.
+    feed = cached_feed("explore", render_explore_feed)
+
+    # Use the same template as the main page of the app ('index.html'), but do
+    # not pass in the form argument
+    return render_template(
+        "index.html",
+        title="Explore",
+        feed=Markup(feed),
+        stream_url=stream_url(feed="explore"),
+    )
+
+
+def render_explore_feed():
+
+    # Get all posts by all users, along with their authors. Paginate
+    # accordingly.
+    posts = paginate_posts(Post.query, current_app.config["POSTS_PER_PAGE"], rows=True)
+    return render_feed(posts, "main.explore")
+
+
+def stream_url(**values):
+    """
+    Return the URL of the stream of new posts for the page, or None on older
+    pages, where new posts don't belong.
+    """
+    if request.args.get("before") or request.args.get("after"):
+        return None
+    return url_for("main.stream", **values)
+
+
+@bp.route("/stream")
+@login_required
+def stream():
+    """
+    Server-Sent Events with the HTML of each new post by the followed users,
+    or with `?feed=explore`, by everyone.
+    """
+    if request.args.get("feed") == "explore":
+        followed = None
+    else:
+        query = db.session.query(followers.c.followed_id).filter(
+            followers.c.follower_id == current_user.id
+        )
+        followed = {user_id for (user_id,) in query}
+        followed.add(current_user.id)
+
+    # The generator runs after the request is over, so it can't use the
+    # session or `current_user`, and doesn't hold a database connection.
+    events = post_stream.events(
+        current_user.id,
+        followed,
+        last_id=request.headers.get("Last-Event-ID", type=int),
+    )
+    response = Response(events, mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    # Keep nginx from buffering the events
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+@bp.route("/search")
+@login_required
+def search():
+    q = request.args.get("q", "").strip()
+    if not q:
+        return redirect(url_for("main.explore"))
+
+    # Results come straight from the full-text index, best match first
+    posts = search_posts(
+        q, current_app.config["POSTS_PER_PAGE"], request.args.get("before")
+    )
+    feed = Markup(render_feed(posts, "main.search", q=q)) if posts.items else None
+    return render_template("search.html", title=_("Search"), q=q, feed=feed)
+
+
+@bp.route("/cache/stats")
+@login_required
+def cache_stats():
+    """Report the hit and miss counts of the response cache in this process."""
+    return jsonify(cache.stats())
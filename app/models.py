@@ -5,22 +5,46 @@ classes.
 """
 
 import hashlib
-from datetime import datetime
+import secrets
+from datetime import datetime, timedelta
+from functools import lru_cache
+from itertools import chain
 from time import time
 
 import jwt
+from flask import current_app, url_for
 from flask_login import UserMixin
-from werkzeug.security import check_password_hash, generate_password_hash
+from sqlalchemy import func, inspect, select
+from sqlalchemy.orm import validates
+from sqlalchemy.sql import ClauseElement
+
+from app import db, passwords, search_index
+
+
+def email_digest(email):
+    """Return the digest that Gravatar uses to identify `email`."""
+    return hashlib.md5(email.lower().encode("utf-8")).hexdigest()
+
+
+@lru_cache(maxsize=64)
+def avatar_template(size):
+    """
+    Return the URL of a Gravatar image `size` pixels wide, with a `{}` in place
+    of the email digest. Templates only ask for a handful of sizes, so each is
+    only built once.
+    """
+    return "https://www.gravatar.com/avatar/{}?d=identicon&s=%d" % size
 
-from app import app, db, login
 
 # This table is created outside of a model class, becuase it is an auxiliary
 # table that has no data other than foreign keys for other table entries (in
-# this case, user IDs)
+# this case, user IDs). The composite primary key keeps out duplicate rows and
+# covers lookups by follower; the second index covers lookups by followed user.
 followers = db.Table(
     "followers",
-    db.Column("follower_id", db.Integer, db.ForeignKey("user.id")),
-    db.Column("followed_id", db.Integer, db.ForeignKey("user.id")),
+    db.Column("follower_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Column("followed_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Index("ix_followers_followed_id_follower_id", "followed_id", "follower_id"),
 )
 
 
@@ -32,10 +56,29 @@ class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
+
+    # Gravatar's digest of `email`, kept up to date by `_set_email_digest()`,
+    # so that avatar URLs can be built without hashing anything.
+    email_digest = db.Column(db.String(32))
     password_hash = db.Column(db.String(128))
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
 
+    # Denormalized counts, kept up to date by `follow()`, `unfollow()` and the
+    # creation of posts, so that a profile page doesn't have to run COUNT(*)
+    # queries. `reconcile_counters()` recomputes them from scratch.
+    follower_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default="0"
+    )
+    followed_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default="0"
+    )
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
+    # Bearer token for the JSON API in `app/api`, see `get_token()`
+    token = db.Column(db.String(32), index=True, unique=True)
+    token_expiration = db.Column(db.DateTime)
+
     # This defines a 'one-to-many' relationship. The first argument represents
     # the 'many' side of the relationship. The `backref` argument defines the
     # name of the field that will be added to the objects of the 'many' class
@@ -60,28 +103,62 @@ class User(UserMixin, db.Model):
         return "<User %s>" % self.username
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = passwords.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return passwords.verify(self.password_hash, password)
+
+    def password_needs_rehash(self):
+        return passwords.needs_rehash(self.password_hash)
+
+    @validates("email")
+    def _set_email_digest(self, key, email):
+        self.email_digest = email_digest(email) if email is not None else None
+        return email
 
     def avatar(self, size):
         """Return URL for the user's avatar image"""
-        digest = hashlib.md5(self.email.lower().encode("utf-8")).hexdigest()
-
-        url = "https://www.gravatar.com/avatar/{}?d=identicon&s={}"
-        return url.format(digest, size)
+        return avatar_template(size).format(self.email_digest)
 
     def follow(self, user):
         if not self.is_following(user):
             self.followed.append(user)
+            _increment(self, "followed_count", 1)
+            _increment(user, "follower_count", 1)
 
     def unfollow(self, user):
         if self.is_following(user):
             self.followed.remove(user)
+            _increment(self, "followed_count", -1)
+            _increment(user, "follower_count", -1)
 
     def is_following(self, user):
-        return self.followed.filter(followers.c.followed_id == user.id).count() > 0
+        # Users that were just added to the session don't have an id yet
+        if self.id is None or user.id is None:
+            db.session.flush()
+
+        # Probe for the one row that matters, instead of counting rows
+        row = select(followers).where(
+            followers.c.follower_id == self.id, followers.c.followed_id == user.id
+        )
+        return db.session.query(row.exists()).scalar()
+
+    def followed_ids(self, user_ids):
+        """
+        Return the set of ids, out of `user_ids`, of the users that this user
+        follows. This takes one query no matter how many ids are given.
+        """
+        user_ids = set(user_ids)
+        if not user_ids:
+            return set()
+
+        rows = db.session.execute(
+            select(followers.c.followed_id).where(
+                followers.c.follower_id == self.id,
+                followers.c.followed_id.in_(user_ids),
+            )
+        )
+        return {followed_id for followed_id, in rows}
 
     def followed_posts(self):
         """
@@ -107,39 +184,260 @@ class User(UserMixin, db.Model):
     def get_reset_password_token(self, expires_in=600):
         return jwt.encode(
             {"reset_password": self.id, "exp": time() + expires_in},
-            app.config["SECRET_KEY"],
+            current_app.config["SECRET_KEY"],
             algorithm="HS256",
         )
 
     @staticmethod
     def verify_reset_password_token(token):
         try:
-            id = jwt.decode(token, app.config["SECRET_KEY"], algorithms=["HS256"])[
-                "reset_password"
-            ]
+            id = jwt.decode(
+                token, current_app.config["SECRET_KEY"], algorithms=["HS256"]
+            )["reset_password"]
         except:
             return
         return User.query.get(id)
 
+    def get_token(self, expires_in=3600):
+        """
+        Return the user's API token, issuing a new one if there is none or it
+        is about to expire. The caller is responsible for committing.
+        """
+        now = datetime.utcnow()
+        if self.token and self.token_expiration > now + timedelta(seconds=60):
+            return self.token
+        self.token = secrets.token_hex(16)
+        self.token_expiration = now + timedelta(seconds=expires_in)
+        return self.token
+
+    def revoke_token(self):
+        self.token_expiration = datetime.utcnow() - timedelta(seconds=1)
+
+    @staticmethod
+    def check_token(token):
+        user = User.query.filter_by(token=token).first()
+        if user is None or user.token_expiration < datetime.utcnow():
+            return None
+        return user
+
+    def to_dict(self, include_email=False):
+        """Return the user as a dictionary for the JSON API."""
+        data = {
+            "id": self.id,
+            "username": self.username,
+            "about_me": self.about_me,
+            "last_seen": self.last_seen.isoformat() + "Z" if self.last_seen else None,
+            "post_count": self.post_count,
+            "follower_count": self.follower_count,
+            "followed_count": self.followed_count,
+            "_links": {
+                "self": url_for("api.get_user", id=self.id),
+                "posts": url_for("api.get_user_posts", id=self.id),
+                "followers": url_for("api.get_followers", id=self.id),
+                "followed": url_for("api.get_followed", id=self.id),
+                "avatar": self.avatar(128),
+            },
+        }
+        if include_email:
+            data["email"] = self.email
+        return data
+
+
+class SearchableMixin(object):
+    """
+    Keeps the full-text index of a model (see `app/search.py`) in sync with
+    its table. The fields listed in `__searchable__` are indexed when a row is
+    added or changed, and dropped when it is deleted, once the session
+    commits. Nothing is indexed if the transaction is rolled back.
+    """
+
+    @classmethod
+    def search(cls, expression, limit, after=None):
+        """Return up to `limit` hits for `expression`, as `(id, score)` pairs."""
+        return search_index.query(cls.__tablename__, expression, limit, after)
+
+    @classmethod
+    def reindex(cls, batch_size=1000):
+        """Rebuild the index from scratch, and return the number of rows."""
+        search_index.clear(cls.__tablename__)
+        columns = [getattr(cls, field) for field in cls.__searchable__]
+        rows = db.session.execute(
+            select(cls.id, *columns).execution_options(yield_per=batch_size)
+        )
+        count = 0
+        for batch in rows.partitions():
+            search_index.add_many(
+                cls.__tablename__,
+                ((row[0], dict(zip(cls.__searchable__, row[1:]))) for row in batch),
+            )
+            count += len(batch)
+        return count
+
+    def _search_fields(self):
+        return {field: getattr(self, field) for field in self.__searchable__}
+
+    @staticmethod
+    def _after_flush(session, context):
+        changes = session.info.setdefault("search_changes", [])
+        for obj in chain(session.new, session.dirty):
+            if isinstance(obj, SearchableMixin):
+                changes.append((obj.__tablename__, obj.id, obj._search_fields()))
+        for obj in session.deleted:
+            if isinstance(obj, SearchableMixin):
+                changes.append((obj.__tablename__, obj.id, None))
+
+    @staticmethod
+    def _after_commit(session):
+        for index, id, fields in session.info.pop("search_changes", ()):
+            # The rows are already committed, so a failure here only means
+            # that the index is behind until the next `flask search reindex`.
+            try:
+                if fields is None:
+                    search_index.remove(index, id)
+                else:
+                    search_index.add(index, id, fields)
+            except Exception:
+                current_app.logger.exception("Failed to update the search index")
+
+    @staticmethod
+    def _after_soft_rollback(session, previous_transaction):
+        session.info.pop("search_changes", None)
+
 
-class Post(db.Model):
+db.event.listen(db.session, "after_flush", SearchableMixin._after_flush)
+db.event.listen(db.session, "after_commit", SearchableMixin._after_commit)
+db.event.listen(db.session, "after_soft_rollback", SearchableMixin._after_soft_rollback)
+
+
+class Post(SearchableMixin, db.Model):
     """
     Represents a post by a user to the blog.
     """
 
+    __searchable__ = ["body"]
+
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
 
+    # Lets the posts of one user be read in order with an index range scan
+    __table_args__ = (db.Index("ix_post_user_id_timestamp", "user_id", "timestamp"),)
+
     def __repr__(self):
         return "<Post %s>" % self.body
 
 
-@login.user_loader
-def load_user(id):
+class TimelineEntry(db.Model):
+    """
+    One post in one user's materialized home timeline. Rows are written when a
+    post is created (fan-out-on-write) and when a user follows someone, and
+    deleted when a user unfollows someone. See `app/timeline.py`.
+    """
+
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey("post.id"), primary_key=True)
+
+    def __repr__(self):
+        return "<TimelineEntry %s %s>" % (self.user_id, self.post_id)
+
+
+class Recommendation(db.Model):
     """
-    The `user_loader` function keeps track of users that have logged into the
-    application.
+    A user suggested to another user to follow, with its score. Rows are
+    rewritten by `app/recommendations.py` as the followers graph changes.
     """
-    return User.query.get(int(id))
+
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    candidate_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    score = db.Column(db.Float, nullable=False)
+    computed = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return "<Recommendation %s %s>" % (self.user_id, self.candidate_id)
+
+
+class OutboundMail(db.Model):
+    """
+    An email waiting to be sent by the mail queue in `app/mail_queue.py`. Rows are
+    deleted once they have been sent.
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(255))
+    sender = db.Column(db.String(120))
+
+    # One address per line
+    recipients = db.Column(db.Text)
+    body = db.Column(db.Text)
+    html = db.Column(db.Text)
+    created = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # When the message should be (re)tried. NULL once the queue has given up
+    # on it.
+    next_attempt = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.String(255))
+
+    # A worker that is sending the message holds a claim on it until the
+    # claim expires, so that other workers leave it alone.
+    claim = db.Column(db.String(32), index=True)
+    claimed_until = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return "<OutboundMail %s>" % self.subject
+
+
+def _increment(user, counter, amount):
+    """
+    Add `amount` to one of the counters of `user`. For users that are already
+    in the database, this is done in SQL (i.e., `count = count + 1`) so that
+    concurrent requests don't overwrite each other's changes.
+    """
+    value = user.__dict__.get(counter)
+    if isinstance(value, ClauseElement):
+        value = value + amount
+    elif inspect(user).persistent:
+        value = getattr(User, counter) + amount
+    else:
+        value = (value or 0) + amount
+    setattr(user, counter, value)
+
+
+@db.event.listens_for(Post, "after_insert")
+def _count_new_post(mapper, connection, post):
+    users = User.__table__
+    connection.execute(
+        users.update()
+        .where(users.c.id == post.user_id)
+        .values(post_count=users.c.post_count + 1)
+    )
+
+
+@db.event.listens_for(Post, "after_delete")
+def _count_deleted_post(mapper, connection, post):
+    users = User.__table__
+    connection.execute(
+        users.update()
+        .where(users.c.id == post.user_id)
+        .values(post_count=users.c.post_count - 1)
+    )
+
+
+def reconcile_counters():
+    """
+    Recompute the counters of every user from the `followers` and `post`
+    tables, in a single UPDATE statement.
+    """
+    users = User.__table__
+
+    def count(user_id):
+        return select(func.count()).where(user_id == users.c.id).scalar_subquery()
+
+    db.session.execute(
+        users.update().values(
+            follower_count=count(followers.c.followed_id),
+            followed_count=count(followers.c.follower_id),
+            post_count=count(Post.user_id),
+        )
+    )
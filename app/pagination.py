@@ -0,0 +1,185 @@
+"""
+Keyset (cursor) pagination for lists of posts.
+
+Flask-SQLAlchemy's `paginate()` skips over earlier pages with OFFSET, so deep
+pages get slower and slower, and it also runs a COUNT(*) over the whole query
+on every page view. Here, posts are instead ordered by `(timestamp, id)`, and
+each page is fetched with a WHERE clause that starts right after the last (or
+before the first) post of the page the client came from. Page 10,000 costs the
+same as page 1, and no count is ever needed: one extra row is fetched to find
+out whether there is another page.
+
+The position of a post is passed around in `before`/`after` URL arguments as
+an opaque token. The old `?page=` links still work, but only for the page they
+point at; every link out of that page is a cursor.
+"""
+
+import base64
+from datetime import datetime
+
+from flask import request
+from sqlalchemy import and_, or_
+
+from app import search_index
+from app.models import Post
+from app.rows import post_rows, project_posts
+
+
+def encode_cursor(*values):
+    """Pack `values` into an opaque, URL-safe token."""
+    raw = "|".join(str(value) for value in values).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(token):
+    """
+    Unpack a token made by `encode_cursor()` into a list of strings. Raises
+    `ValueError` if the token is malformed.
+    """
+    padded = token + "=" * (-len(token) % 4)
+    return base64.urlsafe_b64decode(padded.encode("ascii")).decode("utf-8").split("|")
+
+
+def post_cursor(post):
+    return encode_cursor(post.timestamp.isoformat(), post.id)
+
+
+def _decode_post_cursor(token):
+    timestamp, id = decode_cursor(token)
+    return datetime.fromisoformat(timestamp), int(id)
+
+
+class KeysetPage(object):
+    """One page of posts, along with cursors for the neighbouring pages."""
+
+    def __init__(self, items, next_cursor, prev_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        """True if there are older posts."""
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        """True if there are newer posts."""
+        return self.prev_cursor is not None
+
+
+def _fetch(query, limit, offset=0, rows=False):
+    if rows:
+        query = project_posts(query)
+    query = query.limit(limit)
+    if offset:
+        query = query.offset(offset)
+    return post_rows(query) if rows else query.all()
+
+
+def paginate_posts(query, per_page, before=None, after=None, page=None, rows=False):
+    """
+    Return a `KeysetPage` of the posts in `query`, newest first. `before` and
+    `after` are cursors from a previous page; if neither is given, `page` is
+    used instead. When called without any of them, they are read from the
+    request arguments. With `rows`, the page holds `PostRow` records instead of
+    `Post` objects.
+    """
+    if before is None and after is None and page is None:
+        before = request.args.get("before")
+        after = request.args.get("after")
+        page = request.args.get("page", 1, type=int)
+
+    # Whatever order the caller asked for is replaced by the keyset order.
+    query = query.order_by(None)
+    newest_first = (Post.timestamp.desc(), Post.id.desc())
+
+    try:
+        if after:
+            timestamp, id = _decode_post_cursor(after)
+            found = _fetch(
+                query.filter(
+                    or_(
+                        Post.timestamp > timestamp,
+                        and_(Post.timestamp == timestamp, Post.id > id),
+                    )
+                ).order_by(Post.timestamp.asc(), Post.id.asc()),
+                per_page + 1,
+                rows=rows,
+            )
+            items = found[:per_page][::-1]
+            has_newer = len(found) > per_page
+            has_older = True
+            if not items:
+                return KeysetPage(items, after, None)
+
+        elif before:
+            timestamp, id = _decode_post_cursor(before)
+            found = _fetch(
+                query.filter(
+                    or_(
+                        Post.timestamp < timestamp,
+                        and_(Post.timestamp == timestamp, Post.id < id),
+                    )
+                ).order_by(*newest_first),
+                per_page + 1,
+                rows=rows,
+            )
+            items = found[:per_page]
+            has_newer = True
+            has_older = len(found) > per_page
+            if not items:
+                return KeysetPage(items, None, before)
+
+        else:
+            # Compatibility path for `?page=` links. There is still an OFFSET
+            # here, but no COUNT.
+            offset = (max(page or 1, 1) - 1) * per_page
+            found = _fetch(
+                query.order_by(*newest_first), per_page + 1, offset, rows=rows
+            )
+            items = found[:per_page]
+            has_newer = offset > 0 and bool(items)
+            has_older = len(found) > per_page
+
+    # A malformed cursor is treated like no cursor at all.
+    except ValueError:
+        return paginate_posts(query, per_page, page=1, rows=rows)
+
+    return KeysetPage(
+        items,
+        post_cursor(items[-1]) if has_older else None,
+        post_cursor(items[0]) if has_newer else None,
+    )
+
+
+def search_posts(text, per_page, cursor=None):
+    """
+    Return a `KeysetPage` of the posts that match `text`, best match first.
+    `cursor` is the `next_cursor` of the previous page. There is no cursor for
+    the previous page, since rankings can change as posts are added.
+    """
+    after = None
+    if cursor:
+        try:
+            score, id = decode_cursor(cursor)
+            after = (float(score), int(id))
+
+        # A malformed cursor is treated like no cursor at all.
+        except ValueError:
+            pass
+
+    hits = Post.search(text, per_page + 1, after)
+    page = hits[:per_page]
+    ids = [id for id, score in page]
+    found = {}
+    if ids:
+        query = Post.query.filter(Post.id.in_(ids))
+        found = {row.id: row for row in post_rows(project_posts(query))}
+
+    # Posts that were deleted since they were indexed are left out
+    items = [found[id] for id in ids if id in found]
+    next_cursor = (
+        encode_cursor(page[-1][1], page[-1][0]) if len(hits) > per_page else None
+    )
+    return KeysetPage(items, next_cursor, None)
@@ -0,0 +1,128 @@
+"""
+Password hashing away from the request threads.
+
+A password hash is deliberately slow: with the default PBKDF2 cost, checking
+one password keeps a CPU core busy for a good fraction of a second. Done inside
+the view, every login holds a request worker for that long, and a burst of
+login attempts can leave no workers for any other page. `PasswordHasher` runs
+the hashing in a separate pool of `PASSWORD_HASH_WORKERS` processes instead.
+
+The pool has backpressure: at most `PASSWORD_HASH_QUEUE` hashes can wait for a
+free process. A request that can't get a place within `PASSWORD_HASH_WAIT`
+seconds fails with `PasswordHashingBusy`, which is answered with a 503, rather
+than piling up behind the others.
+
+The algorithm and its cost are set with `PASSWORD_HASH_METHOD`, in werkzeug's
+format (e.g., "pbkdf2:sha256:600000"). Hashes made with an older method are
+replaced the next time the user logs in; see `needs_rehash()`.
+"""
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.security import (
+    DEFAULT_PBKDF2_ITERATIONS,
+    check_password_hash,
+    generate_password_hash,
+)
+
+
+class PasswordHashingBusy(Exception):
+    """Raised when too many passwords are already waiting to be hashed."""
+
+
+class PasswordHasher(object):
+    def __init__(self, app=None):
+        self.app = None
+        self._executor = None
+        self._slots = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault("PASSWORD_HASH_METHOD", "pbkdf2:sha256")
+        app.config.setdefault("PASSWORD_HASH_SALT_LENGTH", 16)
+        app.config.setdefault("PASSWORD_HASH_WORKERS", os.cpu_count() or 1)
+        app.config.setdefault("PASSWORD_HASH_QUEUE", 64)
+        app.config.setdefault("PASSWORD_HASH_WAIT", 5)
+        app.extensions["passwords"] = self
+
+    def after_fork(self):
+        """Forget the pool of the parent process, and start a new one on use."""
+        self._executor = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+    @property
+    def method(self):
+        """The configured method, with the cost filled in if it was left out."""
+        method = self.app.config["PASSWORD_HASH_METHOD"]
+        if method.startswith("pbkdf2:") and method.count(":") == 1:
+            method += ":%d" % DEFAULT_PBKDF2_ITERATIONS
+        return method
+
+    def hash(self, password):
+        """Return a hash of `password`, made with the configured method."""
+        return self._run(
+            generate_password_hash,
+            password,
+            self.method,
+            self.app.config["PASSWORD_HASH_SALT_LENGTH"],
+        )
+
+    def verify(self, password_hash, password):
+        """Return True if `password` matches `password_hash`."""
+        if not password_hash:
+            return False
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """
+        Return True if `password_hash` wasn't made with the configured method
+        and cost, and should be replaced with a new hash of the same password.
+        """
+        return password_hash.split("$", 1)[0] != self.method
+
+    def _run(self, function, *args):
+        executor = self._pool()
+        if executor is None:
+            return function(*args)
+
+        if not self._slots.acquire(timeout=self.app.config["PASSWORD_HASH_WAIT"]):
+            raise PasswordHashingBusy()
+        try:
+            future = executor.submit(function, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda future: self._slots.release())
+        return future.result()
+
+    def _pool(self):
+        """
+        Return the process pool, starting it on first use. Returns None if
+        `PASSWORD_HASH_WORKERS` is 0, in which case passwords are hashed in the
+        calling thread.
+        """
+        workers = self.app.config["PASSWORD_HASH_WORKERS"]
+        if not workers:
+            return None
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._slots = threading.BoundedSemaphore(
+                        workers + self.app.config["PASSWORD_HASH_QUEUE"]
+                    )
+
+                    # Processes are started fresh instead of forked, so they
+                    # don't inherit the locks of the server's other threads.
+                    # Like with any spawned process, a script that hashes
+                    # passwords needs an `if __name__ == "__main__"` guard.
+                    self._executor = ProcessPoolExecutor(
+                        workers, mp_context=multiprocessing.get_context("spawn")
+                    )
+        return self._executor
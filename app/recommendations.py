@@ -0,0 +1,235 @@
+"""
+"Who to follow" suggestions, from the followers graph.
+
+Users are suggested the users that the users they follow follow (friends of
+friends), scored by Adamic-Adar: each path u -> w -> c adds 1 / log(1 + n) to
+the score of c for u, where n is the number of users that w follows, so that a
+path through someone who follows only a few users counts for more than one
+through someone who follows everybody. With `RECOMMENDATIONS_SCORE` set to
+"common_neighbors", every path counts 1. The best `RECOMMENDATIONS_PER_USER`
+candidates of each user, other than the users they already follow, are stored
+as `Recommendation` rows.
+
+`rebuild()` (`flask recommendations rebuild`, meant to be run on a schedule,
+e.g., nightly from cron) loads the whole edge list into a sparse adjacency
+matrix A, and scores users `RECOMMENDATIONS_BATCH_SIZE` at a time, as the
+rows of the matrix product A[batch] . D . A, where the diagonal matrix D holds
+the weight of each user in the middle of a path.
+
+A follow or unfollow by u changes the paths that start at u, and the weight
+of u, which is in the middle of the paths of its followers. `update()`
+rescores them right away, from the edges within two steps of them. The
+followers of users with more than `RECOMMENDATIONS_UPDATE_MAX_FOLLOWERS`
+followers wait for the next rebuild instead.
+
+NumPy and SciPy are only imported when something has to be scored, since they
+take longer to import than the rest of the application. Like
+`app/timeline.py`, the functions here only add statements to the current
+session; the caller is responsible for committing.
+"""
+
+from datetime import datetime
+from itertools import islice
+
+from flask import current_app
+from sqlalchemy import func, or_, select
+
+from app import db
+from app.models import Recommendation, User, followers
+
+
+def enabled():
+    return current_app.config["RECOMMENDATIONS_PER_USER"] > 0
+
+
+def _graph(follower_ids, followed_ids):
+    """
+    Return the sorted ids of the users in the edges `follower_ids[i]` ->
+    `followed_ids[i]`, and the adjacency matrix of the edges, in which those
+    users are numbered by their position in the ids.
+    """
+    import numpy as np
+    from scipy import sparse
+
+    ids, index = np.unique(
+        np.concatenate([follower_ids, followed_ids]), return_inverse=True
+    )
+    rows, columns = np.split(index, 2)
+    adjacency = sparse.csr_matrix(
+        (np.ones(len(rows)), (rows, columns)), shape=(len(ids), len(ids))
+    )
+    return ids, adjacency
+
+
+def _score(ids, adjacency, rows):
+    """
+    Yield the id of the user of each of `rows` of `adjacency`, with a list of
+    the ids and scores of their best candidates, best first.
+    """
+    import numpy as np
+    from scipy import sparse
+
+    config = current_app.config
+    limit = config["RECOMMENDATIONS_PER_USER"]
+    batch_size = config["RECOMMENDATIONS_BATCH_SIZE"]
+
+    # The weight of each user in the middle of a path
+    out_degree = np.asarray(adjacency.sum(axis=1)).ravel()
+    if config["RECOMMENDATIONS_SCORE"] == "adamic_adar":
+        weights = np.zeros(len(ids))
+        np.divide(1, np.log1p(out_degree), out=weights, where=out_degree > 0)
+    elif config["RECOMMENDATIONS_SCORE"] == "common_neighbors":
+        weights = np.ones(len(ids))
+    else:
+        raise ValueError(
+            "Unknown RECOMMENDATIONS_SCORE %r" % config["RECOMMENDATIONS_SCORE"]
+        )
+    weighted = sparse.diags(weights) @ adjacency
+
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start : start + batch_size]
+        followed = adjacency[batch]
+        scores = (followed @ weighted).tocsr()
+        for i, row in enumerate(batch):
+            candidates = scores.indices[scores.indptr[i] : scores.indptr[i + 1]]
+            values = scores.data[scores.indptr[i] : scores.indptr[i + 1]]
+
+            # Leave out the user, and the users they already follow
+            known = followed.indices[followed.indptr[i] : followed.indptr[i + 1]]
+            keep = ~np.isin(candidates, known) & (candidates != row)
+            candidates = ids[candidates[keep]]
+            values = values[keep]
+
+            # Best score first, then lowest id
+            best = np.lexsort((candidates, -values))[:limit]
+            yield int(ids[row]), list(
+                zip(candidates[best].tolist(), values[best].tolist())
+            )
+
+
+def _store(scored):
+    """Write the suggestions yielded by `_score()`, and return how many."""
+    computed = datetime.utcnow()
+    rows = [
+        {
+            "user_id": user_id,
+            "candidate_id": candidate_id,
+            "score": score,
+            "computed": computed,
+        }
+        for user_id, candidates in scored
+        for candidate_id, score in candidates
+    ]
+    if rows:
+        db.session.execute(Recommendation.__table__.insert(), rows)
+    return len(rows)
+
+
+def rebuild():
+    """
+    Score every user from the whole `followers` table, and return the number
+    of suggestions written.
+    """
+    import numpy as np
+
+    recommendations = Recommendation.__table__
+    db.session.execute(recommendations.delete())
+    if not enabled():
+        return 0
+
+    edges = db.session.execute(
+        select(followers.c.follower_id, followers.c.followed_id)
+    ).all()
+    if not edges:
+        return 0
+    edges = np.array(edges, dtype=np.int64)
+    ids, adjacency = _graph(edges[:, 0], edges[:, 1])
+
+    # Users who follow nobody have no candidates
+    rows = np.flatnonzero(np.diff(adjacency.indptr))
+    count = 0
+    batch_size = current_app.config["RECOMMENDATIONS_BATCH_SIZE"]
+    scored = _score(ids, adjacency, rows)
+    while True:
+        batch = list(islice(scored, batch_size))
+        if not batch:
+            return count
+        count += _store(batch)
+
+
+def refresh(user_ids):
+    """Rescore the users with `user_ids`."""
+    import numpy as np
+
+    user_ids = sorted(set(user_ids))
+    recommendations = Recommendation.__table__
+    db.session.execute(
+        recommendations.delete().where(recommendations.c.user_id.in_(user_ids))
+    )
+
+    # The paths from these users only depend on the edges from them, and on
+    # the edges from the users they follow
+    followed = select(followers.c.followed_id).where(
+        followers.c.follower_id.in_(user_ids)
+    )
+    edges = db.session.execute(
+        select(followers.c.follower_id, followers.c.followed_id).where(
+            or_(
+                followers.c.follower_id.in_(user_ids),
+                followers.c.follower_id.in_(followed),
+            )
+        )
+    ).all()
+    if not edges:
+        return
+    edges = np.array(edges, dtype=np.int64)
+    ids, adjacency = _graph(edges[:, 0], edges[:, 1])
+    _store(_score(ids, adjacency, np.flatnonzero(np.isin(ids, user_ids))))
+
+
+def update(user):
+    """
+    Rescore `user`, who just followed or unfollowed someone, and their
+    followers, unless they have too many.
+    """
+    if not enabled():
+        return
+
+    # The follow must be visible to the queries
+    db.session.flush()
+    user_ids = [user.id]
+    threshold = current_app.config["RECOMMENDATIONS_UPDATE_MAX_FOLLOWERS"]
+    count = db.session.query(User.follower_count).filter_by(id=user.id).scalar()
+    if count <= threshold:
+        rows = db.session.execute(
+            select(followers.c.follower_id).where(followers.c.followed_id == user.id)
+        )
+        user_ids.extend(follower_id for follower_id, in rows)
+    refresh(user_ids)
+
+
+def suggestions(user):
+    """
+    Return the users suggested to `user`, best first, with their scores, as
+    (user, score) pairs.
+    """
+    # Leave out anyone followed since the suggestions were computed
+    following = select(followers.c.followed_id).where(
+        followers.c.follower_id == user.id
+    )
+    return (
+        db.session.query(User, Recommendation.score)
+        .join(Recommendation, Recommendation.candidate_id == User.id)
+        .filter(Recommendation.user_id == user.id, User.id.not_in(following))
+        .order_by(Recommendation.score.desc(), User.id)
+        .all()
+    )
+
+
+def version(user):
+    """Return the time the suggestions of `user` were last computed."""
+    return (
+        db.session.query(func.max(Recommendation.computed))
+        .filter(Recommendation.user_id == user.id)
+        .scalar()
+    )
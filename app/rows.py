@@ -0,0 +1,59 @@
+"""
+Lightweight records for rendering lists of posts.
+
+Loading a page of posts as ORM objects builds a `Post` and a `User` instance
+per row, each with identity map entries, attribute history and lazy
+relationships, even though `_post.html` only reads the body, the timestamp,
+and the author's username and avatar. `project_posts()` instead selects just
+those columns, joined with the author, and `post_rows()` turns the result into
+small `__slots__` records, with one author record per author on the page.
+
+The records have the same attributes as the ORM objects, as far as the
+templates are concerned, so either can be passed to `_feed.html`.
+"""
+
+from app.models import Post, User, avatar_template
+
+
+class AuthorRow(object):
+    __slots__ = ("id", "username", "email_digest")
+
+    def __init__(self, id, username, email_digest):
+        self.id = id
+        self.username = username
+        self.email_digest = email_digest
+
+    def avatar(self, size):
+        return avatar_template(size).format(self.email_digest)
+
+
+class PostRow(object):
+    __slots__ = ("id", "body", "timestamp", "author")
+
+    def __init__(self, id, body, timestamp, author):
+        self.id = id
+        self.body = body
+        self.timestamp = timestamp
+        self.author = author
+
+
+def project_posts(query):
+    """
+    Turn a query of posts into a query of only the columns that `post_rows()`
+    needs. Must be called before any LIMIT or OFFSET is applied.
+    """
+    return query.join(User, User.id == Post.user_id).with_entities(
+        Post.id, Post.body, Post.timestamp, User.id, User.username, User.email_digest
+    )
+
+
+def post_rows(results):
+    """Build a list of `PostRow` from the results of `project_posts()`."""
+    authors = {}
+    rows = []
+    for id, body, timestamp, user_id, username, digest in results:
+        author = authors.get(user_id)
+        if author is None:
+            author = authors[user_id] = AuthorRow(user_id, username, digest)
+        rows.append(PostRow(id, body, timestamp, author))
+    return rows
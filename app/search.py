@@ -0,0 +1,247 @@
+"""
+Full-text search.
+
+`SearchIndex` keeps a ranked full-text index of the models that use
+`SearchableMixin` (see `app/models.py`), in one of several backends, chosen
+with `SEARCH_BACKEND`:
+
+ - "sqlite": an FTS5 table per model in a separate SQLite file at
+   `SEARCH_PATH`, ranked with BM25. It needs no server. FTS5 scores every
+   match before it can return the best ones, which for a common word takes
+   hundreds of milliseconds over half a million posts, so only the
+   `SEARCH_MAX_CANDIDATES` most recent matches are ranked.
+ - "elasticsearch": an index per model in the cluster at `ELASTICSEARCH_URL`
+ - "null": indexes nothing, and finds nothing
+
+Every backend has the same interface. `query()` returns hits as `(id, score)`
+pairs in rank order, and takes the last hit of the previous page as `after`,
+so that results can be paginated with a cursor instead of an offset.
+"""
+
+import re
+import sqlite3
+import threading
+
+from app.sqlite import LocalConnections
+
+
+def _words(text):
+    return re.findall(r"\w+", text, re.UNICODE)
+
+
+class NullBackend(object):
+    def add(self, index, id, fields):
+        pass
+
+    def add_many(self, index, rows):
+        pass
+
+    def remove(self, index, id):
+        pass
+
+    def query(self, index, text, limit, after=None):
+        return []
+
+    def clear(self, index):
+        pass
+
+
+class SQLiteBackend(object):
+    """
+    A backend that stores each index as an FTS5 table, with the model's id as
+    the rowid. Tables are created on first use, with one column per field.
+    Only the `max_candidates` matches with the highest ids are ranked (all of
+    them with 0).
+    """
+
+    def __init__(self, path, max_candidates=10000):
+        self.path = path
+        self.max_candidates = max_candidates
+        self._connections = LocalConnections(path)
+
+    def _create(self, index, fields):
+        columns = ", ".join('"%s"' % field for field in fields)
+        self._connections.get().execute(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS "%s" USING fts5(%s)' % (index, columns)
+        )
+
+    def add(self, index, id, fields):
+        self.add_many(index, [(id, fields)])
+
+    def add_many(self, index, rows):
+        rows = list(rows)
+        if not rows:
+            return
+        fields = list(rows[0][1])
+        self._create(index, fields)
+        sql = 'INSERT OR REPLACE INTO "%s" (rowid, %s) VALUES (?%s)' % (
+            index,
+            ", ".join('"%s"' % field for field in fields),
+            ", ?" * len(fields),
+        )
+        connection = self._connections.get()
+        with connection:
+            connection.execute("BEGIN")
+            connection.executemany(
+                sql, ([id] + [values[field] for field in fields] for id, values in rows)
+            )
+
+    def remove(self, index, id):
+        try:
+            self._connections.get().execute(
+                'DELETE FROM "%s" WHERE rowid = ?' % index, (id,)
+            )
+        except sqlite3.OperationalError:
+            # Nothing was ever indexed, so there is nothing to remove
+            pass
+
+    def query(self, index, text, limit, after=None):
+        # Every word is quoted, so that nothing the user types is taken as
+        # FTS5 syntax. Words are implicitly joined with AND.
+        words = _words(text)
+        if not words:
+            return []
+        match = " ".join('"%s"' % word for word in words)
+
+        try:
+            return self._query(index, match, limit, after)
+        except sqlite3.OperationalError as error:
+            if "no such table" in str(error):
+                return []
+            raise
+
+    def _query(self, index, match, limit, after):
+        connection = self._connections.get()
+
+        # `rank` is the BM25 score, where lower is better. Ties are broken by
+        # rowid, so that the order is total and `after` is unambiguous.
+        sql = 'SELECT rowid, rank FROM "%s" WHERE "%s" MATCH ?' % (index, index)
+        parameters = [match]
+
+        # Walking the matches in rowid order costs next to nothing, unlike
+        # scoring them. Newer posts push the oldest candidates out, so a later
+        # page can miss a few hits, which is fine for a search box.
+        if self.max_candidates:
+            floor = connection.execute(
+                'SELECT rowid FROM "%s" WHERE "%s" MATCH ? '
+                "ORDER BY rowid DESC LIMIT 1 OFFSET ?" % (index, index),
+                (match, self.max_candidates - 1),
+            ).fetchone()
+            if floor is not None:
+                sql += " AND rowid >= ?"
+                parameters.append(floor[0])
+
+        if after is not None:
+            sql += " AND (rank > ? OR (rank = ? AND rowid > ?))"
+            parameters += [after[0], after[0], after[1]]
+        sql += " ORDER BY rank, rowid LIMIT ?"
+        parameters.append(limit)
+        return connection.execute(sql, parameters).fetchall()
+
+    def clear(self, index):
+        self._connections.get().execute('DROP TABLE IF EXISTS "%s"' % index)
+
+
+class ElasticsearchBackend(object):
+    """A backend that stores each index in an Elasticsearch cluster."""
+
+    def __init__(self, url):
+        from elasticsearch import Elasticsearch, helpers
+
+        self.es = Elasticsearch(url)
+        self.helpers = helpers
+
+    def add(self, index, id, fields):
+        self.es.index(index=index, id=id, body=dict(fields, id=id))
+
+    def add_many(self, index, rows):
+        self.helpers.bulk(
+            self.es,
+            (
+                {"_index": index, "_id": id, "_source": dict(fields, id=id)}
+                for id, fields in rows
+            ),
+        )
+
+    def remove(self, index, id):
+        self.es.delete(index=index, id=id, ignore=404)
+
+    def query(self, index, text, limit, after=None):
+        # The id is also stored as a field, since sorting on `_id` is slow
+        body = {
+            "query": {"multi_match": {"query": text, "fields": ["*"]}},
+            "sort": [{"_score": "desc"}, {"id": "asc"}],
+            "size": limit,
+        }
+        if after is not None:
+            body["search_after"] = [after[0], after[1]]
+        result = self.es.search(index=index, body=body, ignore=404)
+        hits = result.get("hits", {}).get("hits", [])
+        return [(int(hit["_id"]), hit["_score"]) for hit in hits]
+
+    def clear(self, index):
+        self.es.indices.delete(index=index, ignore=404)
+
+
+class SearchIndex(object):
+    def __init__(self, app=None):
+        self.app = None
+        self._backend = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault("SEARCH_BACKEND", "sqlite")
+        app.config.setdefault("SEARCH_PATH", "search.db")
+        app.config.setdefault("SEARCH_MAX_CANDIDATES", 10000)
+        app.config.setdefault("ELASTICSEARCH_URL", None)
+        app.extensions["search"] = self
+        self.reset()
+
+    @property
+    def backend(self):
+        """The configured backend, which is set up on first use."""
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    self._backend = self._create_backend()
+        return self._backend
+
+    def _create_backend(self):
+        backend = self.app.config["SEARCH_BACKEND"]
+        if backend == "sqlite":
+            return SQLiteBackend(
+                self.app.config["SEARCH_PATH"],
+                self.app.config["SEARCH_MAX_CANDIDATES"],
+            )
+        elif backend == "elasticsearch":
+            return ElasticsearchBackend(self.app.config["ELASTICSEARCH_URL"])
+        elif backend == "null":
+            return NullBackend()
+        raise ValueError("Unknown SEARCH_BACKEND %r" % backend)
+
+    def reset(self):
+        """Forget the backend, so that it is set up again from the config."""
+        self._backend = None
+
+    def after_fork(self):
+        # The connections of the parent can't be used in a forked process
+        self._lock = threading.Lock()
+        self.reset()
+
+    def add(self, index, id, fields):
+        self.backend.add(index, id, fields)
+
+    def add_many(self, index, rows):
+        self.backend.add_many(index, rows)
+
+    def remove(self, index, id):
+        self.backend.remove(index, id)
+
+    def query(self, index, text, limit, after=None):
+        return self.backend.query(index, text, limit, after)
+
+    def clear(self, index):
+        self.backend.clear(index)
@@ -0,0 +1,325 @@
+"""
+Bulk loading of users, posts and follower edges.
+
+Building `User` and `Post` objects one at a time goes through the session's
+unit of work for every row, and `set_password()` hashes one password at a
+time. The functions here instead stream rows in chunks of `chunk_size` and
+insert each chunk with a single Core executemany INSERT. Passwords can be
+hashed in a pool of processes, a chunk at a time, and the secondary indexes of
+the tables (other than the unique ones) can be dropped during the load and
+built once at the end, which is much faster than updating them row by row.
+
+Rows come either from CSV or JSON Lines files (see `read_records()`), or from
+the synthetic social graph generator, `generate()`. Either way, the
+denormalized counters, the materialized timelines and the search index are
+rebuilt afterwards by `finish()`.
+
+These are used by the `flask data` commands in `app/cli.py`.
+"""
+
+import csv
+import json
+import multiprocessing
+import random
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta
+from itertools import accumulate, islice, repeat
+
+from flask import current_app
+from werkzeug.security import generate_password_hash
+
+from app import db, passwords
+from app import timeline as timelines
+from app.models import Post, User, email_digest, followers, reconcile_counters
+
+
+def chunked(rows, size):
+    """Split the iterable `rows` into lists of at most `size` rows."""
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def read_records(path):
+    """
+    Yield the records in `path` as dictionaries. Files ending in `.csv` are
+    read as CSV with a header row; anything else as JSON Lines.
+    """
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.endswith(".csv"):
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def insert(table, rows, chunk_size):
+    """Insert `rows` into `table` in chunks, and return the number of rows."""
+    count = 0
+    for chunk in chunked(rows, chunk_size):
+        with db.engine.begin() as connection:
+            connection.execute(table.insert(), chunk)
+        count += len(chunk)
+    return count
+
+
+@contextmanager
+def deferred_indexes(*tables):
+    """
+    Drop the secondary indexes of `tables` for the duration of the block, and
+    build them again at the end. Unique indexes are kept, since the chunks are
+    committed as they go: a duplicate found only at the end would already be
+    in the table, and the index could not be built again.
+    """
+    indexes = [index for table in tables for index in table.indexes if not index.unique]
+    for index in indexes:
+        index.drop(db.engine, checkfirst=True)
+    try:
+        yield
+    finally:
+        # An index that can't be built doesn't keep the others from being
+        # built. The first error is raised once they all were tried.
+        error = None
+        for index in indexes:
+            try:
+                index.create(db.engine, checkfirst=True)
+            except Exception as e:
+                current_app.logger.exception("Failed to build index %s", index.name)
+                error = error or e
+        if error is not None:
+            raise error
+
+
+@contextmanager
+def password_pool(workers):
+    """
+    A function that hashes a chunk of passwords, in `workers` processes (or in
+    this one, if `workers` is 0).
+    """
+    method = passwords.method
+    salt_length = current_app.config["PASSWORD_HASH_SALT_LENGTH"]
+    if not workers:
+        yield lambda chunk: [
+            generate_password_hash(password, method, salt_length) for password in chunk
+        ]
+        return
+
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(workers, mp_context=context) as executor:
+        yield lambda chunk: list(
+            executor.map(
+                generate_password_hash,
+                chunk,
+                repeat(method),
+                repeat(salt_length),
+                chunksize=max(len(chunk) // (workers * 4), 1),
+            )
+        )
+
+
+def _parse_timestamp(value):
+    if not value or isinstance(value, datetime):
+        return value or None
+    return datetime.fromisoformat(value.rstrip("Z"))
+
+
+def _user_values(records, hash_chunk, chunk_size):
+    """Turn user records into rows for the `user` table."""
+    for chunk in chunked(records, chunk_size):
+        plain = [r for r in chunk if r.get("password") and not r.get("password_hash")]
+        hashes = dict(zip(map(id, plain), hash_chunk([r["password"] for r in plain])))
+        for record in chunk:
+            row = {
+                "username": record["username"],
+                "email": record["email"],
+                "email_digest": email_digest(record["email"]),
+                "about_me": record.get("about_me") or None,
+                "password_hash": record.get("password_hash") or hashes.get(id(record)),
+                "last_seen": _parse_timestamp(record.get("last_seen")),
+            }
+            if record.get("id"):
+                row["id"] = int(record["id"])
+            yield row
+
+
+def _user_ids():
+    """Map each username to its id."""
+    return dict(db.session.query(User.username, User.id))
+
+
+def _resolve(record, id_key, name_key, ids):
+    if record.get(id_key):
+        return int(record[id_key])
+    return ids[record[name_key]]
+
+
+def _post_values(records, ids):
+    """
+    Turn post records into rows for the `post` table. The author is given as
+    `user_id`, or as `username`.
+    """
+    for record in records:
+        row = {
+            "body": record["body"],
+            "timestamp": _parse_timestamp(record.get("timestamp")) or datetime.utcnow(),
+            "user_id": _resolve(record, "user_id", "username", ids),
+        }
+        if record.get("id"):
+            row["id"] = int(record["id"])
+        yield row
+
+
+def _follower_values(records, ids):
+    """
+    Turn follower records into rows for the `followers` table. Each user is
+    given as `follower_id`/`followed_id`, or as `follower`/`followed` names.
+    """
+    for record in records:
+        yield {
+            "follower_id": _resolve(record, "follower_id", "follower", ids),
+            "followed_id": _resolve(record, "followed_id", "followed", ids),
+        }
+
+
+def import_files(
+    users=None,
+    posts=None,
+    edges=None,
+    chunk_size=5000,
+    hash_workers=0,
+    defer=False,
+):
+    """
+    Load the user, post and follower files that are given, in that order, and
+    return the number of rows inserted into each table.
+    """
+    tables = (User.__table__, Post.__table__, followers)
+    counts = {"users": 0, "posts": 0, "followers": 0}
+    with deferred_indexes(*tables) if defer else nullcontext():
+        if users:
+            with password_pool(hash_workers) as hash_chunk:
+                rows = _user_values(read_records(users), hash_chunk, chunk_size)
+                counts["users"] = insert(User.__table__, rows, chunk_size)
+
+        ids = _user_ids() if posts or edges else {}
+        if posts:
+            rows = _post_values(read_records(posts), ids)
+            counts["posts"] = insert(Post.__table__, rows, chunk_size)
+        if edges:
+            rows = _follower_values(read_records(edges), ids)
+            counts["followers"] = insert(followers, rows, chunk_size)
+    return counts
+
+
+def _zipf_weights(count, exponent):
+    """
+    Cumulative weights for picking one of `count` users, where the user at
+    rank `k` is picked with probability proportional to `1 / k**exponent`.
+    """
+    return list(accumulate(1 / (rank**exponent) for rank in range(1, count + 1)))
+
+
+def _pick(rng, cumulative, k):
+    """Pick `k` distinct indexes, weighted by the `cumulative` weights."""
+    total = cumulative[-1]
+    picked = set()
+
+    # Picking most of the users by weight would take forever, since the
+    # least popular ones are very unlikely to be picked.
+    k = min(k, len(cumulative) // 4)
+    while len(picked) < k:
+        picked.add(bisect_left(cumulative, rng.random() * total))
+    return picked
+
+
+def generate(
+    users,
+    posts,
+    mean_follows=20,
+    exponent=1.0,
+    password="password",
+    days=30,
+    chunk_size=5000,
+    defer=False,
+    seed=None,
+):
+    """
+    Insert a synthetic social graph of `users` users and `posts` posts, and
+    return the number of rows inserted into each table.
+
+    How many users each user follows is drawn from a Pareto distribution with
+    mean `mean_follows`. Whom they follow is drawn from a Zipf distribution
+    with `exponent` over a random ranking of the users, so that follower
+    counts follow a power law, with a few very popular users and a long tail.
+    Posts are spread over the last `days` days, with authors drawn from the
+    same Zipf distribution, so popular users also post more.
+    """
+    rng = random.Random(seed)
+    start = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+    ids = list(range(start, start + users))
+    ranking = ids[:]
+    rng.shuffle(ranking)
+    cumulative = _zipf_weights(users, exponent)
+
+    # Every user gets the same password, which is only hashed once
+    password_hash = passwords.hash(password)
+
+    def user_rows():
+        for id in ids:
+            username = "user%d" % id
+            email = "%s@example.com" % username
+            yield {
+                "id": id,
+                "username": username,
+                "email": email,
+                "email_digest": email_digest(email),
+                "password_hash": password_hash,
+            }
+
+    def follower_rows():
+        # A Pareto distribution with shape `a` has mean `a / (a - 1)`
+        shape = 2.0
+        scale = mean_follows * (shape - 1) / shape
+        for follower in ids:
+            k = int(scale * rng.paretovariate(shape))
+            for index in _pick(rng, cumulative, k):
+                followed = ranking[index]
+                if followed != follower:
+                    yield {"follower_id": follower, "followed_id": followed}
+
+    def post_rows():
+        now = datetime.utcnow()
+        total = cumulative[-1]
+        for i in range(posts):
+            author = ranking[bisect_left(cumulative, rng.random() * total)]
+            yield {
+                "body": "Post %d from user%d" % (i, author),
+                "timestamp": now - timedelta(seconds=rng.random() * days * 86400),
+                "user_id": author,
+            }
+
+    tables = (User.__table__, Post.__table__, followers)
+    with deferred_indexes(*tables) if defer else nullcontext():
+        return {
+            "users": insert(User.__table__, user_rows(), chunk_size),
+            "followers": insert(followers, follower_rows(), chunk_size),
+            "posts": insert(Post.__table__, post_rows(), chunk_size),
+        }
+
+
+def finish():
+    """
+    Rebuild everything that is derived from the users, posts and followers:
+    the counters, the materialized timelines and the search index.
+    """
+    reconcile_counters()
+    if timelines.enabled():
+        timelines.rebuild()
+    db.session.commit()
+    Post.reindex()
@@ -0,0 +1,34 @@
+"""
+Connections to the SQLite files that the response cache, the search index and
+the post stream keep next to the main database.
+"""
+
+import sqlite3
+import threading
+
+
+class LocalConnections(object):
+    """
+    One connection to the SQLite file at `path` for each thread, in
+    autocommit and WAL mode, opened on first use.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def get(self):
+        """Return the connection of the current thread."""
+
+        # SQLite connections can't be shared between threads
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def after_fork(self):
+        # The connections of the parent can't be used in a forked process
+        self._local = threading.local()
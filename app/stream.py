@@ -0,0 +1,331 @@
+"""
+Live notifications of new posts, over Server-Sent Events.
+
+A browser on the home page (or on `/explore`) keeps a connection open to
+`/stream`, and `PostStream` writes the HTML of each new post by a followed
+user (or by anyone) to it as soon as it is published, so that nobody has to
+reload the feed to see it.
+
+Events are kept by a `Hub` in each process, which holds the last
+`STREAM_BACKLOG` of them. Every connection waits on the hub, and when woken
+up, picks the events it wants. Each event has an increasing id, which the
+browser sends back as `Last-Event-ID` when it reconnects, so whatever it
+missed meanwhile is sent first. If that is no longer in the backlog, a
+"reset" event tells the client that it has missed something.
+
+Events reach the hub through a backend, chosen with `STREAM_BACKEND`:
+
+ - "memory": events are only seen by connections to the same process
+ - "sqlite": events are written to a SQLite file at `STREAM_PATH`, which a
+   thread in each process polls every `STREAM_POLL_INTERVAL` milliseconds,
+   for servers with several processes on the same machine
+
+A connection that has nothing to send writes a comment every
+`STREAM_HEARTBEAT` seconds, which keeps proxies from closing it, and lets the
+server notice that the client is gone. Idle connections cost no CPU, but with
+the default threaded workers each one holds a thread. To hold thousands of
+them, run the server with gevent workers (e.g.,
+`gunicorn -k gevent --worker-connections 5000 flaskapp:app`), where the
+hub's locks are turned into cooperative ones.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from collections import deque, namedtuple
+
+from app.sqlite import LocalConnections
+
+Event = namedtuple("Event", ["id", "kind", "data"])
+
+
+def message(data, event=None, id=None):
+    """Format a Server-Sent Events message."""
+    lines = []
+    if id is not None:
+        lines.append("id: %d" % id)
+    if event is not None:
+        lines.append("event: %s" % event)
+    lines.append("data: %s" % json.dumps(data, separators=(",", ":")))
+    return "\n".join(lines) + "\n\n"
+
+
+class Hub(object):
+    """The latest events, which the connections of one process wait for."""
+
+    def __init__(self, backlog=1000, last_id=0):
+        self._events = deque(maxlen=backlog)
+        self._condition = threading.Condition()
+
+        # Events up to `floor` aren't kept, so a client can only resume from
+        # `floor` or later.
+        self.floor = self.last_id = last_id
+
+    def append(self, kind, data):
+        """Add an event with the next id, and return it."""
+        with self._condition:
+            event = Event(self.last_id + 1, kind, data)
+            self._add(event)
+            self._condition.notify_all()
+        return event
+
+    def deliver(self, events):
+        """Add events whose ids were given elsewhere."""
+        with self._condition:
+            for event in events:
+                if event.id > self.last_id:
+                    self._add(event)
+            self._condition.notify_all()
+
+    def _add(self, event):
+        if len(self._events) == self._events.maxlen:
+            self.floor = self._events[0].id
+        self._events.append(event)
+        self.last_id = event.id
+
+    def since(self, last_id):
+        """
+        Return the events after `last_id`, or None if some of them are no
+        longer kept.
+        """
+        with self._condition:
+            return self._since(last_id)
+
+    def wait(self, last_id, timeout):
+        """
+        Wait up to `timeout` seconds for an event after `last_id`, and return
+        them all, as `since()` does.
+        """
+        with self._condition:
+            if last_id == self.last_id:
+                self._condition.wait(timeout)
+            return self._since(last_id)
+
+    def _since(self, last_id):
+        if not self.floor <= last_id <= self.last_id:
+            return None
+        events = []
+        for event in reversed(self._events):
+            if event.id <= last_id:
+                break
+            events.append(event)
+        events.reverse()
+        return events
+
+    def after_fork(self):
+        self._condition = threading.Condition()
+
+
+class MemoryBackend(object):
+    """Events are only seen in the process that publishes them."""
+
+    def __init__(self, backlog):
+        # Ids carry on from a previous run of the server (unless it saw more
+        # than a thousand events a second), so that clients which were
+        # connected to it are told that they missed something.
+        self.hub = Hub(backlog, last_id=int(time.time() * 1000))
+
+    def publish(self, kind, data):
+        self.hub.append(kind, data)
+
+    def start(self):
+        pass
+
+    def after_fork(self):
+        self.hub.after_fork()
+
+
+class SQLiteBackend(object):
+    """
+    Events are stored in a SQLite file, and each process polls it for new
+    ones. Only the last `backlog * 10` events are kept.
+    """
+
+    def __init__(self, path, backlog, poll_interval=500):
+        self.path = path
+        self.backlog = backlog
+        self.poll_interval = poll_interval / 1000
+        self.hub = None
+        self._connections = LocalConnections(path)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._writes = 0
+        self._connections.get().execute(
+            "CREATE TABLE IF NOT EXISTS events "
+            "(id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT, data TEXT)"
+        )
+
+    def publish(self, kind, data):
+        connection = self._connections.get()
+        cursor = connection.execute(
+            "INSERT INTO events (kind, data) VALUES (?, ?)", (kind, json.dumps(data))
+        )
+        self._writes += 1
+        if self._writes % self.backlog == 0:
+            connection.execute(
+                "DELETE FROM events WHERE id <= ?",
+                (cursor.lastrowid - self.backlog * 10,),
+            )
+        self._wake.set()
+
+    def start(self):
+        """Load the latest events, and start polling for new ones."""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            rows = (
+                self._connections.get()
+                .execute(
+                    "SELECT id, kind, data FROM events ORDER BY id DESC LIMIT ?",
+                    (self.backlog,),
+                )
+                .fetchall()
+            )
+            rows.reverse()
+            if len(rows) == self.backlog:
+                floor = rows[0][0] - 1
+            else:
+                floor = 0
+            self.hub = Hub(self.backlog, last_id=floor)
+            self.hub.deliver(
+                Event(id, kind, json.loads(data)) for id, kind, data in rows
+            )
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def poll(self):
+        """Pass the events published since the last poll on to the hub."""
+        rows = self._connections.get().execute(
+            "SELECT id, kind, data FROM events WHERE id > ? ORDER BY id LIMIT ?",
+            (self.hub.last_id, self.backlog),
+        )
+        events = [Event(id, kind, json.loads(data)) for id, kind, data in rows]
+        if events:
+            self.hub.deliver(events)
+        return len(events)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            try:
+                # Catch up in batches
+                while self.poll() == self.backlog:
+                    pass
+            except sqlite3.Error:
+                time.sleep(self.poll_interval)
+
+    def after_fork(self):
+        # The poller isn't copied into the child, which starts its own
+        self._connections.after_fork()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self.hub = None
+
+
+class PostStream(object):
+    def __init__(self, app=None):
+        self.backend = None
+        self.heartbeat = 15
+        self.retry = 3000
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("STREAM_BACKEND", "memory")
+        app.config.setdefault("STREAM_BACKLOG", 1000)
+        app.config.setdefault("STREAM_HEARTBEAT", 15)
+        app.config.setdefault("STREAM_RETRY", 3000)
+        app.config.setdefault("STREAM_PATH", "stream.db")
+        app.config.setdefault("STREAM_POLL_INTERVAL", 500)
+        app.extensions["post_stream"] = self
+
+        self.heartbeat = app.config["STREAM_HEARTBEAT"]
+        self.retry = app.config["STREAM_RETRY"]
+        backend = app.config["STREAM_BACKEND"]
+        if backend == "memory":
+            self.backend = MemoryBackend(app.config["STREAM_BACKLOG"])
+        elif backend == "sqlite":
+            self.backend = SQLiteBackend(
+                app.config["STREAM_PATH"],
+                app.config["STREAM_BACKLOG"],
+                app.config["STREAM_POLL_INTERVAL"],
+            )
+        else:
+            raise ValueError("Unknown STREAM_BACKEND %r" % backend)
+
+    @property
+    def hub(self):
+        self.backend.start()
+        return self.backend.hub
+
+    def publish_post(self, post, html):
+        """Send a new post, and the HTML to show it with, to the clients."""
+        self.backend.publish(
+            "post", {"id": post.id, "author_id": post.user_id, "html": str(html)}
+        )
+
+    def publish_follow(self, follower, followed, following=True):
+        """Tell the open connections of `follower` which posts they now want."""
+        self.backend.publish(
+            "follow",
+            {
+                "follower_id": follower.id,
+                "followed_id": followed.id,
+                "following": following,
+            },
+        )
+
+    def events(self, user_id, followed=None, last_id=None):
+        """
+        Generate the stream of the user with id `user_id`, which shows the
+        posts of the users with ids in `followed`, or with None, those of
+        everybody. Starts after the event `last_id`, or with new events.
+        """
+        hub = self.hub
+        if last_id is None:
+            last_id = hub.last_id
+        yield "retry: %d\n\n" % self.retry
+        written = time.monotonic()
+
+        while True:
+            # Events for other clients don't count: the heartbeat is due
+            # whenever nothing was written to this one for a while
+            timeout = max(0, written + self.heartbeat - time.monotonic())
+            events = hub.wait(last_id, timeout)
+            if events is None:
+                last_id = hub.last_id
+                yield message({}, event="reset", id=last_id)
+                written = time.monotonic()
+                continue
+
+            for event in events:
+                last_id = event.id
+                data = event.data
+                if event.kind == "post":
+                    if followed is None or data["author_id"] in followed:
+                        yield message(
+                            {"id": data["id"], "html": data["html"]},
+                            event="post",
+                            id=event.id,
+                        )
+                        written = time.monotonic()
+                elif event.kind == "follow" and followed is not None:
+                    if data["follower_id"] != user_id:
+                        continue
+                    if data["following"]:
+                        followed.add(data["followed_id"])
+                    else:
+                        followed.discard(data["followed_id"])
+
+            if time.monotonic() - written >= self.heartbeat:
+                yield ": heartbeat\n\n"
+                written = time.monotonic()
+
+    def after_fork(self):
+        self.backend.after_fork()
@@ -0,0 +1,176 @@
+"""
+Materialized home timelines (fan-out-on-write).
+
+Instead of building the home page with the UNION query in
+`User.followed_posts()` on every request, each new post is pushed into a
+`TimelineEntry` row for its author and for every one of the author's
+followers. The home page then only has to read the rows that belong to the
+current user.
+
+Authors with more than `TIMELINE_FANOUT_MAX_FOLLOWERS` followers are not
+pushed, since a single post from them would write that many rows. Their posts
+are pulled at read time instead, which makes this a hybrid push/pull model.
+When an unfollow brings an author back down to the threshold, the posts that
+weren't pushed meanwhile are written to the timelines of their followers.
+
+All functions here are no-ops (or fall back to `followed_posts()`) unless
+`TIMELINE_FANOUT` is enabled. They only add statements to the current session;
+the caller is responsible for committing.
+"""
+
+from flask import current_app
+from sqlalchemy import literal, select, union
+
+from app import db
+from app.models import Post, TimelineEntry, User, followers
+
+
+def enabled():
+    return current_app.config["TIMELINE_FANOUT"]
+
+
+def _pull_authors():
+    """
+    Return a subquery of the ids of users whose posts are pulled at read time
+    rather than pushed into timelines.
+    """
+    threshold = current_app.config["TIMELINE_FANOUT_MAX_FOLLOWERS"]
+    return select(User.id).where(User.follower_count > threshold)
+
+
+def is_pull_author(user):
+    """Return True if `user` has too many followers to fan out to."""
+    threshold = current_app.config["TIMELINE_FANOUT_MAX_FOLLOWERS"]
+
+    # Read the counter from the database, since the one on `user` may have
+    # been changed in this session and not flushed yet.
+    count = db.session.query(User.follower_count).filter_by(id=user.id).scalar()
+    return count > threshold
+
+
+def push_post(post):
+    """
+    Add a new post to the timeline of its author, and to the timelines of the
+    author's followers unless the author is a pull author. The post must have
+    been flushed so that it has an id.
+    """
+    if not enabled():
+        return
+
+    entries = TimelineEntry.__table__
+    db.session.execute(entries.insert().values(user_id=post.user_id, post_id=post.id))
+
+    if is_pull_author(post.author):
+        return
+
+    fan_out = (
+        select(followers.c.follower_id, literal(post.id))
+        .where(followers.c.followed_id == post.user_id)
+        .where(followers.c.follower_id != post.user_id)
+    )
+    db.session.execute(entries.insert().from_select(["user_id", "post_id"], fan_out))
+
+
+def backfill(follower, followed):
+    """Copy the posts of `followed` into the timeline of `follower`."""
+    if not enabled() or is_pull_author(followed):
+        return
+
+    # Prune first so that backfilling an existing follow is harmless.
+    prune(follower, followed)
+    entries = TimelineEntry.__table__
+    posts = select(literal(follower.id), Post.id).where(Post.user_id == followed.id)
+    db.session.execute(entries.insert().from_select(["user_id", "post_id"], posts))
+
+
+def prune(follower, followed):
+    """
+    Remove the posts of `followed` from the timeline of `follower`, and if
+    `followed` is no longer a pull author, push their posts to their other
+    followers.
+    """
+    if not enabled():
+        return
+
+    entries = TimelineEntry.__table__
+    posts = select(Post.id).where(Post.user_id == followed.id)
+    db.session.execute(
+        entries.delete()
+        .where(entries.c.user_id == follower.id)
+        .where(entries.c.post_id.in_(posts))
+    )
+
+    # An unfollow takes one follower away, so this is when an author comes
+    # back down to the threshold
+    threshold = current_app.config["TIMELINE_FANOUT_MAX_FOLLOWERS"]
+    count = db.session.query(User.follower_count).filter_by(id=followed.id).scalar()
+    if count == threshold:
+        push_missing(followed)
+
+
+def push_missing(author):
+    """
+    Add the posts of `author` that were pulled rather than pushed to the
+    timelines of the author's followers.
+    """
+    entries = TimelineEntry.__table__
+    pushed = select(entries.c.post_id).where(
+        entries.c.user_id == followers.c.follower_id, entries.c.post_id == Post.id
+    )
+    missing = (
+        select(followers.c.follower_id, Post.id)
+        .select_from(
+            followers.join(Post.__table__, Post.user_id == followers.c.followed_id)
+        )
+        .where(followers.c.followed_id == author.id)
+        .where(followers.c.follower_id != author.id)
+        .where(~pushed.exists())
+    )
+    db.session.execute(entries.insert().from_select(["user_id", "post_id"], missing))
+
+
+def home_posts(user):
+    """
+    Return a query of the posts on the home page of `user`, sorted by most
+    recent date. Equivalent to `user.followed_posts()`.
+    """
+    if not enabled():
+        return user.followed_posts()
+
+    posts = Post.query.join(TimelineEntry, TimelineEntry.post_id == Post.id).filter(
+        TimelineEntry.user_id == user.id
+    )
+
+    # Only pay for the UNION when the user actually follows a pull author.
+    pulled = select(followers.c.followed_id).where(
+        followers.c.follower_id == user.id,
+        followers.c.followed_id.in_(_pull_authors()),
+    )
+    if db.session.query(pulled.exists()).scalar():
+        posts = posts.union(Post.query.filter(Post.user_id.in_(pulled)))
+
+    return posts.order_by(Post.timestamp.desc())
+
+
+def rebuild():
+    """
+    Regenerate every timeline from the `followers` and `post` tables, and
+    return the number of entries written. This is also needed after changing
+    `TIMELINE_FANOUT_MAX_FOLLOWERS`, or after enabling fan-out on a database
+    that already has posts.
+    """
+    entries = TimelineEntry.__table__
+    db.session.execute(entries.delete())
+
+    own = select(Post.user_id, Post.id)
+    pushed = (
+        select(followers.c.follower_id, Post.id)
+        .select_from(
+            followers.join(Post.__table__, Post.user_id == followers.c.followed_id)
+        )
+        .where(followers.c.followed_id.not_in(_pull_authors()))
+    )
+    db.session.execute(
+        entries.insert().from_select(["user_id", "post_id"], union(own, pushed))
+    )
+    return db.session.query(TimelineEntry).count()
@@ -0,0 +1,88 @@
+"""
+Compare rendering a page of posts from ORM objects with rendering it from the
+lightweight records in `app/rows.py`, at several page sizes. For each, prints
+the median time to query and render one page, and the peak memory allocated
+while doing so. For example:
+
+    python benchmarks/bench_feed_rows.py --sizes 3 50 500 --repeat 20
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[3, 50, 500])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--posts", type=int, default=2000)
+    args = parser.parse_args()
+
+    os.environ["DATABASE_URI"] = "sqlite://"
+    # Keep the log of the application out of the repository
+    directory = tempfile.TemporaryDirectory()
+    os.environ["LOG_PATH"] = os.path.join(directory.name, "microblog.log")
+    from sqlalchemy.orm import selectinload
+
+    from app import create_app, db
+    from app.feeds import render_feed
+    from app.models import Post, User
+    from app.pagination import paginate_posts
+
+    app = create_app()
+    app.app_context().push()
+    db.create_all()
+    users = [
+        User(username="user%d" % i, email="user%d@example.com" % i)
+        for i in range(args.users)
+    ]
+    db.session.add_all(users)
+    now = datetime.utcnow()
+    db.session.add_all(
+        Post(
+            body="post %d" % i,
+            author=users[i % len(users)],
+            timestamp=now - timedelta(seconds=i),
+        )
+        for i in range(args.posts)
+    )
+    db.session.commit()
+
+    def orm(size):
+        query = Post.query.options(selectinload(Post.author))
+        return render_feed(paginate_posts(query, size, page=1), "main.explore")
+
+    def rows(size):
+        return render_feed(
+            paginate_posts(Post.query, size, page=1, rows=True), "main.explore"
+        )
+
+    print("%-6s %6s %12s %12s" % ("path", "size", "median ms", "peak KiB"))
+    for size in args.sizes:
+        for name, render in (("orm", orm), ("rows", rows)):
+            times = []
+            peak = 0
+            for _ in range(args.repeat):
+                with app.test_request_context("/explore"):
+                    db.session.remove()
+                    tracemalloc.start()
+                    start = time.perf_counter()
+                    render(size)
+                    times.append(time.perf_counter() - start)
+                    peak = max(peak, tracemalloc.get_traced_memory()[1])
+                    tracemalloc.stop()
+            median = statistics.median(times) * 1000
+            print("%-6s %6d %12.2f %12.1f" % (name, size, median, peak / 1024))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Measure the time to render one page of posts with `render_feed()`, at several
+page sizes, with the fragment cache off, empty ("cold", as for a page nobody
+has seen yet), and holding every post on the page ("warm"). The posts are
+loaded beforehand, so only the rendering is timed. For example:
+
+    python benchmarks/bench_fragments.py --sizes 3 10 50 100 500 --repeat 50
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[3, 10, 50, 100, 500])
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--users", type=int, default=100)
+    args = parser.parse_args()
+
+    os.environ["DATABASE_URI"] = "sqlite://"
+    # Keep the log of the application out of the repository
+    directory = tempfile.TemporaryDirectory()
+    os.environ["LOG_PATH"] = os.path.join(directory.name, "microblog.log")
+    from app import create_app, db, fragments
+    from app.feeds import render_feed
+    from app.models import Post, User
+    from app.pagination import paginate_posts
+
+    app = create_app()
+    app.app_context().push()
+    db.create_all()
+    users = [
+        User(username="user%d" % i, email="user%d@example.com" % i)
+        for i in range(args.users)
+    ]
+    db.session.add_all(users)
+    now = datetime.utcnow()
+    db.session.add_all(
+        Post(
+            body="post %d" % i,
+            author=users[i % len(users)],
+            timestamp=now - timedelta(seconds=i),
+        )
+        for i in range(max(args.sizes))
+    )
+    db.session.commit()
+
+    def measure(posts, max_bytes, clear):
+        fragments.max_bytes = max_bytes
+        fragments.clear()
+        times = []
+        with app.test_request_context("/explore"):
+            render_feed(posts, "main.explore")
+            for _ in range(args.repeat):
+                if clear:
+                    fragments.clear()
+                start = time.perf_counter()
+                render_feed(posts, "main.explore")
+                times.append(time.perf_counter() - start)
+        return statistics.median(times) * 1000
+
+    size_limit = app.config["FRAGMENT_CACHE_SIZE"]
+    print(
+        "%6s %10s %10s %10s %10s" % ("size", "off ms", "cold ms", "warm ms", "warm/off")
+    )
+    for size in args.sizes:
+        with app.test_request_context("/explore"):
+            posts = paginate_posts(Post.query, size, page=1, rows=True)
+        off = measure(posts, 0, False)
+        cold = measure(posts, size_limit, True)
+        warm = measure(posts, size_limit, False)
+        print(
+            "%6d %10.2f %10.2f %10.2f %9.0f%%"
+            % (size, off, cold, warm, warm / off * 100)
+        )
+
+
+if __name__ == "__main__":
+    main()
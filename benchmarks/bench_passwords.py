@@ -0,0 +1,87 @@
+"""
+Measure how many logins per second the server can check, per CPU core.
+
+Each login is a full POST to `/login` through the test client, from several
+threads at once, against a throwaway SQLite database. For example:
+
+    python benchmarks/bench_passwords.py --threads 8 --logins 200
+    PASSWORD_HASH_METHOD=pbkdf2:sha256:600000 python benchmarks/bench_passwords.py
+
+Run it with `PASSWORD_HASH_WORKERS=0` to compare with hashing in the request
+threads.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--threads", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--logins", type=int, default=100, help="in total")
+    args = parser.parse_args()
+
+    handle, path = tempfile.mkstemp(suffix=".db")
+    os.close(handle)
+    os.environ["DATABASE_URI"] = "sqlite:///" + path
+    # Keep the log of the application out of the repository
+    directory = tempfile.TemporaryDirectory()
+    os.environ["LOG_PATH"] = os.path.join(directory.name, "microblog.log")
+
+    from app import create_app, db, last_seen, passwords
+    from app.models import User
+
+    app = create_app()
+    app.config["WTF_CSRF_ENABLED"] = False
+    app.app_context().push()
+    db.create_all()
+    for i in range(args.threads):
+        user = User(username="user%d" % i, email="user%d@example.com" % i)
+        user.set_password("password")
+        db.session.add(user)
+    db.session.commit()
+    db.session.remove()
+
+    def login(i, count, failures):
+        client = app.test_client()
+        for _ in range(count):
+            response = client.post(
+                "/login", data={"username": "user%d" % i, "password": "password"}
+            )
+            client.get("/logout")
+            if response.status_code != 302:
+                failures.append(response.status_code)
+
+    per_thread = max(args.logins // args.threads, 1)
+    failures = []
+    threads = [
+        threading.Thread(target=login, args=(i, per_thread, failures))
+        for i in range(args.threads)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    total = per_thread * args.threads
+    cores = os.cpu_count() or 1
+    print("method:          %s" % passwords.method)
+    print("hash workers:    %s" % app.config["PASSWORD_HASH_WORKERS"])
+    print("request threads: %d" % args.threads)
+    print("logins:          %d in %.2fs (%d failed)" % (total, elapsed, len(failures)))
+    print("logins/s:        %.1f" % (total / elapsed))
+    print("logins/s/core:   %.1f" % (total / elapsed / cores))
+    last_seen.flush()
+    os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Measure how long the application takes to start, and how much memory it
+holds once it has. Each command runs in a fresh interpreter, against a
+throwaway SQLite database, and reports the median wall time and the largest
+resident set size (RSS) across runs:
+
+ - `import app`, which should only create the extension objects
+ - `create_app()`, which loads the models, blueprints and templates
+ - `flask db current`, as every `flask` command pays for `create_app()`
+ - `flask run`, until the server answers its first request
+ - the test suite
+
+For example:
+
+    python benchmarks/bench_startup.py --repeat 5
+    python benchmarks/bench_startup.py --only import create_app
+"""
+
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_command(argv, env):
+    """Run `argv`, and return its wall time in seconds and its RSS in KiB."""
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        argv, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+    stderr = process.stderr.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        sys.stderr.write(stderr.decode(errors="replace"))
+        raise RuntimeError("%s exited with %d" % (" ".join(argv), process.returncode))
+
+    # `ru_maxrss` is in KiB on Linux
+    return elapsed, usage.ru_maxrss
+
+
+def rss(pid):
+    with open("/proc/%d/status" % pid) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run_server(env, timeout=60):
+    """
+    Start `flask run`, and return the time until it answered its first
+    request, and its RSS in KiB at that point.
+    """
+    port = free_port()
+    url = "http://127.0.0.1:%d/explore" % port
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "flask", "run", "--no-reload", "--port", str(port)],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while True:
+            try:
+                # Anything the server sends back counts, e.g. a redirect to
+                # the login page
+                urllib.request.urlopen(url, timeout=timeout)
+                break
+            except urllib.error.HTTPError:
+                break
+            except (urllib.error.URLError, ConnectionError):
+                if process.poll() is not None:
+                    raise RuntimeError("flask run exited with %d" % process.returncode)
+                if time.perf_counter() - start > timeout:
+                    raise RuntimeError("flask run didn't answer")
+                time.sleep(0.01)
+        return time.perf_counter() - start, rss(process.pid)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    commands = {
+        "import": lambda env: run_command([sys.executable, "-c", "import app"], env),
+        "create_app": lambda env: run_command(
+            [sys.executable, "-c", "from app import create_app; create_app()"], env
+        ),
+        "flask_db": lambda env: run_command(
+            [sys.executable, "-m", "flask", "db", "current"], env
+        ),
+        "flask_run": run_server,
+        "tests": lambda env: run_command(
+            [sys.executable, "-m", "unittest", "-q", "tests"], env
+        ),
+    }
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", nargs="+", choices=list(commands))
+    args = parser.parse_args()
+
+    directory = tempfile.TemporaryDirectory()
+    env = dict(
+        os.environ,
+        FLASK_APP="flaskapp.py",
+        FLASK_ENV="production",
+        DATABASE_URI="sqlite:///" + os.path.join(directory.name, "app.db"),
+        SEARCH_PATH=os.path.join(directory.name, "search.db"),
+        LOG_PATH=os.path.join(directory.name, "microblog.log"),
+        MAIL_QUEUE_WORKERS="0",
+    )
+    env.pop("MAIL_SERVER", None)
+
+    print("%-12s %12s %12s" % ("command", "median ms", "max RSS MiB"))
+    try:
+        for name, command in commands.items():
+            if args.only and name not in args.only:
+                continue
+            times = []
+            sizes = []
+            for _ in range(args.repeat):
+                elapsed, size = command(env)
+                times.append(elapsed)
+                sizes.append(size)
+            print(
+                "%-12s %12.1f %12.1f"
+                % (name, statistics.median(times) * 1000, max(sizes) / 1024)
+            )
+    finally:
+        directory.cleanup()
+
+
+if __name__ == "__main__":
+    main()
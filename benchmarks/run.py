@@ -0,0 +1,394 @@
+"""
+Benchmarks for the hot request paths.
+
+Seeds a throwaway SQLite database with a synthetic social graph (see
+`app/seed.py`), then drives each scenario through the Flask test client and
+reports p50/p95/p99 latency, SQL statements per request, and the peak memory
+allocated while handling one request. The response cache is disabled, so that
+every request does the full work.
+
+    python benchmarks/run.py run --users 2000 --posts 50000 --output base.json
+    python benchmarks/run.py run --output new.json --baseline base.json --threshold 15
+    python benchmarks/run.py compare base.json new.json --threshold 15
+
+`--threshold` is a percentage. A scenario regresses if its p95 latency grows
+by more than that, or if it runs more statements per request than before.
+Either command exits with status 1 if anything regressed, so that it can fail
+a build. Results are only comparable between runs with the same dataset
+options, which are saved along with them.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SCENARIOS = []
+
+
+def scenario(name):
+    """Register a function that sets up a scenario, and returns its request."""
+
+    def decorator(setup):
+        SCENARIOS.append((name, setup))
+        return setup
+
+    return decorator
+
+
+def login(client, user_id):
+    with client.session_transaction() as session:
+        session["_user_id"] = str(user_id)
+        session["_fresh"] = True
+
+
+@scenario("index")
+def index(env):
+    # The home page of a user that follows a typical number of users
+    client = env.app.test_client()
+    login(client, env.typical_user)
+    return lambda: client.get("/index")
+
+
+@scenario("index_heavy")
+def index_heavy(env):
+    # The home page of the user that follows the most users
+    client = env.app.test_client()
+    login(client, env.heavy_user)
+    return lambda: client.get("/index")
+
+
+@scenario("explore")
+def explore(env):
+    client = env.app.test_client()
+    login(client, env.typical_user)
+    return lambda: client.get("/explore")
+
+
+@scenario("explore_deep")
+def explore_deep(env):
+    # A page far into the explore list, reached by cursor
+    from app.models import Post
+    from app.pagination import post_cursor
+
+    client = env.app.test_client()
+    login(client, env.typical_user)
+    offset = min(100 * env.app.config["POSTS_PER_PAGE"], env.posts - 1)
+    with env.app.app_context():
+        post = (
+            Post.query.order_by(Post.timestamp.desc(), Post.id.desc())
+            .offset(offset)
+            .first()
+        )
+        url = "/explore?before=" + post_cursor(post)
+    return lambda: client.get(url)
+
+
+@scenario("user")
+def user(env):
+    client = env.app.test_client()
+    login(client, env.typical_user)
+    url = "/user/" + env.popular_username
+    return lambda: client.get(url)
+
+
+@scenario("search")
+def search(env):
+    client = env.app.test_client()
+    login(client, env.typical_user)
+    return lambda: client.get("/search?q=post")
+
+
+@scenario("login")
+def login_scenario(env):
+    # A full password check, from a client without a session
+    data = {"username": env.typical_username, "password": env.password}
+
+    def run():
+        response = env.app.test_client().post("/login", data=data)
+        if response.status_code != 302:
+            raise RuntimeError("Login failed")
+        return response
+
+    return run
+
+
+@scenario("followed_posts")
+def followed_posts(env):
+    # The model query alone, without the view or the template
+    from app.models import User
+
+    def run():
+        with env.app.app_context():
+            user = User.query.get(env.heavy_user)
+            user.followed_posts().limit(env.app.config["POSTS_PER_PAGE"]).all()
+
+    return run
+
+
+@scenario("feed_template")
+def feed_template(env):
+    # Rendering `_feed.html` alone, from rows that are already loaded
+    from app.feeds import render_feed
+    from app.models import Post
+    from app.pagination import paginate_posts
+
+    with env.app.test_request_context("/explore"):
+        posts = paginate_posts(
+            Post.query, env.app.config["POSTS_PER_PAGE"], page=1, rows=True
+        )
+
+    def run():
+        with env.app.test_request_context("/explore"):
+            render_feed(posts, "main.explore")
+
+    return run
+
+
+class Environment(object):
+    """The seeded app, and a few users chosen for the scenarios."""
+
+    def __init__(self, args):
+        from app import create_app, db, seed
+        from app.models import User
+
+        self.app = app = create_app()
+        self.posts = args.posts
+        self.password = "password"
+        app.config["WTF_CSRF_ENABLED"] = False
+        if args.per_page:
+            app.config["POSTS_PER_PAGE"] = args.per_page
+
+        with app.app_context():
+            db.create_all()
+            seed.generate(
+                args.users,
+                args.posts,
+                mean_follows=args.mean_follows,
+                password=self.password,
+                seed=args.seed,
+            )
+            seed.finish()
+
+            by_followed = User.query.order_by(User.followed_count, User.id).all()
+            typical = by_followed[len(by_followed) // 2]
+            self.typical_user = typical.id
+            self.typical_username = typical.username
+            self.heavy_user = by_followed[-1].id
+            self.popular_username = (
+                User.query.order_by(User.follower_count.desc()).first().username
+            )
+            db.session.remove()
+
+
+def percentile(values, p):
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1]
+
+
+def measure(env, request, repeat, warmup):
+    """Run `request` and return its statistics."""
+    from app import db
+
+    for _ in range(warmup):
+        request()
+
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    times = []
+    queries = []
+    with env.app.app_context():
+        engine = db.engine
+    db.event.listen(engine, "before_cursor_execute", count)
+    try:
+        for _ in range(repeat):
+            del statements[:]
+            start = time.perf_counter()
+            response = request()
+            times.append(time.perf_counter() - start)
+            queries.append(len(statements))
+            if response is not None and response.status_code >= 400:
+                raise RuntimeError("Request failed with %d" % response.status_code)
+    finally:
+        db.event.remove(engine, "before_cursor_execute", count)
+
+    # Allocations are measured in a separate pass, since tracing them slows
+    # everything down.
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(min(repeat, 20)):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            request()
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "requests": repeat,
+        "p50_ms": percentile(times, 50) * 1000,
+        "p95_ms": percentile(times, 95) * 1000,
+        "p99_ms": percentile(times, 99) * 1000,
+        "mean_ms": statistics.mean(times) * 1000,
+        "queries": statistics.median(queries),
+        "peak_kib": statistics.median(peaks) / 1024,
+    }
+
+
+def print_results(results):
+    print(
+        "%-16s %9s %9s %9s %8s %10s"
+        % ("scenario", "p50 ms", "p95 ms", "p99 ms", "queries", "peak KiB")
+    )
+    for name, r in results.items():
+        print(
+            "%-16s %9.2f %9.2f %9.2f %8g %10.1f"
+            % (name, r["p50_ms"], r["p95_ms"], r["p99_ms"], r["queries"], r["peak_kib"])
+        )
+
+
+def compare(base, new, threshold):
+    """Print the differences between two runs, and return the regressions."""
+    if base["dataset"] != new["dataset"]:
+        print("warning: the runs used different datasets")
+
+    regressions = []
+    print(
+        "%-16s %12s %12s %8s %14s"
+        % ("scenario", "base p95", "new p95", "change", "queries")
+    )
+    for name, r in new["results"].items():
+        b = base["results"].get(name)
+        if b is None:
+            print("%-16s %12s %12.2f" % (name, "-", r["p95_ms"]))
+            continue
+        change = (r["p95_ms"] - b["p95_ms"]) / b["p95_ms"] * 100
+        flags = []
+        if change > threshold:
+            flags.append("slower")
+        if r["queries"] > b["queries"]:
+            flags.append("more queries")
+        print(
+            "%-16s %12.2f %12.2f %7.1f%% %6g -> %-6g %s"
+            % (
+                name,
+                b["p95_ms"],
+                r["p95_ms"],
+                change,
+                b["queries"],
+                r["queries"],
+                ", ".join(flags),
+            )
+        )
+        if flags:
+            regressions.append(name)
+    return regressions
+
+
+def run(args):
+    handle, path = tempfile.mkstemp(suffix=".db")
+    os.close(handle)
+    os.environ["DATABASE_URI"] = "sqlite:///" + path
+    os.environ["SEARCH_PATH"] = path + ".search"
+    os.environ["RESPONSE_CACHE_BACKEND"] = "null"
+    os.environ["LOG_PATH"] = path + ".log"
+    os.environ.setdefault("MAIL_QUEUE_WORKERS", "0")
+
+    try:
+        env = Environment(args)
+        results = {}
+        for name, setup in SCENARIOS:
+            if args.only and name not in args.only:
+                continue
+            results[name] = measure(env, setup(env), args.repeat, args.warmup)
+        from app import last_seen
+
+        last_seen.flush()
+    finally:
+        for suffix in (
+            "",
+            "-wal",
+            "-shm",
+            ".search",
+            ".search-wal",
+            ".search-shm",
+            ".log",
+        ):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    print_results(results)
+    output = {
+        "dataset": {
+            "users": args.users,
+            "posts": args.posts,
+            "mean_follows": args.mean_follows,
+            "per_page": env.app.config["POSTS_PER_PAGE"],
+            "seed": args.seed,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            base = json.load(f)
+        print()
+        return 1 if compare(base, output, args.threshold) else 0
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--users", type=int, default=1000)
+    run_parser.add_argument("--posts", type=int, default=20000)
+    run_parser.add_argument("--mean-follows", type=int, default=20)
+    run_parser.add_argument("--per-page", type=int, help="POSTS_PER_PAGE")
+    run_parser.add_argument("--seed", type=int, default=1)
+    run_parser.add_argument("--repeat", type=int, default=100)
+    run_parser.add_argument("--warmup", type=int, default=5)
+    run_parser.add_argument(
+        "--only", nargs="+", choices=[name for name, setup in SCENARIOS]
+    )
+    run_parser.add_argument("--output", help="save the results as JSON")
+    run_parser.add_argument("--baseline", help="results to compare with")
+    run_parser.add_argument("--threshold", type=float, default=10.0)
+
+    compare_parser = commands.add_parser("compare", help="compare two saved runs")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=10.0)
+
+    args = parser.parse_args()
+    if args.command == "run":
+        return run(args)
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    return 1 if compare(base, new, args.threshold) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
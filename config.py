@@ -20,8 +20,89 @@ class Config(object):
     # Don't track changes to the database
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # Connection pool. Without `DATABASE_POOL_SIZE`, the driver's default is
+    # used, which for SQLite files is a new connection for every checkout.
+    # Connections older than `DATABASE_POOL_RECYCLE` seconds are replaced (-1
+    # keeps them), and `DATABASE_POOL_PRE_PING` tests each one on checkout.
+    DATABASE_POOL_SIZE = int(os.environ.get("DATABASE_POOL_SIZE") or 0)
+    DATABASE_MAX_OVERFLOW = int(os.environ.get("DATABASE_MAX_OVERFLOW") or 10)
+    DATABASE_POOL_TIMEOUT = int(os.environ.get("DATABASE_POOL_TIMEOUT") or 30)
+    DATABASE_POOL_RECYCLE = int(os.environ.get("DATABASE_POOL_RECYCLE") or -1)
+    DATABASE_POOL_PRE_PING = os.environ.get("DATABASE_POOL_PRE_PING") is not None
+
+    # A read replica of the database. The pages and API lists that only read
+    # query it instead, except for clients that wrote something within the
+    # last `DATABASE_REPLICA_STICKY` seconds. The post lists that go into the
+    # response cache are always read from the primary.
+    DATABASE_REPLICA_URI = os.environ.get("DATABASE_REPLICA_URI")
+    DATABASE_REPLICA_STICKY = int(os.environ.get("DATABASE_REPLICA_STICKY") or 5)
+
+    # PRAGMAs set on every SQLite connection. In WAL mode readers don't block
+    # the writer, and a writer waits up to `SQLITE_BUSY_TIMEOUT` milliseconds
+    # for the lock instead of failing with "database is locked". A negative
+    # `SQLITE_CACHE_SIZE` is in KiB, and `SQLITE_MMAP_SIZE` is in bytes (0
+    # turns memory-mapped I/O off).
+    SQLITE_JOURNAL_MODE = os.environ.get("SQLITE_JOURNAL_MODE") or "WAL"
+    SQLITE_SYNCHRONOUS = os.environ.get("SQLITE_SYNCHRONOUS") or "NORMAL"
+    SQLITE_BUSY_TIMEOUT = int(os.environ.get("SQLITE_BUSY_TIMEOUT") or 5000)
+    SQLITE_CACHE_SIZE = int(os.environ.get("SQLITE_CACHE_SIZE") or -16000)
+    SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE") or 0)
+
     POSTS_PER_PAGE = 3
 
+    # Materialized home timelines. When enabled, each new post is pushed into
+    # the timeline of every follower of its author, and the home page reads
+    # from those rows instead of running the `followed_posts()` UNION query.
+    # Authors with more followers than the threshold are not pushed; their
+    # posts are pulled at read time instead.
+    TIMELINE_FANOUT = os.environ.get("TIMELINE_FANOUT") is not None
+    TIMELINE_FANOUT_MAX_FOLLOWERS = int(
+        os.environ.get("TIMELINE_FANOUT_MAX_FOLLOWERS") or 1000
+    )
+
+    # "Who to follow" suggestions, from the followers graph (see
+    # `app/recommendations.py`). The best `RECOMMENDATIONS_PER_USER` of each
+    # user are stored (0 turns them off), by `flask recommendations rebuild`
+    # and after each follow or unfollow. The followers of a user with more
+    # than `RECOMMENDATIONS_UPDATE_MAX_FOLLOWERS` followers are only rescored
+    # by the rebuild.
+    RECOMMENDATIONS_PER_USER = int(os.environ.get("RECOMMENDATIONS_PER_USER") or 10)
+    RECOMMENDATIONS_SCORE = os.environ.get("RECOMMENDATIONS_SCORE") or "adamic_adar"
+    RECOMMENDATIONS_BATCH_SIZE = int(
+        os.environ.get("RECOMMENDATIONS_BATCH_SIZE") or 1000
+    )
+    RECOMMENDATIONS_UPDATE_MAX_FOLLOWERS = int(
+        os.environ.get("RECOMMENDATIONS_UPDATE_MAX_FOLLOWERS") or 100
+    )
+
+    # `User.last_seen` is written behind: updates are kept in memory and
+    # flushed in bulk every `LAST_SEEN_FLUSH_INTERVAL` seconds, or as soon as
+    # `LAST_SEEN_BATCH_SIZE` users are pending. A user seen again within
+    # `LAST_SEEN_WINDOW` seconds is not updated at all.
+    LAST_SEEN_WINDOW = int(os.environ.get("LAST_SEEN_WINDOW") or 60)
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get("LAST_SEEN_FLUSH_INTERVAL") or 30)
+    LAST_SEEN_BATCH_SIZE = int(os.environ.get("LAST_SEEN_BATCH_SIZE") or 500)
+
+    # Cache for the rendered post lists of `/explore` and of profile pages.
+    # The backend is one of "memory" (per process), "sqlite" (shared by every
+    # process that uses the same file) or "null" (no caching). The feed and
+    # profile pages answer conditional GET requests (304 Not Modified) with
+    # every backend, but with "memory", only when the request reaches the
+    # process that sent the page. With "null", a browser can keep showing an
+    # author's old name or avatar on `/index` and `/explore` until the next
+    # post, or for at most half of `WTF_CSRF_TIME_LIMIT`.
+    RESPONSE_CACHE_BACKEND = os.environ.get("RESPONSE_CACHE_BACKEND") or "memory"
+    RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL") or 300)
+    RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE") or 1024)
+    RESPONSE_CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH") or os.path.join(
+        basedir, "cache.db"
+    )
+
+    # Cache for the rendered HTML of each post, which every feed page reuses.
+    # It is private to each process, and holds at most `FRAGMENT_CACHE_SIZE`
+    # bytes of HTML (0 turns it off).
+    FRAGMENT_CACHE_SIZE = int(os.environ.get("FRAGMENT_CACHE_SIZE") or 16 * 1024 * 1024)
+
     # Email server details
     MAIL_SERVER = os.environ.get("MAIL_SERVER")
     MAIL_PORT = int(os.environ.get("MAIL_PORT") or 25)
@@ -30,4 +111,87 @@ class Config(object):
     MAIL_PASSWORD = os.environ.get("MAIL_PASSWORD")
     ADMINS = ["your-email@example.com"]
 
+    # Passwords are hashed in a pool of `PASSWORD_HASH_WORKERS` processes
+    # (0 hashes them in the request thread). When `PASSWORD_HASH_QUEUE` hashes
+    # are already waiting, a login waits at most `PASSWORD_HASH_WAIT` seconds
+    # for a place before it is answered with a 503. The method is in
+    # werkzeug's format; existing hashes made with any other method or cost
+    # are replaced when their user next logs in.
+    PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD") or "pbkdf2:sha256"
+    PASSWORD_HASH_WORKERS = int(
+        os.environ.get("PASSWORD_HASH_WORKERS") or os.cpu_count() or 1
+    )
+    PASSWORD_HASH_QUEUE = int(os.environ.get("PASSWORD_HASH_QUEUE") or 64)
+    PASSWORD_HASH_WAIT = int(os.environ.get("PASSWORD_HASH_WAIT") or 5)
+
+    # The logged in user is cached in memory for `USER_CACHE_TTL` seconds (0
+    # disables the cache), in an LRU of at most `USER_CACHE_SIZE` users. With
+    # `SESSION_IDENTITY`, GET requests take the user's id and username from the
+    # session cookie, and don't load the user unless the view needs more.
+    USER_CACHE_TTL = int(os.environ.get("USER_CACHE_TTL") or 60)
+    USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE") or 10000)
+    SESSION_IDENTITY = os.environ.get("SESSION_IDENTITY") is not None
+    SESSION_IDENTITY_MAX_AGE = int(os.environ.get("SESSION_IDENTITY_MAX_AGE") or 300)
+
+    # Full-text search backend: "sqlite" keeps an FTS5 index in a separate file
+    # at `SEARCH_PATH`; "elasticsearch" uses the cluster at `ELASTICSEARCH_URL`.
+    SEARCH_BACKEND = os.environ.get("SEARCH_BACKEND") or "sqlite"
+    SEARCH_PATH = os.environ.get("SEARCH_PATH") or os.path.join(basedir, "search.db")
+    ELASTICSEARCH_URL = os.environ.get("ELASTICSEARCH_URL")
+
+    # With "sqlite", only the most recent `SEARCH_MAX_CANDIDATES` matches of a
+    # search are ranked, since scoring all of the matches of a common word
+    # takes hundreds of milliseconds once there are a few hundred thousand
+    # posts (0 ranks them all).
+    SEARCH_MAX_CANDIDATES = int(os.environ.get("SEARCH_MAX_CANDIDATES") or 10000)
+
+    # Largest page a client of the JSON API can ask for, and the number of
+    # posts fetched at a time when streaming a whole list as NDJSON
+    API_MAX_PER_PAGE = int(os.environ.get("API_MAX_PER_PAGE") or 100)
+    API_STREAM_BATCH_SIZE = int(os.environ.get("API_STREAM_BATCH_SIZE") or 500)
+
+    # New posts are pushed to the open feed pages over Server-Sent Events.
+    # With several server processes, set `STREAM_BACKEND` to "sqlite", so
+    # that they pass the events to each other through the file at
+    # `STREAM_PATH`, which each one checks every `STREAM_POLL_INTERVAL`
+    # milliseconds. Idle connections get a heartbeat every `STREAM_HEARTBEAT`
+    # seconds, and the last `STREAM_BACKLOG` events are kept for clients that
+    # reconnect.
+    STREAM_BACKEND = os.environ.get("STREAM_BACKEND") or "memory"
+    STREAM_PATH = os.environ.get("STREAM_PATH") or os.path.join(basedir, "stream.db")
+    STREAM_POLL_INTERVAL = int(os.environ.get("STREAM_POLL_INTERVAL") or 500)
+    STREAM_HEARTBEAT = int(os.environ.get("STREAM_HEARTBEAT") or 15)
+    STREAM_BACKLOG = int(os.environ.get("STREAM_BACKLOG") or 1000)
+
+    # Outbound email is queued in the database and sent by a pool of worker
+    # threads. Failed messages are retried with exponential backoff, starting
+    # at `MAIL_QUEUE_BACKOFF` seconds.
+    MAIL_QUEUE_WORKERS = int(os.environ.get("MAIL_QUEUE_WORKERS") or 2)
+    MAIL_QUEUE_BATCH_SIZE = int(os.environ.get("MAIL_QUEUE_BATCH_SIZE") or 50)
+    MAIL_QUEUE_MAX_ATTEMPTS = int(os.environ.get("MAIL_QUEUE_MAX_ATTEMPTS") or 5)
+    MAIL_QUEUE_BACKOFF = int(os.environ.get("MAIL_QUEUE_BACKOFF") or 30)
+    MAIL_QUEUE_POLL_INTERVAL = int(os.environ.get("MAIL_QUEUE_POLL_INTERVAL") or 10)
+
+    # Per-request instrumentation. `SERVER_TIMING` adds a `Server-Timing`
+    # header with the database and template time of each response. Requests
+    # slower than `SLOW_REQUEST_THRESHOLD` milliseconds are logged with their
+    # SQL (0 turns that off), and `METRICS_ENABLED` serves the counters at
+    # `/metrics` for Prometheus.
+    SERVER_TIMING = os.environ.get("SERVER_TIMING") is not None
+    SLOW_REQUEST_THRESHOLD = int(os.environ.get("SLOW_REQUEST_THRESHOLD") or 500)
+    METRICS_ENABLED = os.environ.get("METRICS_ENABLED") is not None
+
+    # Logging, which is done from a background thread (see `app/log.py`). The
+    # log file is rotated every `LOG_MAX_BYTES` bytes, and with `LOG_JSON` is
+    # written as one JSON object per line. Errors are emailed to `ADMINS` at
+    # most once every `LOG_MAIL_INTERVAL` seconds, as a digest.
+    LOG_PATH = os.environ.get("LOG_PATH") or os.path.join(
+        basedir, "logs", "microblog.log"
+    )
+    LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES") or 10 * 1024 * 1024)
+    LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT") or 10)
+    LOG_JSON = os.environ.get("LOG_JSON") is not None
+    LOG_MAIL_INTERVAL = int(os.environ.get("LOG_MAIL_INTERVAL") or 300)
+    LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE") or 10000)
+
     LANGUAGES = ["en", "es"]
@@ -0,0 +1,92 @@
+"""followers primary key and indexes
+
+Revision ID: 5e2b7c9a1f03
+Revises: afcf8b1cdcf9
+Create Date: 2026-10-17 06:04:12.381907
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "5e2b7c9a1f03"
+down_revision = "afcf8b1cdcf9"
+branch_labels = None
+depends_on = None
+
+
+def _create_followers(name, primary_key):
+    op.create_table(
+        name,
+        sa.Column("follower_id", sa.Integer(), nullable=not primary_key),
+        sa.Column("followed_id", sa.Integer(), nullable=not primary_key),
+        sa.ForeignKeyConstraint(
+            ["followed_id"],
+            ["user.id"],
+        ),
+        sa.ForeignKeyConstraint(
+            ["follower_id"],
+            ["user.id"],
+        ),
+        *(
+            [sa.PrimaryKeyConstraint("follower_id", "followed_id")]
+            if primary_key
+            else []
+        )
+    )
+
+
+def upgrade():
+    # A primary key can't be added to an existing SQLite table, so the table is
+    # copied into a new one. Duplicate and incomplete rows are dropped on the
+    # way.
+    _create_followers("_followers_new", primary_key=True)
+    op.execute(
+        "INSERT INTO _followers_new (follower_id, followed_id) "
+        "SELECT DISTINCT follower_id, followed_id FROM followers "
+        "WHERE follower_id IS NOT NULL AND followed_id IS NOT NULL"
+    )
+    op.drop_table("followers")
+    op.rename_table("_followers_new", "followers")
+    op.create_index(
+        "ix_followers_followed_id_follower_id",
+        "followers",
+        ["followed_id", "follower_id"],
+        unique=False,
+    )
+    op.create_index(
+        "ix_post_user_id_timestamp", "post", ["user_id", "timestamp"], unique=False
+    )
+
+    # The counters may have included duplicate rows
+    user = sa.table(
+        "user",
+        sa.column("id"),
+        sa.column("follower_count"),
+        sa.column("followed_count"),
+    )
+    followers = sa.table(
+        "followers", sa.column("follower_id"), sa.column("followed_id")
+    )
+
+    def count(user_id):
+        return sa.select(sa.func.count()).where(user_id == user.c.id).scalar_subquery()
+
+    op.execute(
+        user.update().values(
+            follower_count=count(followers.c.followed_id),
+            followed_count=count(followers.c.follower_id),
+        )
+    )
+
+
+def downgrade():
+    op.drop_index("ix_post_user_id_timestamp", table_name="post")
+    op.drop_index("ix_followers_followed_id_follower_id", table_name="followers")
+    _create_followers("_followers_old", primary_key=False)
+    op.execute(
+        "INSERT INTO _followers_old (follower_id, followed_id) "
+        "SELECT follower_id, followed_id FROM followers"
+    )
+    op.drop_table("followers")
+    op.rename_table("_followers_old", "followers")
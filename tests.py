@@ -1,19 +1,98 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import queue
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
 from datetime import datetime, timedelta
 
-from app import app, db
-from app.models import Post, User
+from flask import Flask, session
+from flask_login import login_user
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+from werkzeug.security import generate_password_hash
 
+from app import (
+    cache,
+    create_app,
+    db,
+    follow_state,
+    fragments,
+    identity,
+    instrumentation,
+    last_seen,
+    mail,
+    mail_queue,
+    passwords,
+    post_stream,
+    recommendations,
+    seed,
+    timeline,
+)
+from app.cache import MemoryBackend, SQLiteBackend
+from app.fragments import FragmentCache
+from app.last_seen import LastSeenTracker
+from app.log import DigestHandler, NonBlockingQueueHandler, QueueLogging
+from app.mail_queue import MailQueue
+from app.models import (
+    OutboundMail,
+    Post,
+    Recommendation,
+    TimelineEntry,
+    User,
+    followers,
+    reconcile_counters,
+)
+from app.pagination import paginate_posts, search_posts
+from app.passwords import PasswordHasher, PasswordHashingBusy
+from app.sqlite import LocalConnections
+from app.stream import Hub, PostStream
+from config import Config
+
+
+class TestConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = "sqlite://"
+
+    # Keep the search index of the tests in memory
+    SEARCH_PATH = ":memory:"
+
+
+class AppTestCase(unittest.TestCase):
+    """
+    Every test gets a new application, made from `TestConfig` with the
+    settings in `config`, an empty database, and an app context that is
+    pushed for the duration of the test.
+    """
+
+    config = {}
 
-class UserModelCase(unittest.TestCase):
     def setUp(self):
-        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        self.app = create_app(type("CaseConfig", (TestConfig,), dict(self.config)))
+        self.app_context = self.app.app_context()
+        self.app_context.push()
         db.create_all()
 
     def tearDown(self):
+        last_seen.flush()
         db.session.remove()
         db.drop_all()
+        self.app_context.pop()
 
+    def login(self, user):
+        """Return a test client that is logged in as `user`."""
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = str(user.id)
+        return client
+
+
+class UserModelCase(AppTestCase):
     def test_password_hashing(self):
         u = User(username="susan")
         u.set_password("cat")
@@ -29,6 +108,17 @@ class UserModelCase(unittest.TestCase):
             ),
         )
 
+    def test_email_digest(self):
+        u = User(username="john", email="John@Example.com")
+        self.assertEqual(u.email_digest, "d4c74594d841139328695756648b6bd6")
+        u.email = "susan@example.com"
+        self.assertEqual(
+            u.avatar(256),
+            "https://www.gravatar.com/avatar/{}?d=identicon&s=256".format(
+                hashlib.md5(b"susan@example.com").hexdigest()
+            ),
+        )
+
     def test_follow(self):
         u1 = User(username="john", email="joh@example.com")
         u2 = User(username="susan", email="susan@example.com")
@@ -51,6 +141,32 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.followed.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
 
+    def test_indexes(self):
+        u1 = User(username="john", email="john@example.com")
+        u2 = User(username="susan", email="susan@example.com")
+        db.session.add_all([u1, u2])
+        u1.follow(u2)
+        db.session.commit()
+
+        # Duplicate rows are rejected by the primary key
+        with self.assertRaises(IntegrityError):
+            db.session.execute(
+                followers.insert().values(follower_id=u1.id, followed_id=u2.id)
+            )
+        db.session.rollback()
+
+        # Lookups in either direction, and per-author timelines, use an index
+        for query in (
+            u1.followed.order_by(None),
+            u2.followers.order_by(None),
+            u1.posts.order_by(Post.timestamp.desc()),
+        ):
+            sql = query.statement.compile(
+                db.engine, compile_kwargs={"literal_binds": True}
+            )
+            plan = db.session.execute(text("EXPLAIN QUERY PLAN %s" % sql)).all()
+            self.assertFalse([row for row in plan if "SCAN" in row[-1]], plan)
+
     def test_follow_posts(self):
         # Create four users
         u1 = User(username="john", email="john@example.com")
@@ -94,5 +210,1562 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f4, [p4])
 
 
+class FollowStateCase(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.users = [
+            User(username="user%d" % i, email="user%d@example.com" % i)
+            for i in range(6)
+        ]
+        db.session.add_all(self.users)
+        for other in self.users[1:4]:
+            self.users[0].follow(other)
+        db.session.commit()
+
+    def test_followed_ids(self):
+        u = self.users[0]
+        ids = [other.id for other in self.users]
+        self.assertEqual(u.followed_ids(ids), set(ids[1:4]))
+        self.assertEqual(u.followed_ids([]), set())
+        self.assertTrue(u.is_following(self.users[3]))
+        self.assertFalse(u.is_following(self.users[4]))
+
+    def test_request_cache(self):
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        ids = [other.id for other in self.users]
+        with self.app.test_request_context():
+            login_user(self.users[0])
+            db.event.listen(db.engine, "before_cursor_execute", count)
+            try:
+                self.assertEqual(follow_state.following(ids[:4]), set(ids[1:4]))
+                self.assertEqual(follow_state.following(ids), set(ids[1:4]))
+                self.assertTrue(follow_state.is_following(self.users[2]))
+                self.assertFalse(follow_state.is_following(self.users[5]))
+            finally:
+                db.event.remove(db.engine, "before_cursor_execute", count)
+        self.assertEqual(len(statements), 2)
+
+
+class ResponseCacheCase(AppTestCase):
+    config = {"WTF_CSRF_ENABLED": False}
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.u = User(username="john", email="john@example.com")
+        db.session.add(self.u)
+        db.session.commit()
+        self.client = self.login(self.u)
+
+    def test_backends(self):
+        with tempfile.TemporaryDirectory() as path:
+            for backend in (
+                MemoryBackend(max_entries=2),
+                SQLiteBackend(os.path.join(path, "cache.db")),
+            ):
+                backend.set("a", "1")
+                backend.set("b", "2", ttl=-1)
+                self.assertEqual(backend.get("a"), "1")
+                self.assertIsNone(backend.get("b"))
+                backend.clear()
+                self.assertIsNone(backend.get("a"))
+
+            # The least recently used entry is evicted first
+            backend = MemoryBackend(max_entries=2)
+            backend.set("a", "1")
+            backend.set("b", "2")
+            backend.get("a")
+            backend.set("c", "3")
+            self.assertEqual([backend.get(k) for k in "abc"], ["1", None, "3"])
+
+    def test_local_connections(self):
+        with tempfile.TemporaryDirectory() as path:
+            connections = LocalConnections(os.path.join(path, "test.db"))
+            connection = connections.get()
+            self.assertIs(connections.get(), connection)
+            mode = connection.execute("PRAGMA journal_mode").fetchone()[0]
+            self.assertEqual(mode, "wal")
+
+            # Every thread has its own, and so does a forked process
+            other = []
+            thread = threading.Thread(target=lambda: other.append(connections.get()))
+            thread.start()
+            thread.join()
+            self.assertIsNot(other[0], connection)
+            connections.after_fork()
+            self.assertIsNot(connections.get(), connection)
+
+    def test_invalidation(self):
+        db.session.add(Post(body="first post", author=self.u))
+        db.session.commit()
+        hits = cache.stats()["hits"]
+        for url in ("/explore", "/user/john"):
+            self.assertIn(b"first post", self.client.get(url).data)
+            self.assertIn(b"first post", self.client.get(url).data)
+        self.assertEqual(cache.stats()["hits"], hits + 2)
+
+        # Posts written behind the cache's back aren't seen...
+        db.session.add(Post(body="second post", author=self.u))
+        db.session.commit()
+        self.assertNotIn(b"second post", self.client.get("/explore").data)
+
+        # ...but posting through the site invalidates the cached lists
+        self.client.post("/index", data={"post": "third post"})
+        for url in ("/explore", "/user/john"):
+            self.assertIn(b"third post", self.client.get(url).data)
+
+
+class FragmentCacheCase(AppTestCase):
+    # Otherwise the whole post list would come from the response cache
+    config = {"RESPONSE_CACHE_BACKEND": "null"}
+
+    def setUp(self):
+        super().setUp()
+        self.u1 = User(username="john", email="john@example.com")
+        self.u2 = User(username="susan", email="susan@example.com")
+        db.session.add_all([self.u1, self.u2])
+        db.session.add(Post(body="from john", author=self.u1))
+        db.session.add(Post(body="from susan", author=self.u2))
+        db.session.commit()
+        self.client = self.login(self.u1)
+
+    def test_size(self):
+        cache = FragmentCache()
+        cache.max_bytes = 10
+        cache.set("a", "1234")
+        cache.set("b", "\u00e9\u00e9")
+        cache.set("c", "12345678901")
+        self.assertEqual(cache.size, 8)
+        self.assertEqual(cache.get_many("abc"), ["1234", "\u00e9\u00e9", None])
+
+        # The least recently used entries are evicted first
+        cache.get_many("a")
+        cache.set("d", "123")
+        cache.set("e", "12")
+        self.assertEqual(cache.get_many("abde"), ["1234", None, "123", "12"])
+        self.assertEqual(cache.size, 9)
+
+    def test_feed(self):
+        page = self.client.get("/explore").data
+        self.assertEqual(fragments.stats()["misses"], 2)
+        self.assertEqual(self.client.get("/explore").data, page)
+        self.assertEqual(fragments.stats()["hits"], 2)
+        self.assertIn(b"from john", self.client.get("/user/john").data)
+        self.assertEqual(fragments.stats()["hits"], 3)
+
+        # A new username is a new fragment
+        self.u1.username = "johnny"
+        db.session.commit()
+        page = self.client.get("/explore").data
+        self.assertIn(b"johnny", page)
+        self.assertEqual(fragments.stats()["misses"], 3)
+
+
+class ConditionalGetCase(AppTestCase):
+    def setUp(self):
+        # A response cache that every server process shares
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.config = {
+            "RESPONSE_CACHE_BACKEND": "sqlite",
+            "RESPONSE_CACHE_PATH": os.path.join(directory.name, "cache.db"),
+            "WTF_CSRF_ENABLED": False,
+        }
+        super().setUp()
+        self.u1 = User(username="john", email="john@example.com")
+        self.u2 = User(username="susan", email="susan@example.com")
+        db.session.add_all([self.u1, self.u2])
+        db.session.add(Post(body="first post", author=self.u2))
+        db.session.commit()
+        self.client = self.login(self.u1)
+
+    def assertNotModified(self, url, response, not_modified=True):
+        again = self.client.get(
+            url, headers={"If-None-Match": response.headers["ETag"]}
+        )
+        self.assertEqual(again.status_code, 304 if not_modified else 200)
+        if not_modified:
+            self.assertEqual(again.data, b"")
+        return again
+
+    def test_etag(self):
+        for url in ("/index", "/explore", "/user/susan"):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("private", response.headers["Cache-Control"])
+            self.assertNotModified(url, response)
+
+        # Following someone changes the home and profile pages
+        home = self.client.get("/index")
+        profile = self.client.get("/user/susan")
+        self.client.post("/follow/susan")
+        self.client.get("/index")  # consume the flashed message
+        self.assertNotModified("/index", home, False)
+        self.assertNotModified("/user/susan", profile, False)
+
+        # So does swapping followed users for others with the same number of
+        # users and the same sum of ids
+        users = [
+            User(username=name, email="%s@example.com" % name)
+            for name in ("mary", "david", "alice")
+        ]
+        db.session.add_all(users)
+        db.session.commit()
+        self.client.post("/follow/alice")
+        self.client.get("/index")
+        home = self.client.get("/index")
+        self.client.post("/unfollow/susan")
+        self.client.post("/unfollow/alice")
+        self.client.post("/follow/mary")
+        self.client.post("/follow/david")
+        self.client.get("/index")
+        self.assertNotModified("/index", home, False)
+
+        # A new post changes the explore page
+        explore = self.client.get("/explore")
+        self.client.post("/index", data={"post": "second post"})
+        self.client.get("/index")
+        self.assertNotModified("/explore", explore, False)
+
+    def test_private_cache(self):
+        self.app.config["RESPONSE_CACHE_BACKEND"] = "memory"
+        cache.init_app(self.app)
+        for url in ("/index", "/explore", "/user/susan"):
+            response = self.client.get(url)
+            self.assertNotModified(url, response)
+
+            # Once the generations expire, so do the ETags
+            cache.clear()
+            self.assertNotModified(url, response, False)
+
+        # The newest post can't vouch for a copy of another process
+        response = self.client.get("/explore")
+        since = {"If-Modified-Since": response.headers["Last-Modified"]}
+        self.assertEqual(self.client.get("/explore", headers=since).status_code, 200)
+
+    def test_null_cache(self):
+        self.app.config["RESPONSE_CACHE_BACKEND"] = "null"
+        cache.init_app(self.app)
+        for url in ("/index", "/explore", "/user/susan"):
+            response = self.client.get(url)
+            self.assertNotModified(url, response)
+
+        explore = self.client.get("/explore")
+        self.client.post("/index", data={"post": "second post"})
+        self.client.get("/index")
+        self.assertNotModified("/explore", explore, False)
+
+    def test_last_modified(self):
+        response = self.client.get("/explore")
+        since = {"If-Modified-Since": response.headers["Last-Modified"]}
+        self.assertEqual(self.client.get("/explore", headers=since).status_code, 304)
+
+        db.session.add(
+            Post(
+                body="later post",
+                author=self.u2,
+                timestamp=datetime.utcnow() + timedelta(seconds=5),
+            )
+        )
+        db.session.commit()
+        self.assertEqual(self.client.get("/explore", headers=since).status_code, 200)
+
+
+class CounterCase(AppTestCase):
+    def counters(self, user):
+        db.session.refresh(user)
+        return user.follower_count, user.followed_count, user.post_count
+
+    def test_counters(self):
+        u1 = User(username="john", email="john@example.com")
+        u2 = User(username="susan", email="susan@example.com")
+        db.session.add_all([u1, u2])
+
+        # Counters work both before and after the users are first committed
+        u1.follow(u2)
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(self.counters(u1), (0, 1, 0))
+        self.assertEqual(self.counters(u2), (1, 0, 0))
+
+        u2.follow(u1)
+        db.session.add_all([Post(body="one", author=u2), Post(body="two", author=u2)])
+        db.session.commit()
+        self.assertEqual(self.counters(u1), (1, 1, 0))
+        self.assertEqual(self.counters(u2), (1, 1, 2))
+
+        u1.unfollow(u2)
+        u1.unfollow(u2)
+        db.session.delete(u2.posts.first())
+        db.session.commit()
+        self.assertEqual(self.counters(u1), (1, 0, 0))
+        self.assertEqual(self.counters(u2), (0, 1, 1))
+
+    def test_reconcile(self):
+        u1 = User(username="john", email="john@example.com", follower_count=7)
+        u2 = User(username="susan", email="susan@example.com", post_count=3)
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        db.session.execute(
+            followers.insert().values(follower_id=u1.id, followed_id=u2.id)
+        )
+        reconcile_counters()
+        db.session.commit()
+        self.assertEqual(self.counters(u1), (0, 1, 0))
+        self.assertEqual(self.counters(u2), (1, 0, 0))
+
+
+class TimelineCase(AppTestCase):
+    config = {"TIMELINE_FANOUT": True, "TIMELINE_FANOUT_MAX_FOLLOWERS": 1000}
+
+    def setUp(self):
+        super().setUp()
+        self.users = [
+            User(username=name, email="{}@example.com".format(name))
+            for name in ("john", "susan", "mary", "david")
+        ]
+        db.session.add_all(self.users)
+        db.session.commit()
+
+    def post(self, author, body, seconds):
+        post = Post(
+            body=body,
+            author=author,
+            timestamp=datetime.utcnow() + timedelta(seconds=seconds),
+        )
+        db.session.add(post)
+        db.session.flush()
+        timeline.push_post(post)
+        db.session.commit()
+        return post
+
+    def follow(self, follower, followed):
+        follower.follow(followed)
+        timeline.backfill(follower, followed)
+        db.session.commit()
+
+    def unfollow(self, follower, followed):
+        follower.unfollow(followed)
+        timeline.prune(follower, followed)
+        db.session.commit()
+
+    def assertMatchesFollowedPosts(self):
+        for u in self.users:
+            self.assertEqual(
+                timeline.home_posts(u).all(), u.followed_posts().all(), u.username
+            )
+
+    def test_fan_out(self):
+        u1, u2, u3, u4 = self.users
+        self.follow(u1, u2)
+        self.follow(u1, u4)
+        self.follow(u2, u3)
+        self.post(u1, "post from john", 1)
+        self.post(u2, "post from susan", 4)
+        self.post(u3, "post from mary", 3)
+        self.post(u4, "post from david", 2)
+        self.assertMatchesFollowedPosts()
+
+        # Following backfills existing posts, unfollowing prunes them
+        self.follow(u3, u4)
+        self.unfollow(u1, u2)
+        self.assertMatchesFollowedPosts()
+
+    def test_pull_authors(self):
+        u1, u2, u3, u4 = self.users
+        self.app.config["TIMELINE_FANOUT_MAX_FOLLOWERS"] = 1
+        self.follow(u1, u2)
+        self.follow(u3, u2)
+        self.follow(u1, u4)
+        self.post(u2, "post from susan", 1)
+        self.post(u4, "post from david", 2)
+
+        # susan has two followers, so her post is pulled rather than pushed
+        self.assertTrue(timeline.is_pull_author(u2))
+        self.assertFalse(timeline.is_pull_author(u4))
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=u1.id).count(), 1)
+        self.assertMatchesFollowedPosts()
+
+    def test_pull_author_drops_below_threshold(self):
+        u1, u2, u3, u4 = self.users
+        self.app.config["TIMELINE_FANOUT_MAX_FOLLOWERS"] = 2
+        self.follow(u1, u4)
+        self.follow(u2, u4)
+        self.post(u4, "pushed", 1)
+        self.follow(u3, u4)
+        self.post(u4, "pulled", 2)
+        self.assertMatchesFollowedPosts()
+
+        # Back at the threshold, the pulled post is pushed to the followers
+        # that are left
+        self.unfollow(u2, u4)
+        self.assertFalse(timeline.is_pull_author(u4))
+        self.assertEqual(
+            [post.body for post in timeline.home_posts(u1)], ["pulled", "pushed"]
+        )
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=u3.id).count(), 2)
+        self.assertMatchesFollowedPosts()
+
+    def test_rebuild(self):
+        u1, u2, u3, u4 = self.users
+        self.app.config["TIMELINE_FANOUT"] = False
+        u1.follow(u2)
+        u2.follow(u3)
+        db.session.add(Post(body="post from susan", author=u2))
+        db.session.add(Post(body="post from mary", author=u3))
+        db.session.commit()
+
+        self.app.config["TIMELINE_FANOUT"] = True
+        self.assertEqual(timeline.rebuild(), 4)
+        db.session.commit()
+        self.assertMatchesFollowedPosts()
+
+
+class PaginationCase(AppTestCase):
+    def setUp(self):
+        super().setUp()
+
+        # Posts share timestamps in pairs, so ties have to be broken by id
+        now = datetime.utcnow()
+        self.u1 = User(username="john", email="john@example.com")
+        self.u2 = User(username="susan", email="susan@example.com")
+        db.session.add_all([self.u1, self.u2])
+        self.u1.follow(self.u2)
+        for i in range(10):
+            author = self.u1 if i % 3 else self.u2
+            timestamp = now + timedelta(seconds=i // 2)
+            db.session.add(Post(body=str(i), author=author, timestamp=timestamp))
+        db.session.commit()
+
+    def walk(self, query, per_page, rows=False):
+        """Follow the `next` cursors, then the `prev` cursors back again."""
+        pages = [paginate_posts(query, per_page, page=1, rows=rows)]
+        while pages[-1].has_next:
+            cursor = pages[-1].next_cursor
+            pages.append(paginate_posts(query, per_page, before=cursor, rows=rows))
+        back = [pages[-1]]
+        while back[-1].has_prev:
+            cursor = back[-1].prev_cursor
+            back.append(paginate_posts(query, per_page, after=cursor, rows=rows))
+        return [p.items for p in pages], [p.items for p in reversed(back)]
+
+    def test_walk(self):
+        for query in (Post.query, self.u1.followed_posts()):
+            expected = query.order_by(Post.timestamp.desc(), Post.id.desc()).all()
+            for per_page in (1, 3, 4, 10, 11):
+                forward, backward = self.walk(query, per_page)
+                self.assertEqual(forward, backward)
+                self.assertEqual(sum(forward, []), expected)
+                self.assertTrue(all(0 < len(items) <= per_page for items in forward))
+
+    def test_rows(self):
+        for query in (Post.query, self.u1.followed_posts()):
+            expected = query.order_by(Post.timestamp.desc(), Post.id.desc()).all()
+            forward, backward = self.walk(query, 3, rows=True)
+            rows = sum(forward, [])
+            self.assertEqual([r.id for r in rows], [p.id for p in expected])
+            self.assertEqual([r.id for r in sum(backward, [])], [r.id for r in rows])
+            for row, post in zip(rows, expected):
+                self.assertEqual(row.body, post.body)
+                self.assertEqual(row.timestamp, post.timestamp)
+                self.assertEqual(row.author.username, post.author.username)
+                self.assertEqual(row.author.avatar(70), post.author.avatar(70))
+
+    def test_page_compatibility(self):
+        expected = Post.query.order_by(Post.timestamp.desc(), Post.id.desc()).all()
+        page = paginate_posts(Post.query, 3, page=2)
+        self.assertEqual(page.items, expected[3:6])
+        self.assertTrue(page.has_prev and page.has_next)
+        self.assertEqual(
+            paginate_posts(Post.query, 3, after=page.prev_cursor).items, expected[:3]
+        )
+        self.assertEqual(
+            paginate_posts(Post.query, 3, before="garbage").items, expected[:3]
+        )
+
+
+class LastSeenCase(AppTestCase):
+    config = {"LAST_SEEN_FLUSH_INTERVAL": 0}
+
+    def setUp(self):
+        super().setUp()
+        self.users = [
+            User(username=name, email="{}@example.com".format(name))
+            for name in ("john", "susan", "mary")
+        ]
+        db.session.add_all(self.users)
+        db.session.commit()
+        self.tracker = LastSeenTracker(self.app, db)
+
+    def tearDown(self):
+        self.tracker.flush()
+        super().tearDown()
+
+    def test_window(self):
+        u1, u2, u3 = self.users
+        now = datetime.utcnow()
+        self.assertTrue(self.tracker.touch(u1.id, now))
+        self.assertFalse(self.tracker.touch(u1.id, now + timedelta(seconds=10)))
+        self.assertTrue(self.tracker.touch(u2.id, now + timedelta(seconds=10)))
+        self.assertTrue(self.tracker.touch(u1.id, now + timedelta(seconds=70)))
+
+        # Nothing is written until the tracker is flushed
+        last = u1.last_seen
+        db.session.expire_all()
+        self.assertEqual(u1.last_seen, last)
+
+        self.assertEqual(self.tracker.flush(), 2)
+        db.session.expire_all()
+        self.assertEqual(u1.last_seen, now + timedelta(seconds=70))
+        self.assertEqual(u2.last_seen, now + timedelta(seconds=10))
+        self.assertEqual(self.tracker.flush(), 0)
+
+    def test_batch_size(self):
+        self.app.config["LAST_SEEN_BATCH_SIZE"] = 2
+        now = datetime.utcnow() + timedelta(days=1)
+        for u in self.users:
+            self.tracker.touch(u.id, now)
+        db.session.expire_all()
+        self.assertEqual([u.last_seen == now for u in self.users], [True, True, False])
+
+    def test_failed_flush(self):
+        self.app.config["LAST_SEEN_BATCH_SIZE"] = 1
+        now = datetime.utcnow() + timedelta(days=1)
+        user_id = self.users[0].id
+        db.session.execute(text("ALTER TABLE user RENAME TO away"))
+
+        # The request goes on, and the update is written by the next flush
+        with self.assertLogs(self.app.logger, "ERROR"):
+            self.assertTrue(self.tracker.touch(user_id, now))
+        db.session.execute(text("ALTER TABLE away RENAME TO user"))
+        self.assertEqual(self.tracker.flush(), 1)
+        db.session.expire_all()
+        self.assertEqual(self.users[0].last_seen, now)
+
+
+class FeedQueryCase(AppTestCase):
+    def setUp(self):
+        super().setUp()
+
+        # Every post has a different author, and everyone follows everyone
+        self.users = [
+            User(username="user%d" % i, email="user%d@example.com" % i)
+            for i in range(12)
+        ]
+        db.session.add_all(self.users)
+        for u in self.users:
+            db.session.add(Post(body="post from %s" % u.username, author=u))
+            for other in self.users:
+                if other is not u:
+                    u.follow(other)
+        db.session.commit()
+        self.client = self.login(self.users[0])
+
+    def count_statements(self, url):
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        cache.clear()
+        identity.clear()
+        engine = db.engine
+
+        # A request would otherwise share the session and `g` of the test's
+        # app context, along with whatever earlier requests left in them
+        self.app_context.pop()
+        db.event.listen(engine, "before_cursor_execute", count)
+        try:
+            response = self.client.get(url)
+        finally:
+            db.event.remove(engine, "before_cursor_execute", count)
+            self.app_context = self.app.app_context()
+            self.app_context.push()
+        self.assertEqual(response.status_code, 200)
+        return len(statements)
+
+    def test_statements_per_page(self):
+        for url in ("/index", "/explore", "/user/user1"):
+            self.app.config["POSTS_PER_PAGE"] = 3
+            small = self.count_statements(url)
+            self.app.config["POSTS_PER_PAGE"] = 10
+            large = self.count_statements(url)
+            self.assertEqual(small, large, url)
+
+
+class MailQueueCase(AppTestCase):
+    config = {"MAIL_QUEUE_WORKERS": 0}
+
+    def setUp(self):
+        super().setUp()
+        self.state = self.app.extensions["mail"]
+        self.saved = (self.state.suppress, self.state.server, self.state.port)
+
+    def tearDown(self):
+        self.state.suppress, self.state.server, self.state.port = self.saved
+        super().tearDown()
+
+    def test_start(self):
+        # Outside of tests, the workers start with the first request, to send
+        # what was queued before the server started
+        app = Flask(__name__)
+        queue = MailQueue(app, db=db, mail=mail)
+        self.assertIn(queue.start, app.before_first_request_funcs)
+        app = Flask(__name__)
+        app.testing = True
+        queue = MailQueue(app, db=db, mail=mail)
+        self.assertNotIn(queue.start, app.before_first_request_funcs)
+
+    def test_drain(self):
+        self.state.suppress = True
+        for i in range(3):
+            mail_queue.enqueue("hi %d" % i, "a@example.com", ["b@example.com"], "x", "")
+        self.assertEqual(mail_queue.depth(), 3)
+
+        with mail.record_messages() as outbox:
+            self.assertEqual(mail_queue.drain(), 3)
+        self.assertEqual([m.subject for m in outbox], ["hi 0", "hi 1", "hi 2"])
+        self.assertEqual(OutboundMail.query.count(), 0)
+
+    def test_retry(self):
+        self.state.suppress = False
+        self.state.server, self.state.port = "localhost", 1
+        self.app.config["MAIL_QUEUE_MAX_ATTEMPTS"] = 2
+        mail_queue.enqueue("hi", "a@example.com", ["b@example.com"], "x", "")
+
+        self.assertEqual(mail_queue.drain(), 0)
+        message = OutboundMail.query.one()
+        self.assertEqual(message.attempts, 1)
+        self.assertGreater(message.next_attempt, datetime.utcnow())
+        self.assertIsNone(message.claim)
+
+        # Not due yet, so nothing is tried
+        self.assertEqual(mail_queue.drain(), 0)
+        db.session.expire_all()
+        self.assertEqual(OutboundMail.query.one().attempts, 1)
+
+        OutboundMail.query.update({"next_attempt": datetime.utcnow()})
+        db.session.commit()
+        mail_queue.drain()
+        db.session.expire_all()
+        message = OutboundMail.query.one()
+        self.assertEqual(message.attempts, 2)
+        self.assertIsNone(message.next_attempt)
+        self.assertEqual((mail_queue.depth(), mail_queue.failed()), (0, 1))
+
+
+class PasswordCase(AppTestCase):
+    config = {
+        "WTF_CSRF_ENABLED": False,
+        "PASSWORD_HASH_METHOD": "pbkdf2:sha256:2000",
+        "PASSWORD_HASH_WORKERS": 0,
+    }
+
+    def test_needs_rehash(self):
+        self.assertFalse(passwords.needs_rehash(passwords.hash("cat")))
+        self.assertTrue(passwords.needs_rehash(generate_password_hash("cat")))
+        self.app.config["PASSWORD_HASH_METHOD"] = "pbkdf2:sha256"
+        self.assertFalse(passwords.needs_rehash(generate_password_hash("cat")))
+
+    def test_rehash_on_login(self):
+        u = User(username="susan", email="susan@example.com")
+        u.password_hash = generate_password_hash("cat", "pbkdf2:sha1:1000")
+        db.session.add(u)
+        db.session.commit()
+
+        client = self.app.test_client()
+        response = client.post("/login", data={"username": "susan", "password": "dog"})
+        self.assertTrue(u.password_hash.startswith("pbkdf2:sha1:1000$"))
+        response = client.post("/login", data={"username": "susan", "password": "cat"})
+        self.assertEqual(response.status_code, 302)
+        u = User.query.filter_by(username="susan").one()
+        self.assertTrue(u.password_hash.startswith("pbkdf2:sha256:2000$"))
+        self.assertTrue(u.check_password("cat"))
+
+    def test_busy(self):
+        self.app.config["PASSWORD_HASH_WORKERS"] = 1
+        self.app.config["PASSWORD_HASH_QUEUE"] = 0
+        self.app.config["PASSWORD_HASH_WAIT"] = 0
+        hasher = PasswordHasher(self.app)
+        try:
+            self.assertTrue(hasher.verify(hasher.hash("cat"), "cat"))
+
+            # The only slot is taken
+            hasher._slots.acquire()
+            with self.assertRaises(PasswordHashingBusy):
+                hasher.hash("cat")
+            hasher._slots.release()
+        finally:
+            hasher._executor.shutdown()
+
+
+class IdentityCase(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        u = User(username="susan", email="susan@example.com")
+        db.session.add(u)
+        db.session.commit()
+        self.id = u.id
+        db.session.remove()
+        self.statements = []
+
+    def count(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def load(self):
+        db.event.listen(db.engine, "before_cursor_execute", self.count)
+        try:
+            return identity.load_user(str(self.id))
+        finally:
+            db.event.remove(db.engine, "before_cursor_execute", self.count)
+
+    def test_user_cache(self):
+        with self.app.test_request_context():
+            self.assertEqual(self.load().username, "susan")
+        db.session.remove()
+        with self.app.test_request_context():
+            user = self.load()
+            self.assertEqual(user.username, "susan")
+            self.assertEqual(len(self.statements), 1)
+
+            # A change through the session drops the cached copy
+            user.username = "mary"
+            db.session.commit()
+        db.session.remove()
+        with self.app.test_request_context():
+            self.assertEqual(self.load().username, "mary")
+        self.assertEqual(len(self.statements), 2)
+
+    def test_session_identity(self):
+        self.app.config["SESSION_IDENTITY"] = True
+        identity.clear()
+        with self.app.test_request_context(method="POST"):
+            login_user(User.query.get(self.id))
+            saved = dict(session)
+        db.session.remove()
+
+        with self.app.test_request_context():
+            session.update(saved)
+            user = self.load()
+            self.assertIsInstance(user, identity.SessionUser)
+            self.assertEqual((user.id, user.username), (self.id, "susan"))
+            self.assertEqual(self.statements, [])
+            self.assertEqual(user.email, "susan@example.com")
+            with self.assertRaises(AttributeError):
+                user.username = "mary"
+
+        # Requests that change things get the real user
+        with self.app.test_request_context(method="POST"):
+            session.update(saved)
+            self.assertIsInstance(self.load(), User)
+
+
+class SearchCase(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        Post.reindex()
+        self.u = User(username="john", email="john@example.com")
+        bodies = [
+            "the quick brown fox",
+            "a fox, a fox, and another fox",
+            "lazy dogs sleep",
+            "brown bears and brown foxes",
+            "fox",
+        ]
+        db.session.add_all(Post(body=body, author=self.u) for body in bodies)
+        db.session.commit()
+
+    def bodies(self, page):
+        return [post.body for post in page.items]
+
+    def test_incremental(self):
+        self.assertEqual(
+            set(self.bodies(search_posts("fox", 10))),
+            {"the quick brown fox", "a fox, a fox, and another fox", "fox"},
+        )
+        self.assertEqual(
+            self.bodies(search_posts("brown fox", 10)), ["the quick brown fox"]
+        )
+
+        post = Post.query.filter_by(body="fox").one()
+        db.session.delete(post)
+        db.session.commit()
+        self.assertEqual(len(search_posts("fox", 10).items), 2)
+
+        # Nothing is indexed for a rolled back transaction
+        db.session.add(Post(body="fox again", author=self.u))
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(len(search_posts("again", 10).items), 0)
+
+    def test_cursor(self):
+        expected = self.bodies(search_posts("fox", 10))
+        page = search_posts("fox", 2)
+        found = self.bodies(page)
+        while page.has_next:
+            page = search_posts("fox", 2, page.next_cursor)
+            found += self.bodies(page)
+        self.assertEqual(found, expected)
+
+        # Syntax is not passed through to the index
+        self.assertEqual(len(search_posts('fox" OR "dogs', 10).items), 0)
+        self.assertEqual(search_posts("fox", 10, "garbage").items[0].body, expected[0])
+
+    def test_view(self):
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = str(self.u.id)
+        page = client.get("/search?q=lazy").data
+        self.assertIn(b"lazy dogs sleep", page)
+
+        # The search box keeps the query on the results page only
+        self.assertIn(b"value='lazy'", page)
+        self.assertNotIn(b"value='lazy'", client.get("/explore?q=lazy").data)
+
+    def test_max_candidates(self):
+        # Only the most recent matches are ranked
+        self.app.extensions["search"].backend.max_candidates = 2
+        self.assertEqual(
+            set(self.bodies(search_posts("fox", 10))),
+            {"a fox, a fox, and another fox", "fox"},
+        )
+
+    def test_reindex(self):
+        Post.query.filter_by(body="fox").update({"body": "wolf"})
+        db.session.commit()
+        self.assertEqual(len(search_posts("wolf", 10).items), 0)
+        self.assertEqual(Post.reindex(), 5)
+        self.assertEqual(self.bodies(search_posts("wolf", 10)), ["wolf"])
+
+
+class ApiCase(AppTestCase):
+    config = {"PASSWORD_HASH_WORKERS": 0}
+
+    def setUp(self):
+        super().setUp()
+        self.u1 = User(username="john", email="john@example.com")
+        self.u2 = User(username="susan", email="susan@example.com")
+        self.u1.set_password("cat")
+        db.session.add_all([self.u1, self.u2])
+        now = datetime.utcnow()
+        for i in range(7):
+            author = self.u2 if i % 2 else self.u1
+            timestamp = now + timedelta(seconds=i)
+            db.session.add(Post(body="post %d" % i, author=author, timestamp=timestamp))
+        db.session.commit()
+        self.id1, self.id2 = self.u1.id, self.u2.id
+        self.client = self.app.test_client()
+
+    def token(self):
+        credentials = base64.b64encode(b"john:cat").decode("ascii")
+        response = self.client.post(
+            "/api/v1/tokens", headers={"Authorization": "Basic " + credentials}
+        )
+        self.assertEqual(response.status_code, 200)
+        return {"Authorization": "Bearer " + response.get_json()["token"]}
+
+    def test_auth(self):
+        self.assertEqual(self.client.get("/api/v1/posts").status_code, 401)
+        response = self.client.post(
+            "/api/v1/tokens",
+            headers={
+                "Authorization": "Basic " + base64.b64encode(b"john:dog").decode()
+            },
+        )
+        self.assertEqual(response.status_code, 401)
+
+        headers = self.token()
+        response = self.client.get("/api/v1/users/%d" % self.id1, headers=headers)
+        self.assertEqual(response.get_json()["email"], "john@example.com")
+        response = self.client.get("/api/v1/users/99", headers=headers)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.get_json()["error"], "Not Found")
+
+        self.client.delete("/api/v1/tokens", headers=headers)
+        self.assertEqual(
+            self.client.get("/api/v1/posts", headers=headers).status_code, 401
+        )
+
+    def test_cursor_pagination(self):
+        headers = self.token()
+        url = "/api/v1/posts?per_page=3"
+        bodies = []
+        while url:
+            data = self.client.get(url, headers=headers).get_json()
+            self.assertLessEqual(len(data["items"]), 3)
+            bodies += [post["body"] for post in data["items"]]
+            url = data["_links"]["next"]
+        self.assertEqual(bodies, ["post %d" % i for i in reversed(range(7))])
+
+    def test_ndjson(self):
+        headers = self.token()
+        self.app.config["API_STREAM_BATCH_SIZE"] = 2
+        response = self.client.get(
+            "/api/v1/users/%d/posts?format=ndjson" % self.id2, headers=headers
+        )
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(
+            [json.loads(line)["body"] for line in lines], ["post 5", "post 3", "post 1"]
+        )
+
+    def test_follow_and_post(self):
+        headers = self.token()
+        response = self.client.post(
+            "/api/v1/users/%d/followers" % self.id2, headers=headers
+        )
+        self.assertEqual(response.status_code, 204)
+        response = self.client.post(
+            "/api/v1/posts", json={"body": "hello"}, headers=headers
+        )
+        self.assertEqual(response.status_code, 201)
+
+        data = self.client.get("/api/v1/timeline?per_page=20", headers=headers)
+        self.assertEqual(len(data.get_json()["items"]), 8)
+        data = self.client.get(
+            "/api/v1/users/%d/followers" % self.id2, headers=headers
+        ).get_json()
+        self.assertEqual([user["username"] for user in data["items"]], ["john"])
+
+    def test_user_validation(self):
+        user = {"username": "mary", "email": "mary@example.com", "password": "dog"}
+        for field, value in (
+            ("username", ""),
+            ("username", " "),
+            ("username", "m" * 65),
+            ("username", None),
+            ("email", "not-an-email"),
+            ("email", "m" * 110 + "@example.com"),
+            ("password", ""),
+            ("about_me", "a" * 141),
+            ("about_me", {"text": "hi"}),
+        ):
+            response = self.client.post(
+                "/api/v1/users", json=dict(user, **{field: value})
+            )
+            self.assertEqual(response.status_code, 400, (field, value))
+        del user["password"]
+        self.assertEqual(self.client.post("/api/v1/users", json=user).status_code, 400)
+
+        headers = self.token()
+        url = "/api/v1/users/%d" % self.id1
+        for data in (
+            {"username": None},
+            {"username": ""},
+            {"username": "j" * 65},
+            {"about_me": {"text": "hi"}},
+            {"about_me": "a" * 141},
+        ):
+            response = self.client.put(url, json=data, headers=headers)
+            self.assertEqual(response.status_code, 400, data)
+        response = self.client.put(
+            url, json={"username": "johnny", "about_me": "hi"}, headers=headers
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["username"], "johnny")
+
+
+class SeedCase(AppTestCase):
+    config = {"PASSWORD_HASH_WORKERS": 0, "PASSWORD_HASH_METHOD": "pbkdf2:sha256:1000"}
+
+    def setUp(self):
+        super().setUp()
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def write(self, name, text):
+        path = os.path.join(self.dir.name, name)
+        with open(path, "w") as f:
+            f.write(text)
+        return path
+
+    def test_import(self):
+        users = self.write(
+            "users.csv",
+            "username,email,password\njohn,john@example.com,cat\nsusan,susan@example.com,dog\n",
+        )
+        posts = self.write(
+            "posts.jsonl",
+            '{"username": "john", "body": "hi", "timestamp": "2021-01-01T00:00:00Z"}\n'
+            '{"username": "susan", "body": "hello"}\n'
+            '{"username": "susan", "body": "again"}\n',
+        )
+        edges = self.write("edges.csv", "follower,followed\njohn,susan\n")
+
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(
+            args=["data", "import", "--users", users, "--posts", posts]
+            + ["--followers", edges, "--chunk-size", "2", "--defer-indexes"]
+        )
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("2 users, 3 posts and 1 followers", result.output)
+
+        john = User.query.filter_by(username="john").one()
+        susan = User.query.filter_by(username="susan").one()
+        self.assertTrue(john.check_password("cat"))
+        self.assertEqual(john.avatar(64), User(email="john@example.com").avatar(64))
+        self.assertTrue(john.is_following(susan))
+        self.assertEqual((susan.post_count, susan.follower_count), (2, 1))
+        self.assertEqual(len(search_posts("hello", 10).items), 1)
+
+    def test_import_duplicate(self):
+        users = self.write(
+            "users.csv",
+            "username,email\njohn,john@example.com\njohn,other@example.com\n",
+        )
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(
+            args=["data", "import", "--users", users]
+            + ["--chunk-size", "1", "--defer-indexes"]
+        )
+        self.assertIsInstance(result.exception, IntegrityError)
+
+        # The unique indexes caught the duplicate, and every index is back
+        self.assertEqual(User.query.count(), 1)
+        for table in (User.__table__, Post.__table__, followers):
+            names = {
+                index["name"] for index in db.inspect(db.engine).get_indexes(table.name)
+            }
+            self.assertEqual(names, {index.name for index in table.indexes})
+
+    def test_generate(self):
+        counts = seed.generate(200, 1000, mean_follows=10, seed=1)
+        seed.finish()
+        self.assertEqual((counts["users"], counts["posts"]), (200, 1000))
+        self.assertEqual(db.session.query(followers).count(), counts["followers"])
+
+        # A few users have far more followers than the typical user
+        follower_counts = sorted(
+            count for count, in db.session.query(User.follower_count)
+        )
+        self.assertGreater(
+            follower_counts[-1], 5 * follower_counts[len(follower_counts) // 2]
+        )
+        self.assertEqual(sum(follower_counts), counts["followers"])
+
+
+class DatabaseCase(AppTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.config = {
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///"
+            + os.path.join(directory.name, "primary.db"),
+            "DATABASE_REPLICA_URI": "sqlite:///"
+            + os.path.join(directory.name, "replica.db"),
+            "DATABASE_POOL_SIZE": 2,
+            "RESPONSE_CACHE_BACKEND": "null",
+            "WTF_CSRF_ENABLED": False,
+        }
+        super().setUp()
+        db.Model.metadata.create_all(db.get_engine(bind="replica"))
+
+        # The replica lags behind: it has the users, but not the post
+        for bind in (None, "replica"):
+            with db.get_engine(bind=bind).begin() as connection:
+                connection.execute(
+                    User.__table__.insert(),
+                    [
+                        {"id": 1, "username": "john", "email": "john@example.com"},
+                        {"id": 2, "username": "mary", "email": "mary@example.com"},
+                    ],
+                )
+        db.session.add(Post(body="on the primary", user_id=2))
+        db.session.commit()
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as session:
+            session["_user_id"] = "1"
+
+        # Requests get their own app context, and so their own session
+        db.session.remove()
+        self.app_context.pop()
+
+    def tearDown(self):
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        engine = db.engine
+        super().tearDown()
+        engine.dispose()
+
+    def test_migrate(self):
+        # Scripts can run `flask_migrate.upgrade()` on any application
+        self.assertIs(self.app.extensions["migrate"].db, db)
+
+    def test_committed_database(self):
+        # The database in the repository is kept at the latest migration
+        from alembic.script import ScriptDirectory
+
+        root = os.path.dirname(os.path.abspath(__file__))
+        head = ScriptDirectory(os.path.join(root, "migrations")).get_current_head()
+        connection = sqlite3.connect(os.path.join(root, "app.db"))
+        try:
+            revision = connection.execute("SELECT version_num FROM alembic_version")
+            self.assertEqual(revision.fetchone()[0], head)
+        finally:
+            connection.close()
+
+    def test_pragmas(self):
+        with self.app.app_context():
+            self.assertEqual(db.engine.pool.size(), 2)
+            with db.engine.connect() as connection:
+                for pragma, value in (
+                    ("journal_mode", "wal"),
+                    ("synchronous", 1),
+                    ("busy_timeout", 5000),
+                    ("cache_size", -16000),
+                ):
+                    self.assertEqual(
+                        connection.execute(text("PRAGMA " + pragma)).scalar(), value
+                    )
+
+    def test_replica(self):
+        self.assertNotIn(b"on the primary", self.client.get("/explore").data)
+        self.assertNotIn(b"on the primary", self.client.get("/user/mary").data)
+
+        # Pages that write, and those that aren't marked, use the primary
+        self.assertIn(b"on the primary", self.client.get("/search?q=primary").data)
+        response = self.client.post("/index", data={"post": "new post"})
+        self.assertEqual(response.status_code, 302)
+        with self.app.app_context():
+            self.assertEqual(Post.query.count(), 2)
+            with db.get_engine(bind="replica").connect() as connection:
+                count = connection.execute(text("SELECT count(*) FROM post"))
+                self.assertEqual(count.scalar(), 0)
+
+        # Right after writing, the client reads its own writes
+        self.assertIn(b"new post", self.client.get("/explore").data)
+        with self.client.session_transaction() as session:
+            session["_primary_until"] = 0
+        self.assertNotIn(b"new post", self.client.get("/explore").data)
+        with self.client.session_transaction() as session:
+            self.assertNotIn("_primary_until", session)
+
+    def test_replica_cache(self):
+        self.app.config["RESPONSE_CACHE_BACKEND"] = "memory"
+        cache.init_app(self.app)
+
+        # What every viewer gets from the cache is read from the primary
+        self.assertIn(b"on the primary", self.client.get("/explore").data)
+        self.assertIn(b"on the primary", self.client.get("/user/mary").data)
+
+        # Even right after someone else's post invalidated it
+        other = self.app.test_client()
+        with other.session_transaction() as session:
+            session["_user_id"] = "2"
+        other.post("/index", data={"post": "new post"})
+        self.assertIn(b"new post", self.client.get("/explore").data)
+        self.assertIn(b"new post", other.get("/explore").data)
+        self.assertIn(b"new post", other.get("/user/mary").data)
+
+
+class InstrumentationCase(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        u = User(username="john", email="john@example.com")
+        db.session.add(u)
+        db.session.add(Post(body="hello", author=u))
+        db.session.commit()
+        self.client = self.login(u)
+        instrumentation.reset()
+
+    def test_server_timing(self):
+        response = self.client.get("/explore")
+        self.assertNotIn("Server-Timing", response.headers)
+
+        self.app.config["SERVER_TIMING"] = True
+        cache.clear()
+        identity.clear()
+        response = self.client.get("/explore")
+        timing = response.headers["Server-Timing"]
+        self.assertRegex(timing, r'^db;dur=[\d.]+;desc="\d+ queries", tpl;dur=')
+        self.assertNotIn('desc="0 queries"', timing)
+
+    def test_slow_log(self):
+        self.app.config["SLOW_REQUEST_THRESHOLD"] = 0.001
+        identity.clear()
+        with self.assertLogs("app.slow", "WARNING") as logs:
+            self.client.get("/explore")
+        self.assertIn("GET /explore (main.explore)", logs.output[0])
+        self.assertIn("SELECT", logs.output[0])
+
+        # Bound values, like the token of an API request, are left out
+        user = User.query.first()
+        token = user.get_token()
+        db.session.commit()
+        with self.assertLogs("app.slow", "WARNING") as logs:
+            self.client.get(
+                "/api/v1/users/%d" % user.id,
+                headers={"Authorization": "Bearer " + token},
+            )
+        self.assertIn("SELECT", logs.output[0])
+        self.assertNotIn(token, logs.output[0])
+
+    def test_metrics(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 404)
+
+        self.app.config["METRICS_ENABLED"] = True
+        self.client.get("/explore")
+        self.client.get("/explore")
+        text = self.client.get("/metrics").get_data(as_text=True)
+        self.assertIn(
+            'microblog_requests_total{endpoint="main.explore",method="GET",status="200"} 2',
+            text,
+        )
+        self.assertIn(
+            'microblog_request_duration_seconds_count{endpoint="main.explore"} 2', text
+        )
+        self.assertIn('microblog_mail_queue_messages{state="queued"} 0', text)
+
+
+class StreamCase(AppTestCase):
+    config = {"STREAM_HEARTBEAT": 0.01, "WTF_CSRF_ENABLED": False}
+
+    def setUp(self):
+        super().setUp()
+        self.u1 = User(username="john", email="john@example.com")
+        self.u2 = User(username="susan", email="susan@example.com")
+        db.session.add_all([self.u1, self.u2])
+        db.session.commit()
+        self.client = self.login(self.u1)
+
+    def next_event(self, events):
+        """Return the next message of a stream that isn't a heartbeat."""
+        for chunk in events:
+            if chunk != b": heartbeat\n\n":
+                return chunk.decode()
+
+    def publish(self, body, author):
+        post = Post(body=body, author=author)
+        db.session.add(post)
+        db.session.commit()
+        with self.app.test_request_context():
+            post_stream.publish_post(post, "<p>%s</p>" % body)
+
+    def test_hub(self):
+        hub = Hub(backlog=3)
+        for i in range(5):
+            hub.append("post", i)
+        self.assertEqual([event.data for event in hub.since(2)], [2, 3, 4])
+        self.assertEqual(hub.since(5), [])
+
+        # Events before the backlog, or from the future, are lost
+        self.assertIsNone(hub.since(1))
+        self.assertIsNone(hub.since(6))
+        self.assertEqual(hub.wait(5, 0.01), [])
+
+    def test_view(self):
+        response = self.client.get("/stream", buffered=False)
+        self.assertEqual(response.mimetype, "text/event-stream")
+        events = iter(response.response)
+        self.assertEqual(next(events), b"retry: 3000\n\n")
+
+        # Only posts by the user and the followed users are sent
+        self.publish("from susan", self.u2)
+        self.client.post("/index", data={"post": "from john"})
+        message = self.next_event(events)
+        self.assertIn("event: post\n", message)
+        self.assertIn("from john", message)
+        last_id = int(message.split("\n")[0][len("id: ") :])
+
+        self.client.post("/follow/susan")
+        self.publish("followed susan", self.u2)
+        self.assertIn("followed susan", self.next_event(events))
+        response.close()
+
+        # A client that reconnects gets what it missed
+        self.publish("missed", self.u2)
+        response = self.client.get(
+            "/stream", headers={"Last-Event-ID": str(last_id)}, buffered=False
+        )
+        events = iter(response.response)
+        next(events)
+        self.assertIn("followed susan", self.next_event(events))
+        self.assertIn("missed", self.next_event(events))
+        response.close()
+
+        # Or is told it missed too much
+        response = self.client.get(
+            "/stream", headers={"Last-Event-ID": "1"}, buffered=False
+        )
+        events = iter(response.response)
+        next(events)
+        self.assertIn("event: reset\n", self.next_event(events))
+        response.close()
+
+    def test_heartbeat(self):
+        post_stream.heartbeat = 0.05
+        events = post_stream.events(self.u1.id, {self.u1.id})
+        next(events)
+
+        # Posts that the client doesn't see don't hold back the heartbeat
+        done = threading.Event()
+
+        def publish():
+            stop = time.monotonic() + 1
+            while not done.wait(0.002) and time.monotonic() < stop:
+                post_stream.backend.publish(
+                    "post", {"id": 0, "author_id": self.u2.id, "html": ""}
+                )
+
+        publisher = threading.Thread(target=publish)
+        publisher.start()
+        try:
+            start = time.monotonic()
+            self.assertEqual(next(events), ": heartbeat\n\n")
+            self.assertLess(time.monotonic() - start, 0.5)
+        finally:
+            done.set()
+            publisher.join()
+
+    def test_sqlite(self):
+        with tempfile.TemporaryDirectory() as directory:
+            streams = []
+            for _ in range(2):
+                app = Flask(__name__)
+                app.config["STREAM_BACKEND"] = "sqlite"
+                app.config["STREAM_PATH"] = os.path.join(directory, "stream.db")
+                app.config["STREAM_BACKLOG"] = 10
+                streams.append(PostStream(app))
+
+            # Events published by one process reach the others
+            streams[0].publish_follow(self.u1, self.u2)
+            hub = streams[1].hub
+            streams[1].backend.poll()
+            self.assertEqual(hub.since(0)[0].data["followed_id"], self.u2.id)
+            for stream in streams:
+                stream.backend.after_fork()
+
+
+class RecommendationCase(AppTestCase):
+    config = {"WTF_CSRF_ENABLED": False}
+
+    def setUp(self):
+        super().setUp()
+        self.users = {}
+        for name in ("john", "susan", "mary", "david", "alice"):
+            self.users[name] = User(username=name, email="%s@example.com" % name)
+        db.session.add_all(self.users.values())
+        self.follow("john", "susan", "mary")
+        self.follow("susan", "david")
+        self.follow("mary", "david", "alice")
+        db.session.commit()
+
+    def follow(self, name, *names):
+        for other in names:
+            self.users[name].follow(self.users[other])
+
+    def suggested(self, name):
+        return [
+            (user.username, round(score, 3))
+            for user, score in recommendations.suggestions(self.users[name])
+        ]
+
+    def test_rebuild(self):
+        self.assertEqual(recommendations.rebuild(), 2)
+        db.session.commit()
+
+        # David is reached through susan (1 / log 2) and mary (1 / log 3)
+        self.assertEqual(self.suggested("john"), [("david", 2.353), ("alice", 0.91)])
+        self.assertEqual(self.suggested("susan"), [])
+
+        self.app.config["RECOMMENDATIONS_SCORE"] = "common_neighbors"
+        recommendations.rebuild()
+        self.assertEqual(self.suggested("john"), [("david", 2.0), ("alice", 1.0)])
+
+    def test_update(self):
+        recommendations.rebuild()
+
+        # Following a suggestion removes it, and alice's suggestions reach
+        # the followers of susan
+        self.follow("john", "david")
+        recommendations.update(self.users["john"])
+        self.follow("susan", "alice")
+        recommendations.update(self.users["susan"])
+        db.session.commit()
+        self.assertEqual(self.suggested("john"), [("alice", 1.82)])
+
+        # Too many followers to rescore them all
+        self.app.config["RECOMMENDATIONS_UPDATE_MAX_FOLLOWERS"] = 0
+        self.users["susan"].unfollow(self.users["alice"])
+        recommendations.update(self.users["susan"])
+        self.assertEqual(self.suggested("john"), [("alice", 1.82)])
+
+    def test_update_matches_rebuild(self):
+        users = [
+            User(username="user%d" % i, email="%d@example.com" % i) for i in range(30)
+        ]
+        db.session.add_all(users)
+        db.session.flush()
+        self.app.config["RECOMMENDATIONS_UPDATE_MAX_FOLLOWERS"] = 1000
+        self.app.config["RECOMMENDATIONS_PER_USER"] = 5
+        for i in range(150):
+            users[i % 30].follow(users[i * 7 % 29])
+        recommendations.rebuild()
+
+        for i in range(40):
+            follower, followed = users[i * 11 % 30], users[i * 13 % 30]
+            if follower.is_following(followed):
+                follower.unfollow(followed)
+            elif follower != followed:
+                follower.follow(followed)
+            recommendations.update(follower)
+
+        rows = Recommendation.query.with_entities(
+            Recommendation.user_id, Recommendation.candidate_id, Recommendation.score
+        )
+        updated = sorted((u, c, round(s, 9)) for u, c, s in rows)
+        recommendations.rebuild()
+        rebuilt = sorted((u, c, round(s, 9)) for u, c, s in rows)
+        self.assertEqual(updated, rebuilt)
+
+    def test_views(self):
+        recommendations.rebuild()
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = str(self.users["john"].id)
+        page = client.get("/user/john").get_data(as_text=True)
+        self.assertIn("Who to follow", page)
+        self.assertIn("/user/david", page)
+        self.assertNotIn(
+            "Who to follow", client.get("/user/susan").get_data(as_text=True)
+        )
+
+        # Following from the profile page updates the suggestions
+        client.post("/follow/david")
+        page = client.get("/user/john").get_data(as_text=True)
+        self.assertNotIn('/user/david"', page)
+
+        token = self.users["john"].get_token()
+        db.session.commit()
+        headers = {"Authorization": "Bearer " + token}
+        response = client.get(
+            "/api/v1/users/%d/recommendations" % self.users["john"].id, headers=headers
+        )
+        self.assertEqual(
+            [
+                (item["username"], round(item["score"], 3))
+                for item in response.json["items"]
+            ],
+            [("alice", 0.91)],
+        )
+        response = client.get(
+            "/api/v1/users/%d/recommendations" % self.users["susan"].id, headers=headers
+        )
+        self.assertEqual(response.status_code, 403)
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class LoggingCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_digest(self):
+        target = ListHandler()
+        handler = DigestHandler(target, interval=3600)
+        logger = logging.getLogger("tests.digest")
+        logger.propagate = False
+        logger.addHandler(handler)
+        try:
+            for i in range(3):
+                logger.error("Failed %d", i)
+            logger.error("Something else")
+
+            # The first error is sent at once, and the rest wait for the
+            # interval to pass
+            self.assertEqual(len(target.records), 1)
+            self.assertIn("1 errors, 1 distinct", target.records[0].getMessage())
+
+            handler.close()
+            self.assertEqual(len(target.records), 2)
+            digest = target.records[1].getMessage()
+            self.assertIn("3 errors, 2 distinct", digest)
+            self.assertIn("2 times:\n", digest)
+            self.assertIn("Failed 1", digest)
+            self.assertNotIn("Failed 2", digest)
+        finally:
+            logger.removeHandler(handler)
+
+    def test_full_queue(self):
+        handler = NonBlockingQueueHandler(queue.Queue(1))
+        for i in range(3):
+            handler.handle(logging.makeLogRecord({"msg": "message %d" % i}))
+        self.assertEqual(handler.dropped, 2)
+
+    def log_app(self):
+        log_app = Flask("logtest")
+        log_app.config.from_object("config.Config")
+        log_app.config["MAIL_SERVER"] = None
+        log_app.config["LOG_PATH"] = os.path.join(self.dir.name, "logs", "test.log")
+        return log_app
+
+    def read_log(self):
+        with open(os.path.join(self.dir.name, "logs", "test.log")) as f:
+            return f.read()
+
+    def test_json_log(self):
+        log_app = self.log_app()
+        log_app.config["LOG_JSON"] = True
+        queue_logging = QueueLogging(log_app)
+        self.addCleanup(queue_logging.stop)
+
+        with log_app.test_request_context("/explore?page=2"):
+            try:
+                1 / 0
+            except ZeroDivisionError:
+                log_app.logger.exception("Failed for %s", "john")
+        queue_logging.listener.queue.join()
+
+        with open(log_app.config["LOG_PATH"]) as f:
+            entry = json.loads(f.readline())
+        self.assertEqual(entry["message"], "Failed for john")
+        self.assertEqual(entry["level"], "ERROR")
+        self.assertIn("ZeroDivisionError", entry["exception"])
+        self.assertEqual(entry["request"]["path"], "/explore?page=2")
+
+    def test_init_twice(self):
+        log_app = self.log_app()
+        queue_logging = QueueLogging(log_app)
+        self.addCleanup(queue_logging.stop)
+        queue_logging.init_app(log_app)
+        queue_handlers = [
+            handler
+            for handler in log_app.logger.handlers
+            if isinstance(handler, NonBlockingQueueHandler)
+        ]
+        self.assertEqual(queue_handlers, [queue_logging.handler])
+
+        log_app.logger.warning("Only once")
+        queue_logging.listener.queue.join()
+        self.assertEqual(self.read_log().count("Only once"), 1)
+
+    def test_after_fork(self):
+        log_app = self.log_app()
+        queue_logging = QueueLogging(log_app)
+        self.addCleanup(queue_logging.stop)
+
+        # A forked process has the queue, but not the listener thread
+        queue_logging.listener.stop()
+        queue_logging.after_fork()
+        log_app.logger.warning("From the child")
+        queue_logging.listener.queue.join()
+        self.assertIn("From the child", self.read_log())
+
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)